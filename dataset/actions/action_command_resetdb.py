@@ -3,7 +3,11 @@ from typing import Any, Text, Dict, List
 from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 
-from actions.utils.admin_config import get_admin_group_id, is_super_admin
+from actions.utils.admin_config import (
+    get_admin_group_id,
+    invalidate_admin_config,
+    is_super_admin,
+)
 from actions.db.store import reset_actions_db
 
 
@@ -23,6 +27,7 @@ class ActionCommandResetDB(Action):
 
         old_group_id = get_admin_group_id() or "not set"
         reset_actions_db()
+        invalidate_admin_config()
         dispatcher.utter_message(
             json_message={
                 "text": f"The actions DB has been reset. Previous group id was {old_group_id}."
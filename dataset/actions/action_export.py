@@ -5,11 +5,16 @@ from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 
 from actions.utils.admin_config import get_admin_group_id
-from actions.utils.csv import format_csv_entry
+from actions.utils.csv import format_csv_entry, write_csv_file
 from actions.utils.date import SERVER_TZINFO
 from actions.utils.entity import get_entity
 from actions.utils.json import get_json_key
-from actions.utils.livechat import get_livechats
+from actions.utils.livechat import (
+    LIVECHAT_EXPORT_ROW_PROJECTION,
+    count_livechats,
+    get_livechats,
+    get_livechats_query,
+)
 from actions.utils.menu import (
     DATE_SELECTOR_DISPLAY_NAME,
     LIFECYCLE_SELECTOR_DISPLAY_NAME,
@@ -22,6 +27,9 @@ from actions.utils.menu import (
     get_timestamps,
 )
 
+# exports with more rows than this are sent gzipped
+EXPORT_COMPRESS_MIN_ROWS = 10000
+
 
 def format_chat_header_for_csv():
     cols = [
@@ -66,11 +74,17 @@ def format_chat_for_csv(c):
             f"{get_json_key(c, 'user_metadata.browser_data.fullVersion')}"
         ),
         format_csv_entry(f"{get_json_key(c, 'user_metadata.referrer_data.referrer')}"),
-        f"{len(c.get('sessions', []))}",
+        f"{c.get('num_sessions', 0)}",
     ]
     return ",".join(cols)
 
 
+def format_chats_for_csv(livechats):
+    yield format_chat_header_for_csv()
+    for c in livechats:
+        yield format_chat_for_csv(c)
+
+
 def export_users(lifecycle_selector, date_selector):
     lifecycle_stage = LIFECYCLE_SELECTOR_STAGE_MAP.get(lifecycle_selector, None)
 
@@ -78,22 +92,33 @@ def export_users(lifecycle_selector, date_selector):
         date_selector
     )
 
-    livechats = get_livechats(
-        lifecycle_stage=lifecycle_stage, from_ts=current_from_ts, to_ts=current_to_ts
-    )
-
-    chat_count = livechats.count()
+    livechats_filter = {
+        "lifecycle_stage": lifecycle_stage,
+        "from_ts": current_from_ts,
+        "to_ts": current_to_ts,
+    }
+    livechats_query = get_livechats_query(**livechats_filter)
+    chat_count = count_livechats(query=livechats_query)
 
     lifecycle_stage_name = lifecycle_stage or "all"
     date_selector_name = DATE_SELECTOR_DISPLAY_NAME.get(date_selector)
     current_date = datetime.now(tz=SERVER_TZINFO)
     current_date_str = current_date.strftime("%d.%m.%y_%H.%M_%p")
     file_name_base = f"{lifecycle_stage_name}_{date_selector_name.replace(' ', '-')}_{current_date_str}"
-    file_name_csv = f"{file_name_base}.csv"
-    chats_csv_list = [format_chat_header_for_csv()] if chat_count else []
-    for c in livechats:
-        chats_csv_list.append(format_chat_for_csv(c))
-    chats_csv = "\n".join(chats_csv_list)
+
+    csv_path = None
+    csv_file_name = None
+    csv_file_type = None
+    if chat_count:
+        compress = chat_count >= EXPORT_COMPRESS_MIN_ROWS
+        livechats = get_livechats(
+            query=livechats_query, projection=LIVECHAT_EXPORT_ROW_PROJECTION
+        )
+        csv_path = write_csv_file(format_chats_for_csv(livechats), compress=compress)
+        csv_file_name = (
+            f"{file_name_base}.csv.gz" if compress else f"{file_name_base}.csv"
+        )
+        csv_file_type = "application/gzip" if compress else "text/csv"
 
     text = ""
 
@@ -105,8 +130,9 @@ def export_users(lifecycle_selector, date_selector):
 
     return (
         text,
-        chats_csv,
-        file_name_csv,
+        csv_path,
+        csv_file_name,
+        csv_file_type,
         {
             "text": text,
             "reply_markup": {
@@ -156,16 +182,20 @@ class ActionExport(Action):
                 lifecycle_selector,
             )
         elif view_selector == VIEW_SELECTOR_COMMAND:
-            (caption, csv_data, csv_filename, json_message) = export_users(
-                lifecycle_selector, date_selector
-            )
-            if csv_data:
+            (
+                caption,
+                csv_path,
+                csv_file_name,
+                csv_file_type,
+                json_message,
+            ) = export_users(lifecycle_selector, date_selector)
+            if csv_path:
                 dispatcher.utter_message(
                     json_message={
                         "caption": caption,
-                        "document": csv_data,
-                        "document_file_type": "text/csv",
-                        "document_file_name": csv_filename,
+                        "document_path": csv_path,
+                        "document_file_type": csv_file_type,
+                        "document_file_name": csv_file_name,
                     }
                 )
 
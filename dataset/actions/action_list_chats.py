@@ -8,24 +8,22 @@ from actions.utils.admin_config import get_admin_group_id
 from actions.utils.entity import get_entity
 from actions.utils.json import get_json_key
 from actions.utils.livechat import (
+    LIVECHAT_ID_PROJECTION,
+    LIVECHAT_LIST_ROW_PROJECTION,
+    count_livechats,
+    get_livechat,
     get_livechats,
+    get_livechats_query,
     get_livechat_card,
 )
-from actions.utils.message_metadata import update_message_metadata
-
-ONLINE_SELECTOR = "o"
-ALL_SELECTOR = "a"
-NEW_VISITOR_SELECTOR = "n"
-QUALIFIED_LEAD_SELECTOR = "q"
-UNQUALIFIED_SELECTOR = "u"
-
-SELECTOR_DISPLAY_NAME = {
-    ONLINE_SELECTOR: "Online",
-    ALL_SELECTOR: "All",
-    NEW_VISITOR_SELECTOR: "New Visitor",
-    QUALIFIED_LEAD_SELECTOR: "Qualified Lead",
-    UNQUALIFIED_SELECTOR: "Unqualified",
-}
+from actions.utils.menu import (
+    ALL_SELECTOR,
+    NEW_VISITOR_SELECTOR,
+    ONLINE_SELECTOR,
+    QUALIFIED_LEAD_SELECTOR,
+    SELECTOR_DISPLAY_NAME,
+    UNQUALIFIED_SELECTOR,
+)
 
 
 def get_menu_message():
@@ -69,26 +67,13 @@ def paginate_inline_button(
     inline_buttons,
     selector,
     page_index=0,
+    total_pages=1,
     row_width=4,
-    max_rows=10,
 ):
-    paginated_buttons = []
-    total_buttons = len(inline_buttons)
-    total_rows = ceil(total_buttons / row_width)
-    total_pages = ceil(total_rows / max_rows)
-
-    clamp = lambda val, min, max: min if val < min else max if val > max else val
-
-    page_index = clamp(page_index, 0, total_pages - 1)
-    num_rows = clamp(total_rows - (page_index * max_rows), 0, max_rows)
-    slice_start = page_index * max_rows * row_width
-
-    for i in range(num_rows):
-        slice_end = slice_start + row_width
-        sliced_list = inline_buttons[slice_start:slice_end]
-        if sliced_list:
-            paginated_buttons.append(sliced_list)
-        slice_start += row_width
+    paginated_buttons = [
+        inline_buttons[i : i + row_width]
+        for i in range(0, len(inline_buttons), row_width)
+    ]
 
     if total_pages > 1:
         scroll_buttons = []
@@ -114,19 +99,37 @@ def paginate_inline_button(
 def get_chat_inline_button(chat, selector, page_index):
     return {
         "title": f"{get_json_key(chat, 'user_metadata.user_name', chat.get('user_id'))}",
-        "payload": f'/chats{{"p":"{selector}","u":"{chat.get("user_id")}","i":{page_index}}}',
+        "payload": f'/chats{{"p":"{selector}","c":"{chat.get("_id")}","b":{page_index}}}',
     }
 
 
-def format_chats_message(chats, selector, page_index):
+def format_chats_message(livechats_filter, selector, page_index):
     ROW_WIDTH = 2
     MAX_ROWS = 10
+    PAGE_SIZE = ROW_WIDTH * MAX_ROWS
+
+    # only the requested page is read from the db; a date filter makes the query
+    # expensive to build, so it is built once for the count and the page
+    livechats_query = get_livechats_query(**livechats_filter)
+    total_chats = count_livechats(query=livechats_query)
+    total_pages = ceil(total_chats / PAGE_SIZE)
+
+    clamp = lambda val, min, max: min if val < min else max if val > max else val
+
+    page_index = clamp(page_index, 0, max(total_pages - 1, 0))
+    chats = get_livechats(
+        query=livechats_query,
+        projection=LIVECHAT_LIST_ROW_PROJECTION,
+        skip=page_index * PAGE_SIZE,
+        limit=PAGE_SIZE,
+    )
+
     chats_keyboard = paginate_inline_button(
         [get_chat_inline_button(c, selector, page_index) for c in chats],
         selector,
         page_index,
+        total_pages,
         ROW_WIDTH,
-        MAX_ROWS,
     )
 
     reply_markup = {
@@ -153,28 +156,29 @@ def format_chats_message(chats, selector, page_index):
 
 
 def get_all_chats_message(page_index):
-    all_chats = get_livechats()
-    return format_chats_message(all_chats, ALL_SELECTOR, page_index)
+    return format_chats_message({}, ALL_SELECTOR, page_index)
 
 
 def get_online_chats_message(page_index):
-    online_chats = get_livechats(online=True)
-    return format_chats_message(online_chats, ONLINE_SELECTOR, page_index)
+    return format_chats_message({"online": True}, ONLINE_SELECTOR, page_index)
 
 
 def get_qualified_chats_message(page_index):
-    qualified_chats = get_livechats(lifecycle_stage="lead")
-    return format_chats_message(qualified_chats, QUALIFIED_LEAD_SELECTOR, page_index)
+    return format_chats_message(
+        {"lifecycle_stage": "lead"}, QUALIFIED_LEAD_SELECTOR, page_index
+    )
 
 
 def get_unqualified_chats_message(page_index):
-    unqualified_chats = get_livechats(lifecycle_stage="unqualified")
-    return format_chats_message(unqualified_chats, UNQUALIFIED_SELECTOR, page_index)
+    return format_chats_message(
+        {"lifecycle_stage": "unqualified"}, UNQUALIFIED_SELECTOR, page_index
+    )
 
 
 def get_new_visitor_chats_message(page_index):
-    new_visitor_chats = get_livechats(lifecycle_stage="subscriber")
-    return format_chats_message(new_visitor_chats, NEW_VISITOR_SELECTOR, page_index)
+    return format_chats_message(
+        {"lifecycle_stage": "subscriber"}, NEW_VISITOR_SELECTOR, page_index
+    )
 
 
 class ActionListChats(Action):
@@ -191,8 +195,11 @@ class ActionListChats(Action):
         entities = tracker.latest_message.get("entities", [])
         selector = get_entity(entities, "s")
         parent_selector = get_entity(entities, "p")
+        livechat_id = get_entity(entities, "c")
         user_id = get_entity(entities, "u")
         page_index = get_entity(entities, "i", 0)
+        # page of the parent list; buttons sent before "b" existed carry it in "i"
+        back_page_index = get_entity(entities, "b", page_index)
 
         metadata = tracker.latest_message.get("metadata", {})
         callback_query_message = get_json_key(metadata, "callback_query.message", {})
@@ -210,23 +217,17 @@ class ActionListChats(Action):
         elif selector == NEW_VISITOR_SELECTOR:
             json_message = get_new_visitor_chats_message(page_index)
         elif not selector:
-            if parent_selector and user_id and callback_query_message_id:
-                back_button_title = (
-                    f"↩️ Back to {SELECTOR_DISPLAY_NAME[parent_selector]} chats"
+            livechat = None
+            if livechat_id:
+                livechat = get_livechat(
+                    id=livechat_id, projection=LIVECHAT_ID_PROJECTION
                 )
-                back_button_payload = (
-                    f'/chats{{"s":"{parent_selector}", "i":{page_index}}}'
-                )
-                update_message_metadata(
-                    message_id=callback_query_message_id,
-                    metadata={
-                        "back_button_title": back_button_title,
-                        "back_button_payload": back_button_payload,
-                    },
-                )
-
+                user_id = livechat and livechat.get("user_id")
+            if parent_selector and user_id and callback_query_message_id:
                 json_message = get_livechat_card(
-                    user_id=user_id, message_id=callback_query_message_id
+                    user_id=user_id,
+                    livechat=livechat,
+                    navigation={"p": parent_selector, "b": back_page_index},
                 )
             else:
                 json_message = get_menu_message()
@@ -8,18 +8,19 @@ from rasa_sdk.executor import CollectingDispatcher
 from actions.utils.date import SERVER_TZINFO
 from actions.utils.json import get_json_key
 from actions.utils.livechat import (
-    get_livechat,
+    LIVECHAT_NOT_FOUND_TEXT,
+    get_card_livechat_async,
+    get_card_livechat_ids,
     post_livechat_message,
-    update_livechat,
+    update_livechat_async,
 )
-from actions.utils.message_metadata import get_message_metadata
 
 
 class ActionLivechatReply(Action):
     def name(self) -> Text:
         return "action_livechat_reply"
 
-    def run(
+    async def run(
         self,
         dispatcher: CollectingDispatcher,
         tracker: Tracker,
@@ -30,9 +31,21 @@ class ActionLivechatReply(Action):
         message_text = get_json_key(metadata, "message.text")
         reply_to_message = get_json_key(metadata, "message.reply_to_message")
         reply_to_message_id = reply_to_message.get("message_id")
-        message_metadata = get_message_metadata(reply_to_message_id) or {}
-        livechat = get_livechat(id=message_metadata.get("livechat_id"))
+        # the buttons of the card being replied to carry its livechat id; a
+        # message naming several livechats is not a card
+        livechat_ids = get_card_livechat_ids(reply_to_message)
+        livechat = (
+            await get_card_livechat_async(
+                [{"entity": "c", "value": c} for c in livechat_ids],
+                reply_to_message_id,
+            )
+            if len(livechat_ids) <= 1
+            else {}
+        )
         user_id = livechat.get("user_id")
+        if not user_id:
+            dispatcher.utter_message(json_message={"text": LIVECHAT_NOT_FOUND_TEXT})
+            return []
 
         bot_message = {
             "id": uuid4(),
@@ -41,7 +54,7 @@ class ActionLivechatReply(Action):
             "sender_type": "admin",
             "sent_ts": datetime.now(tz=SERVER_TZINFO).timestamp(),
         }
-        update_livechat(user_id, message=bot_message, enabled=True)
+        await update_livechat_async(user_id, message=bot_message, enabled=True)
 
         post_livechat_message(user_id, message_text=message_text)
 
@@ -1,5 +1,3 @@
-from collections import Counter
-from copy import deepcopy
 from typing import Any, Text, Dict, List
 
 from rasa_sdk import Action, Tracker
@@ -9,7 +7,7 @@ from actions.utils.admin_config import get_admin_group_id
 from actions.utils.date import to_readable_duration
 from actions.utils.entity import get_entity
 from actions.utils.json import get_json_key
-from actions.utils.livechat import get_livechat_stats
+from actions.utils.livechat_stats import get_livechat_stats_for_windows
 from actions.utils.menu import (
     DATE_SELECTOR_ALL_TIME,
     DATE_SELECTOR_DISPLAY_NAME,
@@ -25,7 +23,8 @@ from actions.utils.menu import (
 
 
 def diff_livechat_stats(livechat_stats, previous_livechat_stats):
-    out_stats = deepcopy(livechat_stats)
+    # livechat_stats is built per request, so the diffs are added in place
+    out_stats = livechat_stats
 
     def compute_diffs(source, previous_source, source_key):
         for key, value in source.items():
@@ -63,16 +62,17 @@ def get_stats(lifecycle_selector, date_selector):
         date_selector
     )
 
-    livechat_stats = get_livechat_stats(
-        lifecycle_stage=lifecycle_stage, from_ts=current_from_ts, to_ts=current_to_ts
+    windows = {"current": (current_from_ts, current_to_ts)}
+    if date_selector != DATE_SELECTOR_ALL_TIME:
+        windows["previous"] = (previous_from_ts, previous_to_ts)
+    windows_livechat_stats = get_livechat_stats_for_windows(
+        lifecycle_stage=lifecycle_stage, windows=windows
     )
+    livechat_stats = windows_livechat_stats["current"]
     if date_selector != DATE_SELECTOR_ALL_TIME:
-        previous_livechat_stats = get_livechat_stats(
-            lifecycle_stage=lifecycle_stage,
-            from_ts=previous_from_ts,
-            to_ts=previous_to_ts,
+        livechat_stats = diff_livechat_stats(
+            livechat_stats, windows_livechat_stats["previous"]
         )
-        livechat_stats = diff_livechat_stats(livechat_stats, previous_livechat_stats)
 
     text = ""
 
@@ -121,12 +121,11 @@ def get_stats(lifecycle_selector, date_selector):
             value = round(value, 2)
         return f"{title}: {value}{diff_str}\n"
 
-    def print_most_common_from_list(input_list, n, title):
-        total = len(input_list)
+    def print_most_common_from_list(histogram, n, title):
+        total = histogram.get("total", 0)
         if not total:
             return ""
-        c = Counter(input_list)
-        most_common_list = c.most_common(n)
+        most_common_list = histogram.get("top", [])[:n]
         return f"{title}: {', '.join([v[0] + ' (' + str(round((v[1]/total)*100)) + '%)' for v in most_common_list])}\n"
 
     funnel_diff_percents = get_json_key(livechat_stats, "funnel.diff_percents", {})
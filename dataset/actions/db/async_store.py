@@ -0,0 +1,49 @@
+import asyncio
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from typing import Optional, Text
+
+
+class AsyncMongoDataStore:
+    """Stores data in Mongo from code running on an asyncio event loop.
+
+    Queries mirror the ones made through MongoDataStore. The motor client is
+    bound to the event loop it is first used from, so it is created lazily.
+    """
+
+    def __init__(
+        self,
+        host: Optional[Text] = "mongodb://mongo-admin:27017",
+        db: Optional[Text] = "rappo",
+        username: Optional[Text] = None,
+        password: Optional[Text] = None,
+        auth_source: Optional[Text] = "admin",
+    ) -> None:
+        self.host = host
+        self.db_name = db
+        self.username = username
+        self.password = password
+        self.auth_source = auth_source
+
+        self.client: Optional[AsyncIOMotorClient] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def db(self) -> AsyncIOMotorDatabase:
+        loop = asyncio.get_event_loop()
+        if self.client is None or self.loop is not loop:
+            self.client = AsyncIOMotorClient(
+                self.host,
+                username=self.username,
+                password=self.password,
+                authSource=self.auth_source,
+                io_loop=loop,
+            )
+            self.loop = loop
+        return self.client[self.db_name]
+
+
+_async_db_store = AsyncMongoDataStore()
+
+
+def get_async_db() -> AsyncIOMotorDatabase:
+    return _async_db_store.db
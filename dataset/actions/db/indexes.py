@@ -0,0 +1,56 @@
+import logging
+from pymongo import ASCENDING, DESCENDING
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Telegram gives up on an update after a day, widget retries are much shorter
+DEDUP_KEY_TTL = 24 * 60 * 60
+
+
+def ensure_indexes(db: Database):
+    """Creates the indexes the actions rely on; safe to call again at any time.
+
+    Runs at startup and after the collections are dropped by reset_actions_db,
+    since the unique indexes guard against duplicate writes and the TTL
+    indexes keep dedup_key and message_metadata bounded.
+    """
+    # db.livechat only holds the per-user header (user_metadata, flags and counters);
+    # the unbounded history lives in child collections keyed by livechat_id
+    try:
+        db.livechat.create_index("user_id", unique=True)
+    except OperationFailure as e:
+        # databases created before user_id was unique need actions.db.migrate_livechat
+        logger.error(f"Could not create unique livechat user_id index. {e}")
+    # seq is the message's position in its livechat, taken from num_messages;
+    # rows copied before seq existed get one from actions.db.migrate_livechat
+    db.livechat_message.create_index(
+        [("livechat_id", ASCENDING), ("seq", ASCENDING)],
+        unique=True,
+        partialFilterExpression={"seq": {"$exists": True}},
+    )
+    db.livechat_event.create_index(
+        [("livechat_id", ASCENDING), ("session_index", ASCENDING)]
+    )
+    db.livechat_session.create_index(
+        [("livechat_id", ASCENDING), ("index", ASCENDING)], unique=True
+    )
+    db.livechat_session.create_index("start_ts")
+    # set on the sessions of a livechat whose lifecycle stage changed
+    db.livechat_session.create_index("stats_dirty_ts", sparse=True)
+
+    # one row per day x lifecycle_stage; past days are answered from here instead of
+    # re-aggregating the whole session history
+    db.livechat_stats_rollup.create_index(
+        [("day_ts", ASCENDING), ("lifecycle_stage", ASCENDING)], unique=True
+    )
+    db.livechat_stats_rollup.create_index("finalized")
+
+    db.message_metadata.create_index("message_id")
+    db.message_metadata.create_index(
+        [("livechat_id", ASCENDING), ("live_card_ts", DESCENDING)]
+    )
+    db.message_metadata.create_index("expire_at", expireAfterSeconds=0)
+
+    db.dedup_key.create_index("created_at", expireAfterSeconds=DEDUP_KEY_TTL)
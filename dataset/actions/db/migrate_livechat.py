@@ -0,0 +1,159 @@
+"""Moves the embedded livechat history into the per-livechat collections.
+
+Older livechat documents carry their full history in the `messages`, `events`
+and `sessions` arrays. This copies each array into `livechat_message`,
+`livechat_event` and `livechat_session` and replaces it with a counter on the
+livechat header. Rows the current version already wrote for such a livechat
+are renumbered to follow its history. It also numbers messages stored before
+they had a `seq` and replaces the old non-unique `user_id` index with the
+unique one the upsert in `update_livechat` relies on.
+
+Stop the Rasa and action servers before running it: rows written while it
+runs may be numbered twice. An interrupted run can be re-run.
+
+Usage (from the dataset directory):
+    python -m actions.db.migrate_livechat
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
+import logging
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import OperationFailure
+
+from actions.db.indexes import ensure_indexes
+from actions.db.store import db
+
+logger = logging.getLogger(__name__)
+
+# embedded array -> (collection, field numbering its rows within the livechat)
+HISTORY_FIELDS = {
+    "messages": ("livechat_message", "seq"),
+    "events": ("livechat_event", None),
+    "sessions": ("livechat_session", "index"),
+}
+
+
+def backfill_message_seq():
+    # messages stored before seq existed precede every numbered one, which the
+    # num_messages counter numbered after them
+    for livechat_id in db.livechat_message.distinct(
+        "livechat_id", {"seq": {"$exists": False}}
+    ):
+        rows = db.livechat_message.find(
+            {"livechat_id": livechat_id, "seq": {"$exists": False}}, {"_id": 1}
+        ).sort("_id", ASCENDING)
+        db.livechat_message.bulk_write(
+            [
+                UpdateOne({"_id": r["_id"]}, {"$set": {"seq": i}})
+                for i, r in enumerate(rows)
+            ]
+        )
+
+
+def shift_live_rows(livechat_id, collection, field, offset):
+    # highest first, so that no two rows ever share a number; the marker keeps
+    # a re-run from shifting a row twice
+    rows = (
+        db[collection]
+        .find(
+            {
+                "livechat_id": livechat_id,
+                "migrated_index": {"$exists": False},
+                "history_shifted": {"$exists": False},
+            },
+            {field: 1},
+        )
+        .sort(field, DESCENDING)
+    )
+    for row in rows:
+        db[collection].update_one(
+            {"_id": row["_id"], "history_shifted": {"$exists": False}},
+            {"$inc": {field: offset}, "$set": {"history_shifted": True}},
+        )
+
+
+def get_history_requests(livechat_id, rows, field):
+    # keyed on the position in the array, so a re-run does not copy a row twice
+    requests = []
+    for i, row in enumerate(rows):
+        doc = {"livechat_id": livechat_id, **row, "migrated_index": i}
+        if field:
+            doc[field] = i
+        requests.append(
+            UpdateOne(
+                {"livechat_id": livechat_id, "migrated_index": i},
+                {"$setOnInsert": doc},
+                upsert=True,
+            )
+        )
+    return requests
+
+
+def migrate_livechat(livechat):
+    livechat_id = livechat.get("_id")
+    history = {f: livechat.get(f) or [] for f in HISTORY_FIELDS.keys()}
+
+    # the history comes first, so rows already written move behind it
+    num_sessions = len(history["sessions"])
+    if history["messages"]:
+        shift_live_rows(
+            livechat_id, "livechat_message", "seq", len(history["messages"])
+        )
+    if num_sessions:
+        shift_live_rows(livechat_id, "livechat_session", "index", num_sessions)
+        shift_live_rows(livechat_id, "livechat_event", "session_index", num_sessions)
+
+    for f, (collection, field) in HISTORY_FIELDS.items():
+        if history[f]:
+            db[collection].bulk_write(
+                get_history_requests(livechat_id, history[f], field), ordered=False
+            )
+
+    db.livechat.update_one(
+        {"_id": livechat_id},
+        {
+            # $max never lowers a counter below the rows it has handed out
+            "$max": {
+                f"num_{f}": db[collection].count_documents({"livechat_id": livechat_id})
+                for f, (collection, _) in HISTORY_FIELDS.items()
+            },
+            "$unset": {f: "" for f in HISTORY_FIELDS.keys()},
+        },
+    )
+    for collection, _ in HISTORY_FIELDS.values():
+        db[collection].update_many(
+            {"livechat_id": livechat_id, "history_shifted": {"$exists": True}},
+            {"$unset": {"history_shifted": ""}},
+        )
+
+
+def migrate_livechats():
+    query = {"$or": [{f: {"$exists": True}} for f in HISTORY_FIELDS.keys()]}
+    num_migrated = 0
+    for livechat in db.livechat.find(query):
+        migrate_livechat(livechat)
+        num_migrated += 1
+    return num_migrated
+
+
+def ensure_unique_user_id_index():
+    user_id_index = db.livechat.index_information().get("user_id_1", {})
+    if user_id_index.get("unique"):
+        return
+    if user_id_index:
+        db.livechat.drop_index("user_id_1")
+    try:
+        db.livechat.create_index("user_id", unique=True)
+    except OperationFailure as e:
+        # duplicate user_id documents have to be merged by hand before this succeeds
+        logger.error(f"Could not create unique livechat user_id index. {e}")
+        db.livechat.create_index("user_id")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    backfill_message_seq()
+    logger.info(f"Migrated {migrate_livechats()} livechat documents.")
+    ensure_unique_user_id_index()
+    ensure_indexes(db)
@@ -1,6 +1,8 @@
 from pymongo.database import Database
 from typing import Optional, Text
 
+from actions.db.indexes import ensure_indexes
+
 
 class MongoDataStore:
     """Stores data in Mongo.
@@ -32,8 +34,11 @@ class MongoDataStore:
 _db_store = MongoDataStore()
 
 db = _db_store.db
+ensure_indexes(db)
 
 
 def reset_actions_db():
     for c in db.list_collection_names():
         db.drop_collection(c)
+    # dropping a collection drops its indexes too
+    ensure_indexes(db)
@@ -1,22 +1,125 @@
-from typing import List, Text
+import logging
+import threading
+import time
+from typing import Dict, List, Text
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
 
+from actions.db.async_store import get_async_db
 from actions.db.store import db
 from actions.utils.debug import is_debug_env
 
+logger = logging.getLogger(__name__)
+
 ADMIN_CONFID_OBJECT_ID = "000000000000000000000001"
 
+# the config is read on almost every request, so it is served from memory and
+# kept current by a change stream, or by polling where the deployment has no
+# change streams; the TTL only applies while neither is running
+ADMIN_CONFIG_TTL = 60
+ADMIN_CONFIG_POLL_INTERVAL = 5
+
+admin_config_cache = {"config": None, "loaded_ts": 0.0}
+admin_config_lock = threading.Lock()
+admin_config_watcher = None
+
+
+def cache_admin_config(admin_config: Dict):
+    with admin_config_lock:
+        admin_config_cache["config"] = admin_config
+        admin_config_cache["loaded_ts"] = time.monotonic()
+
+
+def invalidate_admin_config():
+    with admin_config_lock:
+        admin_config_cache["config"] = None
+
+
+def load_admin_config():
+    # creates the document on first use in the same round trip as the read
+    admin_config = db.admin_config.find_one_and_update(
+        {"_id": ObjectId(ADMIN_CONFID_OBJECT_ID)},
+        {"$setOnInsert": {"super_admins": [], "admin_group_id": ""}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    cache_admin_config(admin_config)
+    return admin_config
+
+
+async def load_admin_config_async():
+    admin_config = await get_async_db().admin_config.find_one_and_update(
+        {"_id": ObjectId(ADMIN_CONFID_OBJECT_ID)},
+        {"$setOnInsert": {"super_admins": [], "admin_group_id": ""}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    cache_admin_config(admin_config)
+    return admin_config
+
 
-def lazy_init():
-    admin_config = db.admin_config.find_one({"_id": ObjectId(ADMIN_CONFID_OBJECT_ID)})
-    if not admin_config:
-        db.admin_config.insert_one(
-            {
-                "_id": ObjectId(ADMIN_CONFID_OBJECT_ID),
-                "super_admins": [],
-                "admin_group_id": "",
-            },
+def watch_admin_config():
+    while True:
+        try:
+            with db.admin_config.watch(
+                [{"$match": {"documentKey._id": ObjectId(ADMIN_CONFID_OBJECT_ID)}}],
+                full_document="updateLookup",
+            ) as stream:
+                # pick up anything written before the stream was opened
+                load_admin_config()
+                for change in stream:
+                    if change.get("fullDocument"):
+                        cache_admin_config(change.get("fullDocument"))
+                    else:
+                        load_admin_config()
+        except OperationFailure as e:
+            # standalone servers have no change streams
+            logger.info(f"Polling admin config, change stream unavailable. {e}")
+            break
+        except PyMongoError as e:
+            logger.error(f"Admin config change stream failed. {e}")
+            time.sleep(ADMIN_CONFIG_POLL_INTERVAL)
+
+    while True:
+        try:
+            load_admin_config()
+        except PyMongoError as e:
+            logger.error(f"Could not load admin config. {e}")
+        time.sleep(ADMIN_CONFIG_POLL_INTERVAL)
+
+
+def start_admin_config_watcher():
+    global admin_config_watcher
+    with admin_config_lock:
+        if admin_config_watcher and admin_config_watcher.is_alive():
+            return
+        admin_config_watcher = threading.Thread(
+            target=watch_admin_config, name="admin_config_watcher", daemon=True
         )
+        admin_config_watcher.start()
+
+
+def is_admin_config_cached() -> bool:
+    is_watching = admin_config_watcher and admin_config_watcher.is_alive()
+    if not is_watching:
+        start_admin_config_watcher()
+    return admin_config_cache["config"] is not None and (
+        is_watching
+        or time.monotonic() - admin_config_cache["loaded_ts"] <= ADMIN_CONFIG_TTL
+    )
+
+
+def get_admin_config() -> Dict:
+    if is_admin_config_cached():
+        return admin_config_cache["config"]
+    return load_admin_config()
+
+
+async def get_admin_config_async() -> Dict:
+    if is_admin_config_cached():
+        return admin_config_cache["config"]
+    return await load_admin_config_async()
 
 
 def is_super_admin(chat_id: Text):
@@ -29,23 +132,27 @@ def is_admin_group(chat_id: Text):
     return get_admin_group_id() == chat_id
 
 
-def get_super_admins():
-    lazy_init()
-    return db.admin_config.find_one({"_id": ObjectId(ADMIN_CONFID_OBJECT_ID)}).get(
-        "super_admins"
-    )
+def get_super_admins() -> List:
+    return get_admin_config().get("super_admins")
 
 
 def get_admin_group_id():
-    lazy_init()
-    return db.admin_config.find_one({"_id": ObjectId(ADMIN_CONFID_OBJECT_ID)}).get(
-        "admin_group_id"
-    )
+    return get_admin_config().get("admin_group_id")
+
+
+async def get_admin_group_id_async():
+    return (await get_admin_config_async()).get("admin_group_id")
 
 
 def set_admin_group_id(group_id):
-    lazy_init()
-    db.admin_config.update_one(
+    admin_config = db.admin_config.find_one_and_update(
         {"_id": ObjectId(ADMIN_CONFID_OBJECT_ID)},
-        {"$set": {"admin_group_id": group_id}},
+        {
+            "$set": {"admin_group_id": group_id},
+            "$setOnInsert": {"super_admins": []},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
     )
+    # other processes pick the change up through their watcher
+    cache_admin_config(admin_config)
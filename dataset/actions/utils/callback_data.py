@@ -0,0 +1,151 @@
+import base64
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Text, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects inline buttons with more callback data than this many bytes
+CALLBACK_DATA_MAX_LENGTH = 64
+# marks encoded callback data; plain payloads start with "/"
+CALLBACK_DATA_PREFIX = "~"
+# encoded as their index, so only ever append to this list
+CALLBACK_DATA_COMMANDS = ["chats", "export", "quick", "refresh", "stats", "tag"]
+
+# same syntax Rasa parses for `/intent{"entity": value}` messages
+PAYLOAD_PATTERN = re.compile(r"^/(\w+)(\{.*\})?$", re.DOTALL)
+OBJECT_ID_PATTERN = re.compile(r"^[0-9a-f]{24}$")
+
+VALUE_TYPE_INT = ord("i")
+VALUE_TYPE_OBJECT_ID = ord("o")
+VALUE_TYPE_TEXT = ord("s")
+
+
+def parse_payload(payload: Text) -> Optional[Tuple[Text, Dict[Text, Any]]]:
+    match = PAYLOAD_PATTERN.match(payload or "")
+    if not match:
+        return None
+    command, entities_json = match.groups()
+    entities = {}
+    if entities_json:
+        try:
+            entities = json.loads(entities_json)
+        except ValueError:
+            return None
+        if not isinstance(entities, dict):
+            return None
+    return command, entities
+
+
+def format_payload(command: Text, entities: Dict[Text, Any]) -> Text:
+    if not entities:
+        return f"/{command}"
+    return f"/{command}{json.dumps(entities, separators=(',', ':'))}"
+
+
+def get_payload_entities(payload: Text) -> List[Dict[Text, Any]]:
+    parsed = parse_payload(payload)
+    if not parsed:
+        return []
+    return [{"entity": k, "value": v} for k, v in parsed[1].items()]
+
+
+def add_payload_entities(payload: Text, entities: Dict[Text, Any]) -> Text:
+    parsed = parse_payload(payload)
+    if not parsed or not entities:
+        return payload
+    command, payload_entities = parsed
+    return format_payload(command, {**payload_entities, **entities})
+
+
+def encode_varint(value: int) -> bytes:
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def decode_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def encode_entity(key: Text, value: Any) -> Optional[bytes]:
+    if len(key) != 1 or not key.isascii():
+        return None
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return bytes([ord(key), VALUE_TYPE_INT]) + encode_varint(value)
+    if isinstance(value, str) and OBJECT_ID_PATTERN.match(value):
+        return bytes([ord(key), VALUE_TYPE_OBJECT_ID]) + bytes.fromhex(value)
+    if isinstance(value, str):
+        text = value.encode("utf-8")
+        if len(text) < 256:
+            return bytes([ord(key), VALUE_TYPE_TEXT, len(text)]) + text
+    return None
+
+
+def encode_callback_data(payload: Optional[Text]) -> Optional[Text]:
+    """Packs a `/command{json}` payload into Telegram's 64 byte callback data.
+
+    The command is stored as an index into CALLBACK_DATA_COMMANDS and each entity
+    as a one byte key followed by a varint, 12 byte ObjectId or short string.
+    Payloads that cannot be packed are returned as they are.
+    """
+    parsed = parse_payload(payload)
+    if parsed and parsed[0] in CALLBACK_DATA_COMMANDS:
+        command, entities = parsed
+        data = bytearray([CALLBACK_DATA_COMMANDS.index(command)])
+        for key, value in entities.items():
+            entity = encode_entity(key, value)
+            if entity is None:
+                break
+            data += entity
+        else:
+            encoded = base64.urlsafe_b64encode(bytes(data)).decode("ascii")
+            payload = CALLBACK_DATA_PREFIX + encoded.rstrip("=")
+
+    if payload and len(payload.encode("utf-8")) > CALLBACK_DATA_MAX_LENGTH:
+        logger.warning(f"Callback data is longer than Telegram allows: {payload}")
+    return payload
+
+
+def decode_callback_data(callback_data: Optional[Text]) -> Optional[Text]:
+    """Returns the `/command{json}` payload packed by encode_callback_data."""
+    if not callback_data or not callback_data.startswith(CALLBACK_DATA_PREFIX):
+        return callback_data
+    try:
+        encoded = callback_data[len(CALLBACK_DATA_PREFIX) :]
+        data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        command = CALLBACK_DATA_COMMANDS[data[0]]
+        entities = {}
+        offset = 1
+        while offset < len(data):
+            key, value_type = chr(data[offset]), data[offset + 1]
+            offset += 2
+            if value_type == VALUE_TYPE_INT:
+                entities[key], offset = decode_varint(data, offset)
+            elif value_type == VALUE_TYPE_OBJECT_ID:
+                entities[key] = data[offset : offset + 12].hex()
+                offset += 12
+            elif value_type == VALUE_TYPE_TEXT:
+                length = data[offset]
+                entities[key] = data[offset + 1 : offset + 1 + length].decode("utf-8")
+                offset += 1 + length
+            else:
+                raise ValueError(f"unknown value type {value_type}")
+        return format_payload(command, entities)
+    except (ValueError, IndexError) as e:
+        logger.error(f"Could not decode callback data {callback_data}. {e}")
+        return callback_data
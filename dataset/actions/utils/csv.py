@@ -1,2 +1,32 @@
+import gzip
+import os
+import tempfile
+from typing import Iterable, Text
+
+# exports are spooled here by the action server and uploaded from here by the connector
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "landerbot-exports")
+
+
 def format_csv_entry(e):
     return str(e or "").replace(",", " ").replace("\n", " ").replace("\t", " ")
+
+
+def write_csv_file(lines: Iterable[Text], compress: bool = False) -> Text:
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(
+        suffix=".csv.gz" if compress else ".csv", dir=EXPORT_DIR
+    )
+    os.close(fd)
+
+    # lines are written one at a time so memory does not grow with the row count
+    open_file = gzip.open if compress else open
+    with open_file(path, "wt", encoding="utf-8") as f:
+        for line in lines:
+            f.write(line + "\n")
+
+    return path
+
+
+def is_export_file(path: Text) -> bool:
+    export_dir = os.path.realpath(EXPORT_DIR)
+    return os.path.realpath(path).startswith(export_dir + os.sep)
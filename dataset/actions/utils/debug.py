@@ -1,5 +1,5 @@
-import os
+from actions.utils.settings import get_settings
 
 
 def is_debug_env():
-    return os.environ["RAPPO_ENV"] == "debug"
+    return get_settings().rappo_env == "debug"
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from datetime import datetime
+import logging
+from pymongo.errors import BulkWriteError, PyMongoError
+from typing import Any, Dict, List, Text
+
+from actions.db.async_store import get_async_db
+from actions.utils.date import SERVER_TZINFO
+
+logger = logging.getLogger(__name__)
+
+DEDUP_KEY_CACHE_SIZE = 10000
+# mongo reports duplicate _ids with this write error code
+DUPLICATE_KEY_ERROR = 11000
+
+# keys claimed or seen by this process, most recent last
+dedup_key_cache = OrderedDict()
+dedup_counters = {"claimed": 0, "cache_hits": 0, "duplicates": 0, "errors": 0}
+
+
+def remember_dedup_key(key: Text):
+    dedup_key_cache[key] = True
+    dedup_key_cache.move_to_end(key)
+    while len(dedup_key_cache) > DEDUP_KEY_CACHE_SIZE:
+        dedup_key_cache.popitem(last=False)
+
+
+async def claim_dedup_keys_async(keys: List[Text]) -> List[bool]:
+    """Returns for each key whether this is the first time it is claimed.
+
+    Repeats within this process are answered from memory; the dedup_key
+    collection catches repeats delivered to other processes. If mongo cannot
+    be reached the keys are treated as new, so nothing is dropped.
+    """
+    claimed = [key not in dedup_key_cache for key in keys]
+    for key in keys:
+        if key in dedup_key_cache:
+            dedup_key_cache.move_to_end(key)
+            dedup_counters["cache_hits"] += 1
+
+    new_indexes = [i for i, is_new in enumerate(claimed) if is_new]
+    if new_indexes:
+        now = datetime.now(tz=SERVER_TZINFO)
+        try:
+            await get_async_db().dedup_key.insert_many(
+                [{"_id": keys[i], "created_at": now} for i in new_indexes],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                index = new_indexes[write_error["index"]]
+                if write_error.get("code") == DUPLICATE_KEY_ERROR:
+                    claimed[index] = False
+                    dedup_counters["duplicates"] += 1
+                else:
+                    dedup_counters["errors"] += 1
+        except PyMongoError as e:
+            logger.error(f"Could not store dedup keys. {e}")
+            dedup_counters["errors"] += 1
+
+    for i in new_indexes:
+        remember_dedup_key(keys[i])
+        if claimed[i]:
+            dedup_counters["claimed"] += 1
+    return claimed
+
+
+async def claim_dedup_key_async(key: Text) -> bool:
+    return (await claim_dedup_keys_async([key]))[0]
+
+
+async def release_dedup_keys_async(keys: List[Text]):
+    # lets a retry through after the first attempt failed
+    if not keys:
+        return
+    for key in keys:
+        dedup_key_cache.pop(key, None)
+    try:
+        await get_async_db().dedup_key.delete_many({"_id": {"$in": keys}})
+    except PyMongoError as e:
+        logger.error(f"Could not release dedup keys. {e}")
+
+
+async def release_dedup_key_async(key: Text):
+    await release_dedup_keys_async([key])
+
+
+def get_dedup_stats() -> Dict[Text, Any]:
+    return {"cached_keys": len(dedup_key_cache), **dedup_counters}
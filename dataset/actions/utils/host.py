@@ -1,22 +1,11 @@
-import logging
-import os
-from ruamel import yaml
-from typing import Dict, Optional, Text
+from typing import Optional, Text
 
-logger = logging.getLogger(__name__)
+from actions.utils.settings import get_settings
 
 
 def get_host_url(path: Optional[Text] = ""):
-    with open("credentials.yml", "r") as stream:
-        try:
-            credentials: Dict = yaml.safe_load(stream)
-            telegram_credentials: Dict = credentials.get(
-                "connectors.telegram.TelegramInput", {}
-            )
-            return telegram_credentials.get("host_url", "") + path
-        except Exception as exc:
-            logger.error(exc)
+    return get_settings().host_url + path
 
 
 def get_livechat_client_url(path: Optional[Text] = ""):
-    return os.environ["LIVECHAT_CLIENT_BASE_URL"] + path
+    return get_settings().livechat_client_base_url + path
@@ -1,36 +1,181 @@
+import asyncio
 from bson.objectid import ObjectId
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timedelta
+from functools import partial
 import logging
-from pymongo import DESCENDING
-import requests
-from typing import Dict
-
+import threading
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    InsertOne,
+    ReturnDocument,
+    UpdateMany,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from actions.db.async_store import get_async_db
 from actions.db.store import db
 
 from actions.utils.date import SERVER_TZINFO
-from actions.utils.host import get_livechat_client_url
-from actions.utils.message_metadata import get_message_metadata
+from actions.utils.json import get_json_key
+from actions.utils.callback_data import (
+    add_payload_entities,
+    decode_callback_data,
+    parse_payload,
+)
+from actions.utils.entity import get_entity
+from actions.utils.livechat_client import livechat_client
+from actions.utils.livechat_transcript import (
+    TELEGRAM_MESSAGE_MAX_LENGTH,
+    get_text_length,
+    get_transcript,
+    get_transcript_page,
+)
+from actions.utils.menu import get_chats_back_button
+from actions.utils.message_metadata import (
+    get_live_card_metadata,
+    get_message_metadata_async,
+)
 from actions.utils.name import random_animal_name
 
 logger = logging.getLogger(__name__)
 
-db.livechat.create_index("user_id")
-db.livechat.create_index("sessions.start_ts")
+# a visitor's live card is edited in place while it is recent enough to be seen;
+# the updates within the debounce window reach Telegram as a single edit
+LIVECHAT_LIVE_CARD_TTL = 15 * 60
+LIVECHAT_LIVE_CARD_DEBOUNCE = 2.0
+# sent back when a card's livechat no longer exists, e.g. after /resetdb
+LIVECHAT_NOT_FOUND_TEXT = "This chat could not be found. It may have been deleted."
+# the commands of a card's own buttons; other buttons, like the rows of a /chats
+# list, may name other livechats
+LIVECHAT_CARD_COMMANDS = ["refresh", "quick", "tag"]
+
+# rendered transcript cards, keyed by (livechat_id, notification_type, page_index);
+# an entry is valid while the livechat `version` it was rendered from is current
+LIVECHAT_CARD_CACHE_SIZE = 256
+livechat_card_cache = OrderedDict()
+# cards are rendered from several threads; the lock only covers cache reads and
+# writes, rendering itself runs unlocked
+livechat_card_lock = threading.Lock()
+# renders cards with pymongo off the event loop
+livechat_card_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="livechat_card"
+)
+
+# projections for the livechat read paths; callers pick the one with the fields they use
+LIVECHAT_ID_PROJECTION = {"user_id": 1, "version": 1}
+LIVECHAT_ENABLED_PROJECTION = {"enabled": 1}
+LIVECHAT_LIST_ROW_PROJECTION = {"user_id": 1, "user_metadata.user_name": 1}
+LIVECHAT_CARD_HEADER_PROJECTION = {
+    "user_id": 1,
+    "online": 1,
+    "visible": 1,
+    "enabled": 1,
+    "version": 1,
+    "num_sessions": 1,
+    "num_messages": 1,
+    "user_metadata.user_name": 1,
+    "user_metadata.lifecycle_stage": 1,
+    "user_metadata.browser_data.browserName": 1,
+    "user_metadata.browser_data.fullVersion": 1,
+    "user_metadata.wurfl_data.form_factor": 1,
+    "user_metadata.wurfl_data.complete_device_name": 1,
+    "user_metadata.location_data.city": 1,
+    "user_metadata.location_data.country": 1,
+    "user_metadata.referrer_data.referrer": 1,
+}
+LIVECHAT_EXPORT_ROW_PROJECTION = {
+    "creation_ts": 1,
+    "last_update_ts": 1,
+    "user_id": 1,
+    "num_sessions": 1,
+    "user_metadata.user_name": 1,
+    "user_metadata.user_email": 1,
+    "user_metadata.lifecycle_stage": 1,
+    "user_metadata.browser_data.browserName": 1,
+    "user_metadata.browser_data.fullVersion": 1,
+    "user_metadata.wurfl_data.form_factor": 1,
+    "user_metadata.wurfl_data.complete_device_name": 1,
+    "user_metadata.location_data.city": 1,
+    "user_metadata.location_data.country": 1,
+    "user_metadata.referrer_data.referrer": 1,
+}
+LIVECHAT_MESSAGE_TRANSCRIPT_PROJECTION = {"sender_type": 1, "text": 1, "seq": 1}
+LIVECHAT_COUNTERS_PROJECTION = {"num_sessions": 1, "num_messages": 1}
+
+# bulk write requests for the child writes of get_livechat_child_writes
+LIVECHAT_WRITE_REQUESTS = {
+    "insert_one": InsertOne,
+    "update_one": UpdateOne,
+    "update_many": UpdateMany,
+}
+
+
+def get_livechat_query(id=None, user_id=None):
+    query = {}
+    if id:
+        query.update({"_id": ObjectId(id)})
+    if user_id:
+        query.update({"user_id": user_id})
+    return query
 
 
 def get_livechat(
     id=None,
     user_id=None,
+    projection=None,
 ):
-    query = {}
-    if id:
-        query.update({"_id": ObjectId(id)})
-    if user_id:
-        query.update({"user_id": user_id})
-    return db.livechat.find_one(query)
+    return db.livechat.find_one(get_livechat_query(id, user_id), projection)
 
 
-def get_livechats(
+async def get_livechat_async(
+    id=None,
+    user_id=None,
+    projection=None,
+):
+    return await get_async_db().livechat.find_one(
+        get_livechat_query(id, user_id), projection
+    )
+
+
+def get_livechat_messages(
+    livechat_id,
+    projection=LIVECHAT_MESSAGE_TRANSCRIPT_PROJECTION,
+    from_seq=0,
+):
+    query = {"livechat_id": livechat_id}
+    if from_seq:
+        query["seq"] = {"$gte": from_seq}
+    return db.livechat_message.find(query, projection).sort("seq", ASCENDING)
+
+
+def get_latest_livechat_message(
+    livechat_id,
+    sender_type=None,
+    projection=LIVECHAT_MESSAGE_TRANSCRIPT_PROJECTION,
+):
+    query = {"livechat_id": livechat_id}
+    if sender_type:
+        query.update({"sender_type": sender_type})
+    return db.livechat_message.find_one(query, projection, sort=[("seq", DESCENDING)])
+
+
+def get_livechat_ids_with_sessions(from_ts=None, to_ts=None):
+    ts_query = {}
+    if from_ts:
+        ts_query.update({"$gte": from_ts})
+    if to_ts:
+        ts_query.update({"$lt": to_ts})
+    return db.livechat_session.distinct("livechat_id", {"start_ts": ts_query})
+
+
+def get_livechats_query(
     enabled=None,
     online=None,
     visible=None,
@@ -47,306 +192,208 @@ def get_livechats(
         query.update({"visible": visible})
     if lifecycle_stage:
         query.update({"user_metadata.lifecycle_stage": lifecycle_stage})
+    if from_ts or to_ts:
+        query.update({"_id": {"$in": get_livechat_ids_with_sessions(from_ts, to_ts)}})
+    return query
 
-    ts_query = {}
-    if from_ts:
-        ts_query.update({"$gte": from_ts})
-    if to_ts:
-        ts_query.update({"$lt": to_ts})
-    if ts_query:
-        query.update({"sessions": {"$elemMatch": {"start_ts": ts_query}}})
 
-    return db.livechat.find(query).sort("_id", DESCENDING)
+def get_livechats(
+    enabled=None,
+    online=None,
+    visible=None,
+    lifecycle_stage=None,
+    from_ts=None,
+    to_ts=None,
+    projection=None,
+    skip=0,
+    limit=0,
+    query=None,
+):
+    if query is None:
+        query = get_livechats_query(
+            enabled, online, visible, lifecycle_stage, from_ts, to_ts
+        )
+    return (
+        db.livechat.find(query, projection)
+        .sort("_id", DESCENDING)
+        .skip(skip)
+        .limit(limit)
+    )
 
 
-def get_livechat_stats(
+def count_livechats(
+    enabled=None,
+    online=None,
+    visible=None,
     lifecycle_stage=None,
     from_ts=None,
     to_ts=None,
+    query=None,
 ):
-    pipeline = []
+    if query is None:
+        query = get_livechats_query(
+            enabled, online, visible, lifecycle_stage, from_ts, to_ts
+        )
+    return db.livechat.count_documents(query)
 
-    # filter documents that do not match the lifecycle_stage
-    if lifecycle_stage:
-        pipeline.append({"$match": {"user_metadata.lifecycle_stage": lifecycle_stage}})
 
-    # remove sessions that don't fit the date criteria; also remove active sessions (duration is not set)
-    sessions_cond_query = []
-    sessions_cond_query.append({"$gt": ["$$session.duration_ts", 0]})
-    if from_ts:
-        sessions_cond_query.append({"$gte": ["$$session.start_ts", from_ts]})
-    if to_ts:
-        sessions_cond_query.append({"$lt": ["$$session.start_ts", to_ts]})
-    sessions_project_query = {
-        "$filter": {
-            "input": "$sessions",
-            "as": "session",
-            "cond": {"$and": sessions_cond_query},
-        }
+def get_livechat_insert_defaults(now_ts, set_data: Dict, inc_data: Dict):
+    # defaults for a new livechat; paths written by $set / $inc must not be repeated here
+    return {
+        k: v
+        for k, v in {
+            "creation_ts": now_ts,
+            "user_metadata.user_name": random_animal_name(),
+            "user_metadata.lifecycle_stage": "subscriber",
+            "enabled": False,
+            "online": False,
+            "visible": False,
+            "num_sessions": 0,
+            "num_messages": 0,
+            "num_events": 0,
+        }.items()
+        if k not in set_data and k not in inc_data
     }
-    pipeline.append(
-        {
-            "$project": {
-                "user_id": 1,
-                "events": 1,
-                "user_metadata": 1,
-                "sessions": sessions_project_query,
-            }
-        }
-    )
-    # filter documents with at least one session that matches the session criteria (see above)
-    pipeline.append({"$match": {"$expr": {"$gt": [{"$size": "$sessions"}, 0]}}})
-
-    # compute the valid session indexes for each document (used next to filter events)
-    pipeline.append(
-        {
-            "$group": {
-                "_id": "$_id",
-                "user_id": {"$first": "$user_id"},
-                "events": {"$first": "$events"},
-                "user_metadata": {"$first": "$user_metadata"},
-                "sessions": {"$first": "$sessions"},
-                "valid_session_indexes": {"$first": "$sessions.index"},
-            }
-        }
-    )
 
-    # remove events that are not in a valid session; also remove other unnecessary events to make computations easier downstream
-    pipeline.append(
-        {
-            "$project": {
-                "user_id": 1,
-                "events": {
-                    "$filter": {
-                        "input": "$events",
-                        "as": "event",
-                        "cond": {
-                            "$and": [
-                                {
-                                    "$in": [
-                                        "$$event.session_index",
-                                        "$valid_session_indexes",
-                                    ]
-                                },
-                                {
-                                    "$or": [
-                                        {"$ne": ["$$event.label", "/livechat_visible"]},
-                                        {"$eq": ["$$event.metadata.visible", True]},
-                                    ]
-                                },
-                                {
-                                    "$or": [
-                                        {"$ne": ["$$event.label", "enable_livechat"]},
-                                        {"$eq": ["$$event.value", True]},
-                                    ]
-                                },
-                            ],
-                        },
-                    }
-                },
-                "user_metadata": 1,
-                "sessions": 1,
-            }
-        }
-    )
 
-    # compute aggregate stats
-    pipeline.append(
-        {
-            "$group": {
-                "_id": None,
-                "total_users": {"$sum": 1},
-                "new_users": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": [0, "$sessions.index"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "returning_users": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": [0, "$sessions.index"]},
-                            0,
-                            1,
-                        ]
-                    }
-                },
-                "widget_open": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["/livechat_visible", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "pricing": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["/pricing", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "features": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["/features", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "installation": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["/installation", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "about": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["/about", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "contact": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["/contact", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "live_chat_enabled": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["enable_livechat", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "subscribe": {
-                    "$sum": {
-                        "$cond": [
-                            {"$in": ["/subscribe", "$events.label"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "qualified_lead": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$user_metadata.lifecycle_stage", "lead"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "unqualified": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$user_metadata.lifecycle_stage", "unqualified"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "untagged": {
-                    "$sum": {
-                        "$cond": [
-                            {"$eq": ["$user_metadata.lifecycle_stage", "subscriber"]},
-                            1,
-                            0,
-                        ]
-                    }
-                },
-                "total_session_duration": {
-                    "$sum": {
-                        "$reduce": {
-                            "input": "$sessions.duration_ts",
-                            "initialValue": 0,
-                            "in": {"$sum": ["$$value", "$$this"]},
-                        }
-                    }
-                },
-                "total_sessions": {"$sum": {"$size": "$sessions"}},
-                "sessions_per_user": {"$avg": {"$size": "$sessions"}},
-                "cities": {"$push": "$user_metadata.location_data.city"},
-                "countries": {"$push": "$user_metadata.location_data.country"},
-                "form_factors": {"$push": "$user_metadata.wurfl_data.form_factor"},
-                "devices": {"$push": "$user_metadata.wurfl_data.complete_device_name"},
-                "browsers": {"$push": "$user_metadata.browser_data.browserName"},
-                "referrers": {"$push": "$user_metadata.referrer_data.referrer"},
+def get_livechat_update(
+    now_ts,
+    user_metadata: Dict = None,
+    message: Dict = None,
+    event: Dict = None,
+    enabled=None,
+    online=None,
+    visible=None,
+):
+    """Returns the header update, the counter increments and the events of an update."""
+    events = [event] if event else []
+    if enabled is not None:
+        events.append(
+            {
+                "category": "user",
+                "action": "update_livechat",
+                "label": "enable_livechat",
+                "value": enabled,
+                "ts": now_ts,
             }
-        }
-    )
+        )
 
-    livechat_stats = {}
-    aggregation_result = db.livechat.aggregate(pipeline)
-    for r in aggregation_result:
-        livechat_stats = r
+    set_data = {"last_update_ts": now_ts}
+    # every header change bumps the version the rendered cards are cached against
+    inc_data = {"version": 1}
+
+    if enabled is not None:
+        set_data.update({"enabled": enabled})
+    if online is not None:
+        set_data.update({"online": online})
+        if online:
+            inc_data.update({"num_sessions": 1})
+    if visible is not None:
+        set_data.update({"visible": visible})
+    if user_metadata:
+        # merge on the server with dotted paths instead of a read-modify-write
+        set_data.update({f"user_metadata.{k}": v for k, v in user_metadata.items()})
+    if message:
+        inc_data.update({"num_messages": 1})
+    if events:
+        inc_data.update({"num_events": len(events)})
+
+    set_on_insert_data = get_livechat_insert_defaults(now_ts, set_data, inc_data)
+
+    update_data = {"$set": set_data, "$setOnInsert": set_on_insert_data}
+    if inc_data:
+        update_data.update({"$inc": inc_data})
+    return update_data, inc_data, events
 
-    total_session_duration = livechat_stats.get("total_session_duration", 0)
-    total_sessions = livechat_stats.get("total_sessions", 0)
-    if total_sessions:
-        livechat_stats["session_duration"] = total_session_duration / total_sessions
-    else:
-        livechat_stats["session_duration"] = 0
-
-    funnel_keys = [
-        "total_users",
-        "new_users",
-        "returning_users",
-        "widget_open",
-        "pricing",
-        "features",
-        "installation",
-        "about",
-        "contact",
-        "live_chat_enabled",
-        "subscribe",
-        "qualified_lead",
-        "unqualified",
-        "untagged",
-    ]
-    livechat_stats["funnel"] = {}
-    for k in funnel_keys:
-        val = livechat_stats.pop(k, 0)
-        livechat_stats["funnel"][k] = val
-
-    livechat_stats["averages"] = {}
-    averages_keys = ["sessions_per_user", "session_duration"]
-    for k in averages_keys:
-        val = livechat_stats.pop(k, 0)
-        livechat_stats["averages"][k] = val
-
-    lists_keys = [
-        "cities",
-        "countries",
-        "form_factors",
-        "devices",
-        "browsers",
-        "referrers",
-    ]
-    livechat_stats["lists"] = {}
-    for k in lists_keys:
-        val = livechat_stats.pop(k, [])
-        livechat_stats["lists"][k] = val
 
-    return livechat_stats
+def get_livechat_child_writes(
+    livechat, now_ts, inc_data, message, events, online, user_metadata
+):
+    """Returns the (collection, method, args) writes that follow the header update."""
+    livechat_id = livechat.get("_id")
+    num_sessions = livechat.get("num_sessions", 0)
+    # events are attributed to the session that was current before this update
+    session_index = max(num_sessions - 1 - inc_data.get("num_sessions", 0), 0)
+
+    writes = []
+    if message:
+        # the header's atomic counter orders the messages; ObjectIds made by
+        # different processes within one second do not follow insert order
+        seq = livechat.get("num_messages", 0) - 1
+        writes.append(
+            (
+                "livechat_message",
+                "insert_one",
+                [{"livechat_id": livechat_id, **message, "seq": seq}],
+            )
+        )
+
+    if events:
+        writes.append(
+            (
+                "livechat_event",
+                "insert_many",
+                [
+                    [
+                        {
+                            "livechat_id": livechat_id,
+                            **e,
+                            "session_index": session_index,
+                        }
+                        for e in events
+                    ]
+                ],
+            )
+        )
+
+    if online:
+        writes.append(
+            (
+                "livechat_session",
+                "insert_one",
+                [
+                    {
+                        "livechat_id": livechat_id,
+                        "start_ts": now_ts,
+                        "index": num_sessions - 1,
+                    }
+                ],
+            )
+        )
+    elif online is not None:
+        writes.append(
+            (
+                "livechat_session",
+                "update_one",
+                [
+                    {"livechat_id": livechat_id, "index": session_index},
+                    [
+                        {
+                            "$set": {
+                                "end_ts": now_ts,
+                                "duration_ts": {
+                                    "$subtract": [
+                                        now_ts,
+                                        {"$ifNull": ["$start_ts", now_ts]},
+                                    ]
+                                },
+                            }
+                        }
+                    ],
+                ],
+            )
+        )
+
+    if user_metadata and "lifecycle_stage" in user_metadata:
+        # the stats rollups of the days these sessions are on have to be recomputed
+        writes.append(
+            (
+                "livechat_session",
+                "update_many",
+                [{"livechat_id": livechat_id}, {"$set": {"stats_dirty_ts": now_ts}}],
+            )
+        )
+    return writes
 
 
 def update_livechat(
@@ -358,106 +405,271 @@ def update_livechat(
     online=None,
     visible=None,
 ):
-    update_data = {}
+    now_ts = datetime.now(tz=SERVER_TZINFO).timestamp()
+    update_data, inc_data, events = get_livechat_update(
+        now_ts, user_metadata, message, event, enabled, online, visible
+    )
 
-    livechat = db.livechat.find_one({"user_id": user_id})
+    # one atomic round trip creates or updates the header and returns the session counter after the write
+    for retry in range(2):
+        try:
+            livechat = db.livechat.find_one_and_update(
+                {"user_id": user_id},
+                update_data,
+                projection=LIVECHAT_COUNTERS_PROJECTION,
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            break
+        except DuplicateKeyError:
+            # a concurrent upsert inserted the same user_id first; retrying updates that document
+            if retry:
+                raise
 
-    if not livechat:
-        livechat_id = db.livechat.insert_one(
-            {
-                "creation_ts": datetime.now(tz=SERVER_TZINFO).timestamp(),
-                "last_update_ts": datetime.now(tz=SERVER_TZINFO).timestamp(),
-                "user_id": user_id,
-                "user_metadata": {
-                    "user_name": random_animal_name(),
-                    "lifecycle_stage": "subscriber",
-                },
-                "enabled": False,
-                "online": False,
-                "visible": False,
-                "sessions": [],
-                "messages": [],
-                "events": [],
-            },
-        ).inserted_id
-        livechat = db.livechat.find_one({"_id": livechat_id})
-
-    sessions = livechat.get("sessions", [])
-    session_index = max(len(sessions) - 1, 0)
-    session = sessions[session_index] if sessions else {}
-    if event:
-        event.update({"session_index": session_index})
-    events = [event] if event else []
+    for collection, method, args in get_livechat_child_writes(
+        livechat, now_ts, inc_data, message, events, online, user_metadata
+    ):
+        getattr(db[collection], method)(*args)
 
-    set_data = {}
-    push_data = {}
 
-    if message:
-        messages_to_add = [message]
-        push_data.update({"messages": {"$each": messages_to_add}})
+async def update_livechat_async(
+    user_id,
+    user_metadata: Dict = None,
+    message: Dict = None,
+    event: Dict = None,
+    enabled=None,
+    online=None,
+    visible=None,
+):
+    async_db = get_async_db()
+    now_ts = datetime.now(tz=SERVER_TZINFO).timestamp()
+    update_data, inc_data, events = get_livechat_update(
+        now_ts, user_metadata, message, event, enabled, online, visible
+    )
 
-    if enabled is not None:
-        set_data.update({"enabled": enabled})
-        events.append(
-            {
-                "category": "user",
-                "action": "update_livechat",
-                "label": "enable_livechat",
-                "value": enabled,
-                "session_index": session_index,
-                "ts": datetime.now(tz=SERVER_TZINFO).timestamp(),
-            }
+    for retry in range(2):
+        try:
+            livechat = await async_db.livechat.find_one_and_update(
+                {"user_id": user_id},
+                update_data,
+                projection=LIVECHAT_COUNTERS_PROJECTION,
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            break
+        except DuplicateKeyError:
+            if retry:
+                raise
+
+    for collection, method, args in get_livechat_child_writes(
+        livechat, now_ts, inc_data, message, events, online, user_metadata
+    ):
+        await getattr(async_db[collection], method)(*args)
+
+
+async def update_livechats_async(updates: Dict):
+    """Applies the online / visible updates of many users, keyed by user_id.
+
+    Equivalent to one update_livechat_async per user, in one bulk write for the
+    headers and one for the sessions.
+    """
+    async_db = get_async_db()
+    now_ts = datetime.now(tz=SERVER_TZINFO).timestamp()
+    livechat_updates = {
+        user_id: get_livechat_update(
+            now_ts, online=update.get("online"), visible=update.get("visible")
         )
+        for user_id, update in updates.items()
+    }
 
-    if online is not None:
-        set_data.update({"online": online})
-        if online:
-            sessions_to_add = [
+    user_ids = list(livechat_updates.keys())
+    try:
+        await async_db.livechat.bulk_write(
+            [
+                UpdateOne(
+                    {"user_id": user_id}, livechat_updates[user_id][0], upsert=True
+                )
+                for user_id in user_ids
+            ],
+            ordered=False,
+        )
+    except BulkWriteError as e:
+        for write_error in e.details.get("writeErrors", []):
+            user_id = user_ids[write_error["index"]]
+            logger.error(f"Could not update livechat {user_id}. {write_error}")
+            del livechat_updates[user_id]
+
+    livechats = await async_db.livechat.find(
+        {"user_id": {"$in": list(livechat_updates.keys())}},
+        {"user_id": 1, "num_sessions": 1},
+    ).to_list(None)
+    child_requests = {}
+    for livechat in livechats:
+        user_id = livechat.get("user_id")
+        _, inc_data, events = livechat_updates[user_id]
+        for collection, method, args in get_livechat_child_writes(
+            livechat,
+            now_ts,
+            inc_data,
+            None,
+            events,
+            updates[user_id].get("online"),
+            None,
+        ):
+            child_requests.setdefault(collection, []).append(
+                LIVECHAT_WRITE_REQUESTS[method](*args)
+            )
+    for collection, requests in child_requests.items():
+        await async_db[collection].bulk_write(requests, ordered=False)
+
+
+def group_livechat_events(items: List[Dict], statuses: List[Dict]) -> Dict:
+    events_by_user = {}
+    for index, item in enumerate(items):
+        user_id = item.get("user_id") if isinstance(item, dict) else None
+        event = item.get("event") if isinstance(item, dict) else None
+        if not user_id or not isinstance(event, dict):
+            set_livechat_event_error(statuses, index, "user_id and event are required")
+            continue
+        events_by_user.setdefault(user_id, []).append((index, event))
+    return events_by_user
+
+
+def set_livechat_event_error(statuses: List[Dict], index, error):
+    statuses[index] = {"status": "error", "error": str(error)}
+
+
+def get_livechat_event_header_requests(user_ids, events_by_user: Dict, now_ts):
+    # one unordered upsert per user for the header counters
+    header_requests = []
+    for user_id in user_ids:
+        set_data = {"last_update_ts": now_ts}
+        inc_data = {"num_events": len(events_by_user[user_id])}
+        header_requests.append(
+            UpdateOne(
+                {"user_id": user_id},
                 {
-                    "start_ts": datetime.now(tz=SERVER_TZINFO).timestamp(),
-                    "index": len(sessions),
-                }
-            ]
-            push_data.update({"sessions": {"$each": sessions_to_add}})
-        else:
-            end_ts = datetime.now(tz=SERVER_TZINFO).timestamp()
-            duration_ts = end_ts - session.get("start_ts", end_ts)
-            set_data.update(
+                    "$set": set_data,
+                    "$inc": inc_data,
+                    "$setOnInsert": get_livechat_insert_defaults(
+                        now_ts, set_data, inc_data
+                    ),
+                },
+                upsert=True,
+            )
+        )
+    return header_requests
+
+
+def set_livechat_header_errors(
+    e: BulkWriteError, user_ids, events_by_user: Dict, statuses: List[Dict]
+):
+    for write_error in e.details.get("writeErrors", []):
+        for index, _ in events_by_user.pop(user_ids[write_error["index"]]):
+            set_livechat_event_error(statuses, index, write_error.get("errmsg"))
+
+
+def get_livechat_event_docs(livechats, events_by_user: Dict):
+    event_indexes = []
+    event_docs = []
+    for livechat in livechats:
+        session_index = max(livechat.get("num_sessions", 0) - 1, 0)
+        for index, event in events_by_user.get(livechat.get("user_id"), []):
+            event_indexes.append(index)
+            event_docs.append(
                 {
-                    f"sessions.{session_index}.end_ts": end_ts,
-                    f"sessions.{session_index}.duration_ts": duration_ts,
+                    "livechat_id": livechat.get("_id"),
+                    **event,
+                    "session_index": session_index,
                 }
             )
+    return event_indexes, event_docs
 
-    if events:
-        push_data.update({"events": {"$each": events}})
 
-    if visible is not None:
-        set_data.update({"visible": visible})
+def set_livechat_event_errors(e: BulkWriteError, event_indexes, statuses: List[Dict]):
+    for write_error in e.details.get("writeErrors", []):
+        set_livechat_event_error(
+            statuses, event_indexes[write_error["index"]], write_error.get("errmsg")
+        )
 
-    if user_metadata:
-        merged_user_metadata = livechat.get("user_metadata", {})
-        merged_user_metadata.update(user_metadata)
-        set_data.update({"user_metadata": merged_user_metadata})
-
-    if set_data or push_data:
-        set_data.update({"last_update_ts": datetime.now(tz=SERVER_TZINFO).timestamp()})
-    if set_data:
-        update_data.update({"$set": set_data})
-    if push_data:
-        update_data.update({"$push": push_data})
-
-    if update_data:
-        db.livechat.update_one(
-            {"user_id": user_id},
-            update_data,
+
+def add_livechat_events(items: List[Dict]) -> List[Dict]:
+    """Stores a batch of {"user_id", "event"} items; returns a status per item."""
+    now_ts = datetime.now(tz=SERVER_TZINFO).timestamp()
+    statuses = [{"status": "ok"} for _ in items]
+    events_by_user = group_livechat_events(items, statuses)
+    if not events_by_user:
+        return statuses
+
+    user_ids = list(events_by_user.keys())
+    try:
+        db.livechat.bulk_write(
+            get_livechat_event_header_requests(user_ids, events_by_user, now_ts),
+            ordered=False,
+        )
+    except BulkWriteError as e:
+        set_livechat_header_errors(e, user_ids, events_by_user, statuses)
+
+    livechats = db.livechat.find(
+        {"user_id": {"$in": list(events_by_user.keys())}},
+        {"user_id": 1, "num_sessions": 1},
+    )
+    event_indexes, event_docs = get_livechat_event_docs(livechats, events_by_user)
+    if event_docs:
+        try:
+            db.livechat_event.insert_many(event_docs, ordered=False)
+        except BulkWriteError as e:
+            set_livechat_event_errors(e, event_indexes, statuses)
+
+    return statuses
+
+
+async def add_livechat_events_async(items: List[Dict]) -> List[Dict]:
+    async_db = get_async_db()
+    now_ts = datetime.now(tz=SERVER_TZINFO).timestamp()
+    statuses = [{"status": "ok"} for _ in items]
+    events_by_user = group_livechat_events(items, statuses)
+    if not events_by_user:
+        return statuses
+
+    user_ids = list(events_by_user.keys())
+    try:
+        await async_db.livechat.bulk_write(
+            get_livechat_event_header_requests(user_ids, events_by_user, now_ts),
+            ordered=False,
         )
+    except BulkWriteError as e:
+        set_livechat_header_errors(e, user_ids, events_by_user, statuses)
+
+    livechats = await async_db.livechat.find(
+        {"user_id": {"$in": list(events_by_user.keys())}},
+        {"user_id": 1, "num_sessions": 1},
+    ).to_list(None)
+    event_indexes, event_docs = get_livechat_event_docs(livechats, events_by_user)
+    if event_docs:
+        try:
+            await async_db.livechat_event.insert_many(event_docs, ordered=False)
+        except BulkWriteError as e:
+            set_livechat_event_errors(e, event_indexes, statuses)
+
+    return statuses
+
+
+def get_livechat_transcript(livechat):
+    livechat_id = livechat.get("_id")
+    return get_transcript(
+        str(livechat_id),
+        livechat.get("num_messages", 0),
+        lambda from_seq: get_livechat_messages(livechat_id, from_seq=from_seq),
+    )
 
 
-def get_livechat_card(user_id, notification_type="transcript", message_id=None):
-    livechat = db.livechat.find_one({"user_id": user_id})
+def render_livechat_card(user_id, notification_type, page_index):
+    """Returns the card and whether it may be cached against the livechat version."""
+    livechat = get_livechat(user_id=user_id, projection=LIVECHAT_CARD_HEADER_PROJECTION)
+    livechat_id = str(livechat.get("_id"))
+    cacheable = False
     user_metadata = livechat.get("user_metadata", {})
-    messages = livechat.get("messages") or []
 
     user_name = user_metadata.get("user_name", "") + f" #{str(user_id)[-7:]}"
     card_text = ""
@@ -465,11 +677,6 @@ def get_livechat_card(user_id, notification_type="transcript", message_id=None):
     reply_markup = {}
 
     if notification_type == "transcript":
-        card_text = card_text + f"Chat with {user_name}\n\n"
-        for message in messages:
-            sender_type = str(message.get("sender_type")).capitalize()
-            card_text = card_text + f"{sender_type}: {message.get('text')}\n"
-
         chat_status = "🟢 Online" if livechat.get("online", False) else "🔴 Offline"
         if livechat.get("online") == True and livechat.get("visible") == True:
             chat_status = chat_status + " + 📖 Open"
@@ -496,8 +703,7 @@ def get_livechat_card(user_id, notification_type="transcript", message_id=None):
         referrer_data = user_metadata.get("referrer_data", {})
         referrer = referrer_data.get("referrer", "?")
 
-        sessions = livechat.get("sessions", [])
-        num_sessions = len(sessions)
+        num_sessions = livechat.get("num_sessions", 0)
 
         lifecycle_stage = user_metadata.get("lifecycle_stage", "subscriber")
         lead_status = (
@@ -508,88 +714,300 @@ def get_livechat_card(user_id, notification_type="transcript", message_id=None):
             )
         )
 
-        card_text = (
-            card_text
-            + "\n"
-            + f"Status: {chat_status}\nLocation: {location}\nLead Status: {lead_status}\nDevice: {device}\nBrowser: {browser}\nReferrer: {referrer}\nSessions: {num_sessions}\n"
+        card_header = f"Chat with {user_name}\n\n"
+        card_footer = f"\nStatus: {chat_status}\nLocation: {location}\nLead Status: {lead_status}\nDevice: {device}\nBrowser: {browser}\nReferrer: {referrer}\nSessions: {num_sessions}\n"
+
+        # only the newest messages that fit in one Telegram message are shown,
+        # older ones are paged in through the buttons below
+        transcript = get_livechat_transcript(livechat)
+        # a message written after the header was read is not in this version yet
+        cacheable = transcript["num_messages"] >= livechat.get("num_messages", 0)
+        transcript_text, page_index, has_older_page = get_transcript_page(
+            transcript,
+            page_index,
+            TELEGRAM_MESSAGE_MAX_LENGTH
+            - get_text_length(card_header)
+            - get_text_length(card_footer),
         )
+        card_text = card_header + transcript_text + card_footer
+
+        page_buttons = []
+        if has_older_page:
+            page_buttons.append(
+                {
+                    "title": "« Older",
+                    "payload": f'/refresh{{"c":"{livechat_id}","i":{page_index+1}}}',
+                }
+            )
+        if page_index > 0:
+            page_buttons.append(
+                {
+                    "title": "Newer »",
+                    "payload": f'/refresh{{"c":"{livechat_id}","i":{page_index-1}}}',
+                }
+            )
 
         reply_markup = {
             "keyboard": [
                 [
                     {
                         "title": "🔄 Refresh",
-                        "payload": f"/refresh",
+                        "payload": f'/refresh{{"c":"{livechat_id}"}}',
                     },
                 ],
                 [
                     {
                         "title": "🙋 Greet",
-                        "payload": f'/quick{{"d":"greet"}}',
+                        "payload": f'/quick{{"c":"{livechat_id}","d":"greet"}}',
                     },
                     {
                         "title": "👋 Close",
-                        "payload": f'/quick{{"d":"close"}}',
+                        "payload": f'/quick{{"c":"{livechat_id}","d":"close"}}',
                     },
                 ],
                 [
                     {
                         "title": "✅ Qualified Lead",
-                        "payload": f'/tag{{"d":"lead"}}',
+                        "payload": f'/tag{{"c":"{livechat_id}","d":"lead"}}',
                     },
                     {
                         "title": "❌ Unqualified",
-                        "payload": f'/tag{{"d":"unqualified"}}',
+                        "payload": f'/tag{{"c":"{livechat_id}","d":"unqualified"}}',
                     },
                 ],
             ],
             "type": "inline",
         }
+        if page_buttons:
+            reply_markup["keyboard"].insert(0, page_buttons)
     elif notification_type == "latest_user_message":
-        for message in reversed(messages):
-            if message.get("sender_type") == "user":
-                card_text = f"{message.get('text')}\n\nSent by {user_name}"
-                break
+        message = get_latest_livechat_message(livechat.get("_id"), sender_type="user")
+        if message:
+            card_text = f"{message.get('text')}\n\nSent by {user_name}"
 
         reply_markup = {
             "keyboard": [
                 [
                     {
                         "title": "🔍 Expand",
-                        "payload": f"/refresh",
+                        "payload": f'/refresh{{"c":"{livechat_id}"}}',
                     },
                 ]
             ],
             "type": "inline",
         }
 
-    if message_id:
-        message_metadata = get_message_metadata(message_id) or {}
-        back_button_title = message_metadata.get("back_button_title")
-        back_button_payload = message_metadata.get("back_button_payload")
-        if back_button_title and back_button_payload:
-            reply_markup["keyboard"].append(
-                [{"title": back_button_title, "payload": back_button_payload}]
-            )
-
-    return {
+    card = {
         "text": card_text,
         "reply_markup": reply_markup,
         "message_metadata": {
-            "livechat_id": str(livechat.get("_id")),
+            "livechat_id": livechat_id,
+            "livechat_version": livechat.get("version"),
         },
     }
+    return card, cacheable and livechat.get("version") is not None
 
 
-def post_livechat_message(user_id, message_text):
-    response_json = {}
-    try:
-        url = get_livechat_client_url("/livechat/message")
-        response = requests.post(
-            url, json={"sender_id": user_id, "text": message_text}, timeout=5
+def get_livechat_card(
+    user_id,
+    notification_type="transcript",
+    page_index=0,
+    livechat=None,
+    navigation=None,
+):
+    """Returns the card of a livechat.
+
+    With a `livechat` header carrying `_id` and `version`, an unchanged card is
+    served from the cache without reading the livechat again. `navigation` holds
+    the chats list the card was opened from; it is carried in every button so
+    that the card keeps its back button.
+    """
+    card = None
+    if livechat and livechat.get("version") is not None:
+        cache_key = (str(livechat.get("_id")), notification_type, page_index)
+        with livechat_card_lock:
+            cached_card = livechat_card_cache.get(cache_key)
+            if cached_card and cached_card[0] == livechat.get("version"):
+                livechat_card_cache.move_to_end(cache_key)
+                card = cached_card[1]
+
+    if not card:
+        card, cacheable = render_livechat_card(user_id, notification_type, page_index)
+        if cacheable:
+            cache_key = (
+                card["message_metadata"]["livechat_id"],
+                notification_type,
+                page_index,
+            )
+            # cached cards are never modified, so they can be shared across threads
+            with livechat_card_lock:
+                livechat_card_cache[cache_key] = (
+                    card["message_metadata"]["livechat_version"],
+                    card,
+                )
+                livechat_card_cache.move_to_end(cache_key)
+                while len(livechat_card_cache) > LIVECHAT_CARD_CACHE_SIZE:
+                    livechat_card_cache.popitem(last=False)
+
+    # callers add their own keys, so never hand out the cached dict itself
+    json_message = deepcopy(card)
+    # everything a button press needs is in its payload, only live cards are
+    # tracked in message_metadata
+    json_message.pop("message_metadata")
+    if navigation and navigation.get("p"):
+        keyboard = json_message["reply_markup"]["keyboard"]
+        for row in keyboard:
+            for button in row:
+                button["payload"] = add_payload_entities(button["payload"], navigation)
+        keyboard.append(
+            [get_chats_back_button(navigation.get("p"), navigation.get("b", 0))]
         )
-        response_json = response.json()
-    except Exception as e:
-        logger.error(e)
 
-    return response_json
+    return json_message
+
+
+async def get_livechat_card_async(**kwargs):
+    # rendering reads mongo through pymongo, which would block the event loop
+    return await asyncio.get_event_loop().run_in_executor(
+        livechat_card_executor, partial(get_livechat_card, **kwargs)
+    )
+
+
+def get_card_navigation(entities):
+    return {
+        k: get_entity(entities, k)
+        for k in ["p", "b"]
+        if get_entity(entities, k) is not None
+    }
+
+
+def get_card_livechat_ids(message):
+    """Returns the livechat ids the card buttons of the Telegram `message` name."""
+    livechat_ids = set()
+    for row in get_json_key(message, "reply_markup.inline_keyboard", []):
+        for button in row:
+            parsed = parse_payload(decode_callback_data(button.get("callback_data")))
+            if parsed and parsed[0] in LIVECHAT_CARD_COMMANDS and parsed[1].get("c"):
+                livechat_ids.add(parsed[1].get("c"))
+    return livechat_ids
+
+
+async def get_card_livechat_async(entities, message_id):
+    """Returns the header of the livechat a card button was pressed on.
+
+    Cards carry the livechat id in their payloads; cards sent before that are
+    looked up in message_metadata.
+    """
+    livechat_id = get_entity(entities, "c")
+    if not livechat_id and message_id:
+        message_metadata = await get_message_metadata_async(message_id) or {}
+        livechat_id = message_metadata.get("livechat_id")
+    if not livechat_id:
+        return {}
+    return (
+        await get_livechat_async(id=livechat_id, projection=LIVECHAT_ID_PROJECTION)
+        or {}
+    )
+
+
+def is_livechat_card_shown(json_message, message):
+    """Whether the Telegram `message` already shows the card.
+
+    Telegram rejects an edit that changes nothing with "message is not modified".
+    """
+    if not message:
+        return False
+    message_keyboard = [
+        [
+            (button.get("text"), decode_callback_data(button.get("callback_data")))
+            for button in row
+        ]
+        for row in get_json_key(message, "reply_markup.inline_keyboard", [])
+    ]
+    card_keyboard = [
+        [(button.get("title"), button.get("payload")) for button in row]
+        for row in json_message.get("reply_markup", {}).get("keyboard", [])
+    ]
+    # Telegram trims the text it stores
+    return (
+        message.get("text") == json_message.get("text", "").strip()
+        and message_keyboard == card_keyboard
+    )
+
+
+def get_livechat_live_card(user_id, chat_id, notification_type="transcript"):
+    """Returns the card as an edit of the visitor's live card, or as a new live card."""
+    livechat = get_livechat(user_id=user_id, projection=LIVECHAT_ID_PROJECTION)
+    json_message = get_livechat_card(
+        user_id=user_id, notification_type=notification_type, livechat=livechat
+    )
+    livechat_id = str(livechat.get("_id"))
+    now = datetime.now(tz=SERVER_TZINFO)
+    live_card = get_live_card_metadata(
+        livechat_id, now.timestamp() - LIVECHAT_LIVE_CARD_TTL
+    )
+    if live_card:
+        json_message["chat_id"] = chat_id
+        json_message["message_id"] = live_card.get("message_id")
+    else:
+        json_message["message_metadata"] = {
+            "livechat_id": livechat_id,
+            "live_card_ts": now.timestamp(),
+            # the entry is only looked up while the card is live
+            "expire_at": now + timedelta(seconds=LIVECHAT_LIVE_CARD_TTL),
+        }
+    json_message["collapse_key"] = f"live_card_{livechat_id}"
+    json_message["debounce"] = LIVECHAT_LIVE_CARD_DEBOUNCE
+    return json_message
+
+
+async def handle_livechat_message(metadata: Dict, chat_id) -> Optional[Dict]:
+    """Stores a message posted by the livechat widget.
+
+    Returns the card to notify the admin group `chat_id` with, if the widget
+    asked for a notification.
+    """
+    user_id = metadata.get("sender_id")
+    sender_type = metadata.get("sender_type", "user")
+    message_text = metadata.get("message_text")
+    if message_text:
+        user_message = {
+            "id": uuid4(),
+            "user_id": user_id,
+            "text": message_text,
+            "sender_type": sender_type,
+            "sent_ts": datetime.now(tz=SERVER_TZINFO).timestamp(),
+        }
+        await update_livechat_async(user_id, message=user_message)
+    user_metadata = metadata.get("user_metadata")
+    if user_metadata:
+        await update_livechat_async(user_id, user_metadata=user_metadata)
+
+    if not metadata.get("send_notification"):
+        return None
+
+    notification_type = metadata.get("notification_type", "transcript")
+    if metadata.get("live_card"):
+        get_card = partial(
+            get_livechat_live_card,
+            user_id=user_id,
+            chat_id=chat_id,
+            notification_type=notification_type,
+        )
+    else:
+        get_card = partial(
+            get_livechat_card, user_id=user_id, notification_type=notification_type
+        )
+    json_message = await asyncio.get_event_loop().run_in_executor(
+        livechat_card_executor, get_card
+    )
+    json_message["remove_reply_markup"] = False
+    return json_message
+
+
+def post_livechat_message(user_id, message_text):
+    # sent in the background so that the admin is not kept waiting on the widget
+    # backend; keyed by user so that a visitor gets the replies in order
+    return livechat_client.post_in_background(
+        "/livechat/message", {"sender_id": user_id, "text": message_text}, key=user_id
+    )
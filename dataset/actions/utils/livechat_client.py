@@ -0,0 +1,197 @@
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Any, Deque, Dict, Hashable, Optional, Text, Tuple
+from urllib3.exceptions import NewConnectionError
+
+from actions.utils.host import get_livechat_client_url
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")]
+STATS_LOG_INTERVAL = 100
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_connect_error(e: requests.RequestException) -> bool:
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    # an aborted connection is a ConnectionError too, but the post may have arrived
+    reason = getattr(e.args[0] if e.args else None, "reason", None)
+    return isinstance(e, requests.ConnectionError) and isinstance(
+        reason, NewConnectionError
+    )
+
+
+class LivechatClient:
+    """Client for the livechat client server.
+
+    Requests share one keep-alive connection pool. A request that could not
+    connect is retried with jittered exponential backoff; posts are not
+    idempotent, so nothing that may have reached the server is sent again.
+    Background posts with the same `key` are sent one at a time, in the order
+    they were made. After `failure_threshold` failed requests in a row the
+    circuit opens and requests fail fast for `reset_timeout` seconds, after
+    which a single request is let through to probe the server.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        timeout: float = 5.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.25,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        max_workers: int = 4,
+    ) -> None:
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="livechat_client"
+        )
+
+        self.lock = threading.Lock()
+        # background posts waiting behind the one being sent, per key
+        self.pending: Dict[Hashable, Deque[Tuple[Text, Dict[Text, Any], Future]]] = {}
+        self.consecutive_failures = 0
+        self.opened_ts: Optional[float] = None
+        self.probing = False
+
+        self.latency_histogram = [0] * len(LATENCY_BUCKETS)
+        self.counters = {
+            "requests": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "retried": 0,
+            "rejected": 0,
+            "circuit_opened": 0,
+        }
+
+    def increment(self, counter: Text) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+    def allow_request(self) -> bool:
+        with self.lock:
+            if self.opened_ts is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_ts < self.reset_timeout:
+                return False
+            # half open: one request decides whether the circuit closes again
+            self.probing = True
+            return True
+
+    def record_result(self, succeeded: bool, latency: float) -> None:
+        with self.lock:
+            self.counters["requests"] += 1
+            self.latency_histogram[bisect_left(LATENCY_BUCKETS, latency)] += 1
+            if succeeded:
+                self.counters["succeeded"] += 1
+                self.consecutive_failures = 0
+                self.opened_ts = None
+            else:
+                self.consecutive_failures += 1
+                if self.probing or (
+                    self.opened_ts is None
+                    and self.consecutive_failures >= self.failure_threshold
+                ):
+                    self.opened_ts = time.monotonic()
+                    self.counters["circuit_opened"] += 1
+            self.probing = False
+            log_stats = self.counters["requests"] % STATS_LOG_INTERVAL == 0
+        if log_stats:
+            logger.info(f"Livechat client stats: {self.stats()}")
+
+    def get_backoff(self, attempt: int) -> float:
+        # full jitter keeps retries from many workers from lining up
+        return random.uniform(0, self.backoff_base * (2**attempt))
+
+    def post(self, path: Text, json: Dict[Text, Any]) -> Dict[Text, Any]:
+        url = get_livechat_client_url(path)
+        for attempt in range(self.max_retries + 1):
+            if not self.allow_request():
+                self.increment("rejected")
+                raise CircuitOpenError(f"Livechat client circuit is open for {url}")
+
+            start_time = time.monotonic()
+            try:
+                response = self.session.post(url, json=json, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.record_result(False, time.monotonic() - start_time)
+                # only resend what never reached the server
+                if not is_connect_error(e) or attempt == self.max_retries:
+                    self.increment("failed")
+                    raise
+            else:
+                # a server error may come after the post was acted on; client
+                # errors count as a healthy server
+                succeeded = response.status_code < 500
+                self.record_result(succeeded, time.monotonic() - start_time)
+                if not succeeded:
+                    self.increment("failed")
+                    raise Exception(f"{url} returned {response.status_code}")
+                return response.json()
+
+            self.increment("retried")
+            time.sleep(self.get_backoff(attempt))
+
+    def post_in_background(
+        self, path: Text, json: Dict[Text, Any], key: Optional[Hashable] = None
+    ) -> Future:
+        future = Future()
+        with self.lock:
+            queue = self.pending.get(key)
+            if queue is not None:
+                # a worker is already sending this key's posts; it sends this one next
+                queue.append((path, json, future))
+                return future
+            self.pending[key] = deque([(path, json, future)])
+        self.executor.submit(self.send_pending, key)
+        return future
+
+    def send_pending(self, key: Optional[Hashable]) -> None:
+        while True:
+            with self.lock:
+                queue = self.pending[key]
+                if not queue:
+                    del self.pending[key]
+                    return
+                path, json, future = queue.popleft()
+            try:
+                future.set_result(self.post(path, json))
+            except Exception as e:
+                logger.error(f"Could not post to the livechat client. {e}")
+                future.set_result({})
+
+    def stats(self) -> Dict[Text, Any]:
+        return {
+            "circuit_open": self.opened_ts is not None,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_histogram": {
+                str(bound): count
+                for bound, count in zip(LATENCY_BUCKETS, self.latency_histogram)
+            },
+            **self.counters,
+        }
+
+
+livechat_client = LivechatClient()
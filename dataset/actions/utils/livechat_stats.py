@@ -0,0 +1,428 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import logging
+from pymongo import ASCENDING, DESCENDING, DeleteMany, ReplaceOne
+from typing import Dict, List, Text, Tuple
+
+from actions.db.store import db
+
+from actions.utils.date import SERVER_TZINFO
+
+logger = logging.getLogger(__name__)
+
+FUNNEL_KEYS = [
+    "total_users",
+    "new_users",
+    "returning_users",
+    "widget_open",
+    "pricing",
+    "features",
+    "installation",
+    "about",
+    "contact",
+    "live_chat_enabled",
+    "subscribe",
+    "qualified_lead",
+    "unqualified",
+    "untagged",
+]
+COUNTER_KEYS = FUNNEL_KEYS + ["total_session_duration", "total_sessions"]
+# funnel steps counted from the events a user had in the window
+FUNNEL_EVENTS = {
+    "widget_open": "/livechat_visible",
+    "pricing": "/pricing",
+    "features": "/features",
+    "installation": "/installation",
+    "about": "/about",
+    "contact": "/contact",
+    "live_chat_enabled": "enable_livechat",
+    "subscribe": "/subscribe",
+}
+# funnel steps counted from the user's lifecycle stage
+FUNNEL_STAGES = {
+    "qualified_lead": "lead",
+    "unqualified": "unqualified",
+    "untagged": "subscriber",
+}
+LISTS_FIELDS = {
+    "cities": "user_metadata.location_data.city",
+    "countries": "user_metadata.location_data.country",
+    "form_factors": "user_metadata.wurfl_data.form_factor",
+    "devices": "user_metadata.wurfl_data.complete_device_name",
+    "browsers": "user_metadata.browser_data.browserName",
+    "referrers": "user_metadata.referrer_data.referrer",
+}
+LISTS_KEYS = list(LISTS_FIELDS.keys())
+
+# number of values shown per list
+HISTOGRAM_SIZE = 50
+# sessions that start before midnight may still end after it; a day's rows are
+# recomputed until this long after the day is over
+ROLLUP_FINALIZE_DELAY = timedelta(hours=1)
+
+
+def get_stats_pipeline(
+    lifecycle_stage=None,
+    from_ts=None,
+    to_ts=None,
+    bucket_query=None,
+):
+    pipeline = []
+
+    # keep only sessions that fit the date criteria; also remove active sessions (duration is not set)
+    sessions_match_query = {"duration_ts": {"$gt": 0}}
+    ts_query = {}
+    if from_ts:
+        ts_query.update({"$gte": from_ts})
+    if to_ts:
+        ts_query.update({"$lt": to_ts})
+    if ts_query:
+        sessions_match_query.update({"start_ts": ts_query})
+    pipeline.append({"$match": sessions_match_query})
+
+    # collect the valid session indexes and durations for each livechat (used next to filter events)
+    pipeline.append(
+        {
+            "$group": {
+                "_id": {"livechat_id": "$livechat_id", "bucket": bucket_query},
+                "session_indexes": {"$push": "$index"},
+                "session_durations": {"$push": "$duration_ts"},
+            }
+        }
+    )
+
+    # join the livechat header
+    pipeline.append(
+        {
+            "$lookup": {
+                "from": "livechat",
+                "localField": "_id.livechat_id",
+                "foreignField": "_id",
+                "as": "livechat",
+            }
+        }
+    )
+    pipeline.append({"$unwind": "$livechat"})
+
+    # filter documents that do not match the lifecycle_stage
+    if lifecycle_stage:
+        pipeline.append(
+            {"$match": {"livechat.user_metadata.lifecycle_stage": lifecycle_stage}}
+        )
+
+    # join the distinct labels of events that are in a valid session; also remove other unnecessary events to make computations easier downstream
+    pipeline.append(
+        {
+            "$lookup": {
+                "from": "livechat_event",
+                "let": {
+                    "livechat_id": "$_id.livechat_id",
+                    "session_indexes": "$session_indexes",
+                },
+                "pipeline": [
+                    {
+                        "$match": {
+                            "$expr": {
+                                "$and": [
+                                    {"$eq": ["$livechat_id", "$$livechat_id"]},
+                                    {"$in": ["$session_index", "$$session_indexes"]},
+                                    {"$in": ["$label", list(FUNNEL_EVENTS.values())]},
+                                    {
+                                        "$or": [
+                                            {"$ne": ["$label", "/livechat_visible"]},
+                                            {"$eq": ["$metadata.visible", True]},
+                                        ]
+                                    },
+                                    {
+                                        "$or": [
+                                            {"$ne": ["$label", "enable_livechat"]},
+                                            {"$eq": ["$value", True]},
+                                        ]
+                                    },
+                                ]
+                            }
+                        }
+                    },
+                    {"$group": {"_id": "$label"}},
+                ],
+                "as": "events",
+            }
+        }
+    )
+    # one summary per user per bucket: a window spanning several days merges its
+    # users' daily summaries by livechat_id, so each user is counted once
+    pipeline.append(
+        {
+            "$project": {
+                "_id": 0,
+                "bucket": "$_id.bucket",
+                "livechat_id": "$_id.livechat_id",
+                "lifecycle_stage": "$livechat.user_metadata.lifecycle_stage",
+                "new": {"$in": [0, "$session_indexes"]},
+                "sessions": {"$size": "$session_indexes"},
+                "session_duration": {"$sum": "$session_durations"},
+                "event_labels": "$events._id",
+                "lists": {k: f"$livechat.{field}" for k, field in LISTS_FIELDS.items()},
+            }
+        }
+    )
+
+    return pipeline
+
+
+def aggregate_stats_users(
+    lifecycle_stage=None,
+    from_ts=None,
+    to_ts=None,
+    bucket_query=None,
+):
+    pipeline = get_stats_pipeline(lifecycle_stage, from_ts, to_ts, bucket_query)
+    return list(db.livechat_session.aggregate(pipeline))
+
+
+def merge_stats_users(users: List[Dict]):
+    """Merges the per-bucket summaries of each user, oldest first."""
+    merged = {}
+    for user in users:
+        livechat_id = user.get("livechat_id")
+        merged_user = merged.get(livechat_id)
+        if not merged_user:
+            merged[livechat_id] = {
+                **user,
+                "event_labels": set(user.get("event_labels", [])),
+            }
+            continue
+        merged_user["new"] = merged_user.get("new") or user.get("new")
+        merged_user["sessions"] += user.get("sessions", 0)
+        merged_user["session_duration"] += user.get("session_duration", 0)
+        merged_user["event_labels"].update(user.get("event_labels", []))
+        # the header fields are the latest ones seen for the user
+        merged_user["lifecycle_stage"] = user.get("lifecycle_stage")
+        merged_user["lists"] = user.get("lists", {})
+    return list(merged.values())
+
+
+def get_stats_from_users(users: List[Dict]):
+    users = merge_stats_users(users)
+
+    counters = {k: 0 for k in COUNTER_KEYS}
+    lists = {k: Counter() for k in LISTS_KEYS}
+    for user in users:
+        counters["total_users"] += 1
+        counters["new_users" if user.get("new") else "returning_users"] += 1
+        for k, label in FUNNEL_EVENTS.items():
+            if label in user["event_labels"]:
+                counters[k] += 1
+        for k, stage in FUNNEL_STAGES.items():
+            if user.get("lifecycle_stage") == stage:
+                counters[k] += 1
+        counters["total_sessions"] += user.get("sessions", 0)
+        counters["total_session_duration"] += user.get("session_duration", 0)
+        for k in LISTS_KEYS:
+            value = user.get("lists", {}).get(k)
+            if value is not None:
+                lists[k][value] += 1
+
+    livechat_stats = {}
+    livechat_stats["funnel"] = {k: counters[k] for k in FUNNEL_KEYS}
+
+    total_users = counters["total_users"]
+    total_sessions = counters["total_sessions"]
+    livechat_stats["averages"] = {
+        "sessions_per_user": total_sessions / total_users if total_users else 0,
+        "session_duration": counters["total_session_duration"] / total_sessions
+        if total_sessions
+        else 0,
+    }
+
+    livechat_stats["lists"] = {
+        k: {
+            "total": sum(lists[k].values()),
+            "top": lists[k].most_common(HISTOGRAM_SIZE),
+        }
+        for k in LISTS_KEYS
+    }
+
+    return livechat_stats
+
+
+def get_day_bucket_query():
+    # the day a session started on, in server time
+    return {
+        "$dateToString": {
+            "format": "%Y-%m-%d",
+            "date": {"$toDate": {"$multiply": ["$start_ts", 1000]}},
+            "timezone": SERVER_TZINFO.zone,
+        }
+    }
+
+
+def get_window_bucket_query(windows: Dict[Text, Tuple]):
+    # the name of the (non-overlapping) window a session started in
+    branches = []
+    for name, (from_ts, to_ts) in windows.items():
+        conditions = []
+        if from_ts:
+            conditions.append({"$gte": ["$start_ts", from_ts]})
+        if to_ts:
+            conditions.append({"$lt": ["$start_ts", to_ts]})
+        branches.append({"case": {"$and": conditions}, "then": name})
+    return {"$switch": {"branches": branches, "default": None}}
+
+
+def get_day_start(dt: datetime):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def refresh_livechat_stats_rollups():
+    now_dt = datetime.now(tz=SERVER_TZINFO)
+    today_dt = get_day_start(now_dt)
+
+    last_finalized = db.livechat_stats_rollup.find_one(
+        {"finalized": True}, sort=[("day_ts", DESCENDING)]
+    )
+    from_dt = (
+        datetime.fromtimestamp(last_finalized.get("day_ts"), SERVER_TZINFO)
+        + timedelta(days=1)
+        if last_finalized
+        else None
+    )
+    # a lifecycle tag change moves the livechat's sessions to another stage,
+    # so finalized days it had sessions on are recomputed too
+    first_dirty = db.livechat_session.find_one(
+        {"stats_dirty_ts": {"$exists": True}},
+        projection={"start_ts": 1},
+        sort=[("start_ts", ASCENDING)],
+    )
+    if from_dt and first_dirty:
+        from_dt = min(
+            from_dt,
+            get_day_start(
+                datetime.fromtimestamp(first_dirty.get("start_ts", 0), SERVER_TZINFO)
+            ),
+        )
+    # rows written before the rollups kept per-user summaries cannot be merged
+    first_legacy = db.livechat_stats_rollup.find_one(
+        {"users": {"$exists": False}}, sort=[("day_ts", ASCENDING)]
+    )
+    if from_dt and first_legacy:
+        from_dt = min(
+            from_dt,
+            datetime.fromtimestamp(first_legacy.get("day_ts"), SERVER_TZINFO),
+        )
+    if from_dt and from_dt >= today_dt:
+        return
+
+    # recompute every day after the last finalized one; today stays live
+    users = aggregate_stats_users(
+        from_ts=from_dt and from_dt.timestamp(),
+        to_ts=today_dt.timestamp(),
+        bucket_query=get_day_bucket_query(),
+    )
+    rows = {}
+    for user in users:
+        key = (user.get("bucket"), user.get("lifecycle_stage"))
+        rows.setdefault(key, []).append(user)
+
+    # rows are replaced in place so readers never see a day without its rows
+    rollup_requests = []
+    for (day, lifecycle_stage), day_users in rows.items():
+        day_dt = SERVER_TZINFO.localize(datetime.strptime(day, "%Y-%m-%d"))
+        key = {"day_ts": day_dt.timestamp(), "lifecycle_stage": lifecycle_stage}
+        rollup_requests.append(
+            ReplaceOne(
+                key,
+                {
+                    **key,
+                    "day": day,
+                    "finalized": day_dt + timedelta(days=1) + ROLLUP_FINALIZE_DELAY
+                    <= now_dt,
+                    "refreshed_ts": now_dt.timestamp(),
+                    "users": day_users,
+                },
+                upsert=True,
+            )
+        )
+
+    # rows this pass did not produce belong to stages a day no longer has
+    day_ts_query = {"$lt": today_dt.timestamp()}
+    if from_dt:
+        day_ts_query.update({"$gte": from_dt.timestamp()})
+    rollup_requests.append(
+        DeleteMany(
+            {"day_ts": day_ts_query, "refreshed_ts": {"$lt": now_dt.timestamp()}}
+        )
+    )
+    db.livechat_stats_rollup.bulk_write(rollup_requests, ordered=False)
+
+    db.livechat_session.update_many(
+        {"stats_dirty_ts": {"$lte": now_dt.timestamp()}},
+        {"$unset": {"stats_dirty_ts": ""}},
+    )
+
+
+def get_livechat_stats_for_windows(
+    lifecycle_stage=None,
+    windows: Dict[Text, Tuple] = None,
+):
+    """Returns the stats of each named (from_ts, to_ts) window.
+
+    All windows are answered by one rollup query plus at most one live
+    aggregation over today's sessions; windows must not overlap.
+    """
+    refresh_livechat_stats_rollups()
+
+    today_ts = get_day_start(datetime.now(tz=SERVER_TZINFO)).timestamp()
+
+    from_ts_list = [w[0] for w in windows.values()]
+    to_ts_list = [w[1] for w in windows.values()]
+    from_ts = None if None in from_ts_list else min(from_ts_list)
+    to_ts = None if None in to_ts_list else max(to_ts_list)
+
+    def is_in_window(ts, window):
+        window_from_ts, window_to_ts = window
+        return (not window_from_ts or ts >= window_from_ts) and (
+            not window_to_ts or ts < window_to_ts
+        )
+
+    # completed days come from the rollups, oldest first so that the latest
+    # header fields win when a user's days are merged
+    users = {name: [] for name in windows.keys()}
+    day_ts_query = {"$lt": min(to_ts, today_ts) if to_ts else today_ts}
+    if from_ts:
+        day_ts_query.update({"$gte": from_ts})
+    rollup_query = {"day_ts": day_ts_query}
+    if lifecycle_stage:
+        rollup_query.update({"lifecycle_stage": lifecycle_stage})
+    for row in db.livechat_stats_rollup.find(
+        rollup_query, sort=[("day_ts", ASCENDING)]
+    ):
+        for name, window in windows.items():
+            if is_in_window(row.get("day_ts"), window):
+                users[name].extend(row.get("users", []))
+
+    # today is aggregated live, bucketed into the windows in a single scan
+    if not to_ts or to_ts > today_ts:
+        live_users = aggregate_stats_users(
+            lifecycle_stage=lifecycle_stage,
+            from_ts=max(from_ts or today_ts, today_ts),
+            to_ts=to_ts,
+            bucket_query=get_window_bucket_query(windows),
+        )
+        for user in live_users:
+            bucket = user.get("bucket")
+            if bucket in users:
+                users[bucket].append(user)
+
+    return {name: get_stats_from_users(users[name]) for name in windows.keys()}
+
+
+def get_livechat_stats(
+    lifecycle_stage=None,
+    from_ts=None,
+    to_ts=None,
+):
+    return get_livechat_stats_for_windows(
+        lifecycle_stage=lifecycle_stage,
+        windows={"current": (from_ts, to_ts)},
+    )["current"]
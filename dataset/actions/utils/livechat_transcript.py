@@ -0,0 +1,122 @@
+from collections import OrderedDict
+import threading
+from typing import Any, Callable, Dict, Iterable, Text, Tuple
+
+# Telegram rejects messages longer than this many UTF-16 code units
+TELEGRAM_MESSAGE_MAX_LENGTH = 4096
+TRANSCRIPT_CACHE_SIZE = 256
+
+# livechat_id -> rendered transcript lines; an entry is reused while it holds the
+# livechat's num_messages messages and extended with only the new messages otherwise
+transcript_cache: "OrderedDict[Text, Dict[Text, Any]]" = OrderedDict()
+# transcripts are rendered from several threads; entries are replaced rather than
+# extended in place, so the lock only covers the cache itself
+transcript_cache_lock = threading.Lock()
+
+
+def get_text_length(text: Text) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def truncate_text(text: Text, max_length: int) -> Text:
+    if get_text_length(text) <= max_length:
+        return text
+    truncated = text.encode("utf-16-le")[: (max_length - 1) * 2]
+    return truncated.decode("utf-16-le", errors="ignore") + "…"
+
+
+def render_transcript_line(message: Dict[Text, Any]) -> Text:
+    sender_type = str(message.get("sender_type")).capitalize()
+    return f"{sender_type}: {message.get('text')}\n"
+
+
+def get_transcript(
+    livechat_id: Text,
+    num_messages: int,
+    get_new_messages: Callable[[int], Iterable[Dict[Text, Any]]],
+) -> Dict[Text, Any]:
+    """Returns the rendered transcript of a livechat.
+
+    `get_new_messages(from_seq)` returns the messages from `seq` number
+    `from_seq` on, in seq order; it is only called when the livechat has new
+    messages.
+    """
+    with transcript_cache_lock:
+        transcript = transcript_cache.get(livechat_id)
+    if transcript is None or transcript["num_messages"] > num_messages:
+        transcript = {
+            "num_messages": 0,
+            "lines": [],
+            "lengths": [],
+            "pages": {},
+        }
+
+    if transcript["num_messages"] < num_messages:
+        lines = list(transcript["lines"])
+        lengths = list(transcript["lengths"])
+        for message in get_new_messages(len(lines)):
+            # a message whose seq was taken but that is not stored yet leaves a
+            # gap; stop there so that the next call picks it up in order
+            if message.get("seq") != len(lines):
+                break
+            line = render_transcript_line(message)
+            lines.append(line)
+            lengths.append(get_text_length(line))
+        transcript = {
+            # counted from what was fetched: a message still being written when
+            # the header was read is picked up by the next call
+            "num_messages": len(lines),
+            "lines": lines,
+            "lengths": lengths,
+            # pages are counted back from the newest message, so they all shift
+            "pages": {},
+        }
+
+    with transcript_cache_lock:
+        cached = transcript_cache.get(livechat_id)
+        # a concurrent render may already have stored a newer transcript
+        if cached is None or cached["num_messages"] <= transcript["num_messages"]:
+            transcript_cache[livechat_id] = transcript
+        transcript_cache.move_to_end(livechat_id)
+        while len(transcript_cache) > TRANSCRIPT_CACHE_SIZE:
+            transcript_cache.popitem(last=False)
+    return transcript
+
+
+def get_page_start(lengths, end: int, max_length: int) -> int:
+    start, length = end, 0
+    while start > 0 and length + lengths[start - 1] <= max_length:
+        start -= 1
+        length += lengths[start]
+    # a single line longer than a page gets a page of its own and is truncated
+    return end - 1 if start == end and end > 0 else start
+
+
+def get_transcript_page(
+    transcript: Dict[Text, Any], page_index: int, max_length: int
+) -> Tuple[Text, int, bool]:
+    """Returns the text of the page, its index and whether older pages exist.
+
+    Page 0 is the newest tail of the transcript that fits in `max_length`; each
+    following page holds the messages right before the previous one. Indexes
+    past the oldest page return the oldest page.
+    """
+    cache_key = (page_index, max_length)
+    page = transcript["pages"].get(cache_key)
+    if page:
+        return page
+
+    lengths = transcript["lengths"]
+    end = len(lengths)
+    start = get_page_start(lengths, end, max_length)
+    index = 0
+    while index < page_index and start > 0:
+        end = start
+        start = get_page_start(lengths, end, max_length)
+        index += 1
+
+    text = truncate_text("".join(transcript["lines"][start:end]), max_length)
+    page = (text, index, start > 0)
+    # racing threads store the same page, so the unlocked write is harmless
+    transcript["pages"][cache_key] = page
+    return page
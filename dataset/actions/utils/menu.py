@@ -3,6 +3,28 @@ from dateutil.relativedelta import relativedelta
 
 from actions.utils.date import SERVER_TZINFO
 
+ONLINE_SELECTOR = "o"
+ALL_SELECTOR = "a"
+NEW_VISITOR_SELECTOR = "n"
+QUALIFIED_LEAD_SELECTOR = "q"
+UNQUALIFIED_SELECTOR = "u"
+
+SELECTOR_DISPLAY_NAME = {
+    ONLINE_SELECTOR: "Online",
+    ALL_SELECTOR: "All",
+    NEW_VISITOR_SELECTOR: "New Visitor",
+    QUALIFIED_LEAD_SELECTOR: "Qualified Lead",
+    UNQUALIFIED_SELECTOR: "Unqualified",
+}
+
+
+def get_chats_back_button(selector, page_index):
+    return {
+        "title": f"↩️ Back to {SELECTOR_DISPLAY_NAME[selector]} chats",
+        "payload": f'/chats{{"s":"{selector}","i":{page_index}}}',
+    }
+
+
 LIFECYCLE_SELECTOR_ALL = "a"
 LIFECYCLE_SELECTOR_QUALIFIED = "q"
 LIFECYCLE_SELECTOR_UNQUALIFIED = "u"
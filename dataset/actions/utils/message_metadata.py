@@ -1,13 +1,12 @@
 import logging
 from typing import Dict
 
+from actions.db.async_store import get_async_db
 from actions.db.store import db
 
 
 logger = logging.getLogger(__name__)
 
-db.message_metadata.create_index("message_id")
-
 
 def get_message_metadata(
     message_id,
@@ -15,6 +14,12 @@ def get_message_metadata(
     return db.message_metadata.find_one({"message_id": message_id})
 
 
+async def get_message_metadata_async(
+    message_id,
+):
+    return await get_async_db().message_metadata.find_one({"message_id": message_id})
+
+
 def update_message_metadata(
     message_id,
     metadata: Dict,
@@ -24,3 +29,21 @@ def update_message_metadata(
         {"$set": metadata},
         upsert=True,
     )
+
+
+async def update_message_metadata_async(
+    message_id,
+    metadata: Dict,
+):
+    await get_async_db().message_metadata.update_one(
+        {"message_id": message_id},
+        {"$set": metadata},
+        upsert=True,
+    )
+
+
+def get_live_card_metadata(livechat_id, min_ts):
+    return db.message_metadata.find_one(
+        {"livechat_id": livechat_id, "live_card_ts": {"$gte": min_ts}},
+        sort=[("live_card_ts", -1)],
+    )
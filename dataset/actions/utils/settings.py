@@ -0,0 +1,93 @@
+import logging
+import os
+import signal
+import threading
+import time
+from ruamel import yaml
+from typing import Dict, NamedTuple, Optional, Text
+
+logger = logging.getLogger(__name__)
+
+CREDENTIALS_PATH = "credentials.yml"
+TELEGRAM_CREDENTIALS_KEY = "connectors.telegram.TelegramInput"
+# how often get_settings looks at the credentials file for changes
+SETTINGS_CHECK_INTERVAL = 5.0
+
+
+class Settings(NamedTuple):
+    bot_token: Text = ""
+    host_url: Text = ""
+    livechat_client_base_url: Text = ""
+    rappo_env: Text = ""
+
+
+def get_credentials_mtime() -> Optional[float]:
+    try:
+        return os.stat(CREDENTIALS_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def load_settings() -> Settings:
+    telegram_credentials: Dict = {}
+    try:
+        with open(CREDENTIALS_PATH, "r") as stream:
+            credentials: Dict = yaml.safe_load(stream) or {}
+            telegram_credentials = credentials.get(TELEGRAM_CREDENTIALS_KEY) or {}
+    except Exception as exc:
+        logger.error(exc)
+
+    return Settings(
+        bot_token=telegram_credentials.get("access_token", ""),
+        host_url=telegram_credentials.get("host_url", ""),
+        livechat_client_base_url=os.environ.get("LIVECHAT_CLIENT_BASE_URL", ""),
+        rappo_env=os.environ.get("RAPPO_ENV", ""),
+    )
+
+
+settings_state = {
+    "settings": None,
+    "mtime": None,
+    "checked_ts": 0.0,
+    "reload_requested": False,
+}
+settings_lock = threading.Lock()
+
+
+def reload_settings():
+    with settings_lock:
+        settings_state["reload_requested"] = False
+        settings_state["mtime"] = get_credentials_mtime()
+        settings_state["checked_ts"] = time.monotonic()
+        settings_state["settings"] = load_settings()
+
+
+def get_settings() -> Settings:
+    """Returns the settings parsed from credentials.yml and the environment.
+
+    They are parsed once and reloaded when credentials.yml changes (checked at
+    most every SETTINGS_CHECK_INTERVAL seconds) or the process receives SIGHUP.
+    """
+    if settings_state["settings"] is None or settings_state["reload_requested"]:
+        reload_settings()
+    elif time.monotonic() - settings_state["checked_ts"] > SETTINGS_CHECK_INTERVAL:
+        settings_state["checked_ts"] = time.monotonic()
+        if get_credentials_mtime() != settings_state["mtime"]:
+            reload_settings()
+    return settings_state["settings"]
+
+
+def request_settings_reload(signum=None, frame=None):
+    # only flags the reload; parsing inside a signal handler is not safe
+    settings_state["reload_requested"] = True
+    if callable(previous_sighup_handler):
+        previous_sighup_handler(signum, frame)
+
+
+previous_sighup_handler = None
+try:
+    previous_sighup_handler = signal.getsignal(signal.SIGHUP)
+    signal.signal(signal.SIGHUP, request_settings_reload)
+except (AttributeError, ValueError):
+    # no SIGHUP on Windows, and handlers can only be set from the main thread
+    pass
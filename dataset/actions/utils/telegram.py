@@ -1,8 +1,7 @@
 import logging
-from ruamel import yaml
-from typing import Dict
 
 from actions.utils.json import get_json_key
+from actions.utils.settings import get_settings
 
 logger = logging.getLogger(__name__)
 
@@ -24,12 +23,4 @@ def get_user_id(metadata):
     )
 
 def get_bot_token():
-    with open("credentials.yml", "r") as stream:
-        try:
-            credentials: Dict = yaml.safe_load(stream)
-            telegram_credentials: Dict = credentials.get(
-                "connectors.telegram.TelegramInput", {}
-            )
-            return telegram_credentials.get("access_token", "")
-        except Exception as exc:
-            logger.error(exc)
+    return get_settings().bot_token
@@ -0,0 +1,86 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import logging
+from typing import Any, Dict, Text
+
+from rasa.core.channels.channel import OutputChannel
+from rasa_sdk import Action, Tracker
+from rasa_sdk.executor import CollectingDispatcher
+
+from actions.action_export import ActionExport
+from actions.action_list_chats import ActionListChats
+from actions.action_livechat_quick_response import ActionLivechatQuickResponse
+from actions.action_livechat_refresh import ActionLivechatRefresh
+from actions.action_livechat_tag import ActionLivechatTag
+from actions.action_stats import ActionStats
+from actions.utils.callback_data import parse_payload
+
+logger = logging.getLogger(__name__)
+
+
+class CommandRouter:
+    """Runs the actions behind inline button payloads in the connector process.
+
+    Button payloads are fixed commands that the keyword classifier and the rules
+    always map to the same action, so known commands skip NLU, the tracker and
+    the action server. Anything else is left to Rasa.
+    """
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self.actions: Dict[Text, Action] = {
+            "chats": ActionListChats(),
+            "export": ActionExport(),
+            "quick": ActionLivechatQuickResponse(),
+            "refresh": ActionLivechatRefresh(),
+            "stats": ActionStats(),
+            "tag": ActionLivechatTag(),
+        }
+        # the sync actions use pymongo, so they run off the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="command_router"
+        )
+
+    async def handle(
+        self,
+        text: Text,
+        output_channel: OutputChannel,
+        sender_id: Text,
+        metadata: Dict[Text, Any],
+    ) -> bool:
+        """Runs the action for `text`. Returns False if Rasa has to handle it."""
+        parsed = parse_payload(text)
+        action = parsed and self.actions.get(parsed[0])
+        if not action:
+            return False
+        command, entities = parsed
+
+        tracker = Tracker.from_dict(
+            {
+                "sender_id": sender_id,
+                "latest_message": {
+                    "text": text,
+                    "intent": {"name": command, "confidence": 1.0},
+                    "entities": [
+                        {"entity": k, "value": v} for k, v in entities.items()
+                    ],
+                    "metadata": metadata,
+                },
+            }
+        )
+        dispatcher = CollectingDispatcher()
+        if inspect.iscoroutinefunction(action.run):
+            # async actions only use motor on the loop and render cards through
+            # get_livechat_card_async, which runs pymongo on a worker thread
+            await action.run(dispatcher, tracker, {})
+        else:
+            await asyncio.get_event_loop().run_in_executor(
+                self.executor, action.run, dispatcher, tracker, {}
+            )
+
+        for message in dispatcher.messages:
+            await output_channel.send_response(sender_id, message)
+        return True
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
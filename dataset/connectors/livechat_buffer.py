@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Text
+
+from actions.utils.livechat import add_livechat_events_async, update_livechats_async
+
+logger = logging.getLogger(__name__)
+
+
+class LivechatUpdateBuffer:
+    """Write-behind buffer for the widget tracking webhooks.
+
+    Updates are accepted immediately, coalesced per user_id and written to Mongo
+    in bulk by a background task once `flush_size` updates are pending or every
+    `flush_interval` seconds. At most `max_size` updates are held; `put` waits up
+    to `put_timeout` seconds for a flush to make room and returns False otherwise.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 5000,
+        flush_size: int = 500,
+        flush_interval: float = 1.0,
+        put_timeout: float = 5.0,
+    ) -> None:
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        # user_id -> segments; an online change starts a new segment so that
+        # events stay attributed to the right session
+        self.pending: Dict[Text, List[Dict[Text, Any]]] = {}
+        self.pending_updates = 0
+        # pending plus in-flight updates; bounded by max_size
+        self.depth = 0
+
+        self.flush_task: Optional[asyncio.Task] = None
+        self.closing = False
+        self.flush_requested: Optional[asyncio.Event] = None
+        self.flush_lock: Optional[asyncio.Lock] = None
+        self.space_available: Optional[asyncio.Condition] = None
+
+        self.counters = {
+            "accepted": 0,
+            "rejected": 0,
+            "invalid": 0,
+            "max_depth": 0,
+            "flushes": 0,
+            "flushed_updates": 0,
+            "failed_updates": 0,
+            "last_flush_duration": 0.0,
+            "total_flush_duration": 0.0,
+        }
+
+    def start(self) -> None:
+        if self.flush_task:
+            return
+        self.closing = False
+        self.flush_requested = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.space_available = asyncio.Condition()
+        self.flush_task = asyncio.ensure_future(self.run())
+
+    async def close(self) -> None:
+        if not self.flush_task:
+            return
+        # let the running flush finish instead of cancelling it mid-write
+        self.closing = True
+        self.flush_requested.set()
+        await self.flush_task
+        await self.flush()
+        self.flush_task = None
+
+    async def put(
+        self,
+        user_id: Text,
+        event: Optional[Dict] = None,
+        online: Optional[bool] = None,
+        visible: Optional[bool] = None,
+    ) -> bool:
+        if not user_id:
+            # would be written to a livechat without a user
+            self.counters["invalid"] += 1
+            raise ValueError("user_id is required")
+
+        self.start()
+
+        if self.depth >= self.max_size:
+            self.flush_requested.set()
+            try:
+                async with self.space_available:
+                    await asyncio.wait_for(
+                        self.space_available.wait_for(
+                            lambda: self.depth < self.max_size
+                        ),
+                        self.put_timeout,
+                    )
+            except asyncio.TimeoutError:
+                self.counters["rejected"] += 1
+                return False
+
+        segments = self.pending.setdefault(user_id, [])
+        if online is not None or not segments:
+            segments.append({"online": online, "visible": None, "events": []})
+        segment = segments[-1]
+        if visible is not None:
+            segment["visible"] = visible
+        if event:
+            segment["events"].append(event)
+
+        self.pending_updates += 1
+        self.depth += 1
+        self.counters["accepted"] += 1
+        self.counters["max_depth"] = max(self.counters["max_depth"], self.depth)
+        if self.depth >= self.flush_size:
+            self.flush_requested.set()
+        return True
+
+    async def run(self) -> None:
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self.flush_lock:
+            self.flush_requested.clear()
+            if not self.pending:
+                return
+
+            pending, self.pending = self.pending, {}
+            num_updates, self.pending_updates = self.pending_updates, 0
+
+            start_time = time.monotonic()
+            try:
+                await self.write(pending)
+                self.counters["flushed_updates"] += num_updates
+            except Exception as e:
+                logger.error(f"Exception when flushing livechat updates.{e}")
+                self.counters["failed_updates"] += num_updates
+            flush_duration = time.monotonic() - start_time
+
+            self.counters["flushes"] += 1
+            self.counters["last_flush_duration"] = flush_duration
+            self.counters["total_flush_duration"] += flush_duration
+
+            async with self.space_available:
+                self.depth -= num_updates
+                self.space_available.notify_all()
+
+    @staticmethod
+    async def write(pending: Dict[Text, List[Dict[Text, Any]]]) -> None:
+        # the n-th segment of every user is written in round n, so online
+        # changes and the events that follow them keep their order
+        round_index = 0
+        while True:
+            segments = {
+                user_id: user_segments[round_index]
+                for user_id, user_segments in pending.items()
+                if len(user_segments) > round_index
+            }
+            if not segments:
+                break
+
+            updates = {
+                user_id: segment
+                for user_id, segment in segments.items()
+                if segment["online"] is not None or segment["visible"] is not None
+            }
+            if updates:
+                await update_livechats_async(updates)
+
+            events = [
+                {"user_id": user_id, "event": event}
+                for user_id, segment in segments.items()
+                for event in segment["events"]
+            ]
+            if events:
+                for status in await add_livechat_events_async(events):
+                    if status.get("status") != "ok":
+                        logger.error(
+                            f"Could not store livechat event. {status.get('error')}"
+                        )
+
+            round_index += 1
+
+    def stats(self) -> Dict[Text, Any]:
+        return {"depth": self.depth, **self.counters}
@@ -1,15 +1,16 @@
 import base64
-from copy import deepcopy
+from functools import partial
 from csv import excel
 from dotenv import load_dotenv
+import hashlib
+import hmac
 import json
 import logging
+import os
 from sanic import Blueprint, response
 from sanic.request import Request
 from sanic.response import HTTPResponse
-from telebot import TeleBot
 from telebot.types import (
-    BotCommand,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
@@ -28,29 +29,107 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-from actions.utils.admin_config import get_admin_group_id
-from actions.utils.livechat import get_livechat, update_livechat
-from actions.utils.message_metadata import update_message_metadata
+from actions.utils.admin_config import get_admin_group_id_async
+from actions.utils.callback_data import decode_callback_data, encode_callback_data
+from actions.utils.csv import is_export_file
+from actions.utils.dedup import (
+    claim_dedup_key_async,
+    claim_dedup_keys_async,
+    get_dedup_stats,
+    release_dedup_key_async,
+    release_dedup_keys_async,
+)
+from actions.utils.livechat import (
+    LIVECHAT_ENABLED_PROJECTION,
+    add_livechat_events_async,
+    get_livechat_async,
+    handle_livechat_message,
+    update_livechat_async,
+)
+from actions.utils.message_metadata import update_message_metadata_async
+from connectors.command_router import CommandRouter
+from connectors.livechat_buffer import LivechatUpdateBuffer
+from connectors.telegram_api import TelegramBotApi
+from connectors.telegram_send_queue import TelegramSendQueue
+from connectors.update_queue import TelegramUpdateQueue
 
 
 def get_query_param(params, key):
     return next(iter(params[key]), "")
 
 
+def get_livechat_dedup_key(request_dict) -> Optional[Text]:
+    # the widget sends the same event_id when it retries a post
+    if not isinstance(request_dict, dict):
+        return None
+    event_id = request_dict.get("event_id")
+    return f"livechat:{event_id}" if event_id else None
+
+
 def get_bot_link(bot_username):
     return "https://t.me/" + bot_username
 
 
-class TelegramOutput(TeleBot, OutputChannel):
-    """Output channel for Telegram."""
+def remove_document_file(document_file):
+    document_file.close()
+    os.remove(document_file.name)
+
+
+class TelegramOutput(OutputChannel):
+    """Output channel for Telegram.
+
+    Messages are sent through a pooled asyncio Bot API client so that sending
+    never blocks the event loop, and go out through a rate limited queue so that
+    bursts stay within Telegram's limits instead of failing.
+    """
 
     # skipcq: PYL-W0236
     @classmethod
     def name(cls) -> Text:
         return "telegram"
 
-    def __init__(self, access_token: Optional[Text]) -> None:
-        super().__init__(access_token)
+    def __init__(
+        self, access_token: Optional[Text], api_url: Optional[Text] = None
+    ) -> None:
+        self.token = access_token
+        self.api = TelegramBotApi(access_token, api_url)
+        self.send_queue = TelegramSendQueue(self.api)
+
+    @staticmethod
+    def get_api_params(params: Dict[Text, Any]) -> Dict[Text, Any]:
+        reply_markup = params.get("reply_markup")
+        if reply_markup is not None and not isinstance(reply_markup, dict):
+            params["reply_markup"] = json.loads(reply_markup.to_json())
+        return params
+
+    async def call_api(self, method: Text, **params: Any) -> Any:
+        return await self.api.call(method, self.get_api_params(params))
+
+    async def send(
+        self,
+        method: Text,
+        on_sent: Optional[Callable[[Any], Any]] = None,
+        on_done: Optional[Callable[[], None]] = None,
+        collapse_key: Optional[Text] = None,
+        debounce: float = 0.0,
+        **params: Any,
+    ) -> None:
+        if not await self.send_queue.put(
+            method,
+            self.get_api_params(params),
+            on_sent=on_sent,
+            on_done=on_done,
+            collapse_key=collapse_key,
+            delay=debounce,
+        ):
+            logger.error(f"Telegram send queue is full, dropping {method}.")
+
+    async def answer_callback_query(self, callback_query_id: Text) -> None:
+        await self.call_api("answerCallbackQuery", callback_query_id=callback_query_id)
+
+    async def close(self) -> None:
+        await self.send_queue.close()
+        await self.api.close()
 
     async def send_text_message(
         self,
@@ -60,7 +139,12 @@ class TelegramOutput(TeleBot, OutputChannel):
         **kwargs: Any,
     ) -> None:
         for message_part in text.strip().split("\n\n"):
-            self.send_message(recipient_id, message_part, reply_markup=reply_markup)
+            await self.send(
+                "sendMessage",
+                chat_id=recipient_id,
+                text=message_part,
+                reply_markup=reply_markup,
+            )
 
     async def send_image_url(
         self,
@@ -69,7 +153,9 @@ class TelegramOutput(TeleBot, OutputChannel):
         reply_markup=ReplyKeyboardRemove(),
         **kwargs: Any,
     ) -> None:
-        self.send_photo(recipient_id, image, reply_markup=reply_markup)
+        await self.send(
+            "sendPhoto", chat_id=recipient_id, photo=image, reply_markup=reply_markup
+        )
 
     async def send_text_with_buttons(
         self,
@@ -92,7 +178,9 @@ class TelegramOutput(TeleBot, OutputChannel):
         if button_type == "inline":
             reply_markup = InlineKeyboardMarkup()
             button_list = [
-                InlineKeyboardButton(s["title"], callback_data=s["payload"])
+                InlineKeyboardButton(
+                    s["title"], callback_data=encode_callback_data(s["payload"])
+                )
                 for s in buttons
             ]
             reply_markup.row(*button_list)
@@ -101,7 +189,9 @@ class TelegramOutput(TeleBot, OutputChannel):
             reply_markup = InlineKeyboardMarkup()
             [
                 reply_markup.row(
-                    InlineKeyboardButton(s["title"], callback_data=s["payload"])
+                    InlineKeyboardButton(
+                        s["title"], callback_data=encode_callback_data(s["payload"])
+                    )
                 )
                 for s in buttons
             ]
@@ -124,15 +214,28 @@ class TelegramOutput(TeleBot, OutputChannel):
             )
             return
 
-        self.send_message(recipient_id, text, reply_markup=reply_markup)
+        await self.send(
+            "sendMessage", chat_id=recipient_id, text=text, reply_markup=reply_markup
+        )
 
     async def send_custom_json(
         self, recipient_id: Text, json_message_arg: Dict[Text, Any], **kwargs: Any
     ) -> None:
+        document_file = None
         try:
-            json_message = deepcopy(json_message_arg)
+            # only top-level keys are popped below, so a shallow copy is enough
+            json_message = dict(json_message_arg)
+
+            # exports are spooled to disk by the action server and streamed from there
+            document_path = json_message.pop("document_path", None)
+            if document_path and is_export_file(document_path):
+                document_file = open(document_path, "rb")
+                json_message["document"] = document_path
 
             message_metadata = json_message.pop("message_metadata", {})
+            # lets repeated updates of one card cost a single Telegram call
+            collapse_key = json_message.pop("collapse_key", None)
+            debounce = json_message.pop("debounce", 0.0)
             reply_markup_json: Dict = json_message.pop("reply_markup", None)
             reply_markup = (
                 ReplyKeyboardRemove()
@@ -162,7 +265,9 @@ class TelegramOutput(TeleBot, OutputChannel):
                             *[
                                 InlineKeyboardButton(
                                     col.get("title"),
-                                    callback_data=col.get("payload"),
+                                    callback_data=encode_callback_data(
+                                        col.get("payload")
+                                    ),
                                     url=col.get("url"),
                                 )
                                 for col in row
@@ -171,28 +276,29 @@ class TelegramOutput(TeleBot, OutputChannel):
                         for row in reply_markup_json.get("keyboard", [])
                     ]
 
+            # Bot API methods keyed by their required parameters
             send_functions = {
-                ("from_chat_id", "message_id"): "copy_message",
+                ("from_chat_id", "message_id"): "copyMessage",
                 (
                     "text",
                     "chat_id",
                     "message_id",
-                ): "edit_message_text",
-                ("text",): "send_message",
-                ("photo",): "send_photo",
-                ("audio",): "send_audio",
-                ("document",): "send_document",
-                ("sticker",): "send_sticker",
-                ("video",): "send_video",
-                ("video_note",): "send_video_note",
-                ("animation",): "send_animation",
-                ("voice",): "send_voice",
-                ("media",): "send_media_group",
-                ("latitude", "longitude", "title", "address"): "send_venue",
-                ("latitude", "longitude"): "send_location",
-                ("phone_number", "first_name"): "send_contact",
-                ("game_short_name",): "send_game",
-                ("action",): "send_chat_action",
+                ): "editMessageText",
+                ("text",): "sendMessage",
+                ("photo",): "sendPhoto",
+                ("audio",): "sendAudio",
+                ("document",): "sendDocument",
+                ("sticker",): "sendSticker",
+                ("video",): "sendVideo",
+                ("video_note",): "sendVideoNote",
+                ("animation",): "sendAnimation",
+                ("voice",): "sendVoice",
+                ("media",): "sendMediaGroup",
+                ("latitude", "longitude", "title", "address"): "sendVenue",
+                ("latitude", "longitude"): "sendLocation",
+                ("phone_number", "first_name"): "sendContact",
+                ("game_short_name",): "sendGame",
+                ("action",): "sendChatAction",
                 (
                     "title",
                     "decription",
@@ -201,7 +307,7 @@ class TelegramOutput(TeleBot, OutputChannel):
                     "start_parameter",
                     "currency",
                     "prices",
-                ): "send_invoice",
+                ): "sendInvoice",
             }
 
             for params in send_functions.keys():
@@ -214,7 +320,9 @@ class TelegramOutput(TeleBot, OutputChannel):
                         document_file_name = json_message.pop(
                             "document_file_name", "document"
                         )
-                        if document_file_type == "application/zip":
+                        if document_file:
+                            document_bytes = document_file
+                        elif document_file_type == "application/zip":
                             document_bytes = base64.standard_b64decode(document)
                         else:
                             document_bytes = document.encode("utf-8")
@@ -223,29 +331,51 @@ class TelegramOutput(TeleBot, OutputChannel):
                             document_bytes,
                             document_file_type,
                         )
-                    args = [json_message.pop(p) for p in params]
+                    method = send_functions[params]
+                    api_params = {p: json_message.pop(p) for p in params}
                     if (
-                        send_functions[params]
+                        method
                         not in [
-                            "send_media_group",
-                            "send_game",
-                            "send_chat_action",
-                            "send_invoice",
+                            "sendMediaGroup",
+                            "sendGame",
+                            "sendChatAction",
+                            "sendInvoice",
                         ]
                         and reply_markup
                     ):
                         json_message["reply_markup"] = reply_markup
-                    api_call = getattr(self, send_functions[params])
-                    if send_functions[params] == "edit_message_text":
-                        response = api_call(*args, **json_message)
-                    else:
+                    if method != "editMessageText":
                         recipient_id = json_message.pop("chat_id", recipient_id)
-                        response = api_call(recipient_id, *args, **json_message)
-                    if message_metadata:
-                        update_message_metadata(response.message_id, message_metadata)
+                        api_params["chat_id"] = recipient_id
+                    on_done = None
+                    if document_file and "document" in api_params:
+                        # the queue owns the file from here on
+                        on_done = partial(remove_document_file, document_file)
+                        document_file = None
+                    await self.send(
+                        method,
+                        on_sent=partial(self.store_message_metadata, message_metadata),
+                        on_done=on_done,
+                        collapse_key=collapse_key,
+                        debounce=debounce,
+                        **api_params,
+                        **json_message,
+                    )
 
         except Exception as e:
             logger.error(e)
+        finally:
+            if document_file:
+                remove_document_file(document_file)
+
+    @staticmethod
+    async def store_message_metadata(
+        message_metadata: Dict[Text, Any], response: Any
+    ) -> None:
+        if message_metadata and isinstance(response, dict):
+            await update_message_metadata_async(
+                response.get("message_id"), message_metadata
+            )
 
 
 class TelegramInput(InputChannel):
@@ -266,6 +396,9 @@ class TelegramInput(InputChannel):
             credentials.get("webhook_url"),
             credentials.get("drop_pending_updates", "true").lower()
             in ["true", "1", "t"],
+            secret_token=credentials.get("secret_token"),
+            api_url=credentials.get("api_url"),
+            update_workers=int(credentials.get("update_workers", 8)),
         )
 
     def __init__(
@@ -275,12 +408,33 @@ class TelegramInput(InputChannel):
         webhook_url: Optional[Text],
         drop_pending_updates: Optional[bool] = True,
         debug_mode: bool = True,
+        secret_token: Optional[Text] = None,
+        api_url: Optional[Text] = None,
+        update_workers: int = 8,
     ) -> None:
         self.access_token = access_token
         self.verify = verify
         self.webhook_url = webhook_url
         self.drop_pending_updates = drop_pending_updates
         self.debug_mode = debug_mode
+        # lets the output channel talk to a local Bot API server instead
+        self.api_url = api_url
+        self.livechat_buffer = LivechatUpdateBuffer()
+        self.command_router = CommandRouter()
+        # updates are acknowledged before they are processed unless this is 0
+        self.update_queue = (
+            TelegramUpdateQueue(num_workers=update_workers) if update_workers else None
+        )
+
+        # Telegram echoes this in the X-Telegram-Bot-Api-Secret-Token header of
+        # every webhook call; derived from the bot token unless configured
+        self.secret_token = secret_token or (
+            hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+            if access_token
+            else None
+        )
+        self.output_channel: Optional[TelegramOutput] = None
+        self.bot_username: Optional[Text] = None
 
     @staticmethod
     def _get_message_type(message: Message) -> Text:
@@ -323,93 +477,152 @@ class TelegramInput(InputChannel):
     def _is_button(message: Update) -> bool:
         return message and (message.callback_query is not None)
 
+    @staticmethod
+    def _get_chat_id(update: Update) -> Optional[int]:
+        msg = (
+            update.callback_query.message
+            if update.callback_query
+            else update.message or update.edited_message
+        )
+        return msg and msg.chat and msg.chat.id
+
     def blueprint(
         self, on_new_message: Callable[[UserMessage], Awaitable[Any]]
     ) -> Blueprint:
         telegram_webhook = Blueprint("telegram_webhook", __name__)
         out_channel = self.get_output_channel()
 
+        @telegram_webhook.listener("after_server_start")
+        async def start_livechat_buffer(app, loop) -> None:
+            self.livechat_buffer.start()
+
+        @telegram_webhook.listener("before_server_stop")
+        async def flush_livechat_buffer(app, loop) -> None:
+            await self.livechat_buffer.close()
+            if self.update_queue:
+                await self.update_queue.close()
+            self.command_router.close()
+            await out_channel.close()
+
         @telegram_webhook.route("/", methods=["GET"])
         async def health(_: Request) -> HTTPResponse:
             return response.json({"status": "ok"})
 
+        @telegram_webhook.route("/metrics", methods=["GET"])
+        async def metrics(_: Request) -> HTTPResponse:
+            return response.json(
+                {
+                    "livechat_buffer": self.livechat_buffer.stats(),
+                    "telegram_send_queue": out_channel.send_queue.stats(),
+                    "telegram_update_queue": (
+                        self.update_queue.stats() if self.update_queue else None
+                    ),
+                    "dedup": get_dedup_stats(),
+                }
+            )
+
+        async def handle_update(update: Update, metadata: Dict[Text, Any]) -> None:
+            # failures propagate so that the update queue logs and counts them
+            disable_nlu_bypass = True
+            if self._is_button(update):
+                await out_channel.answer_callback_query(update.callback_query.id)
+                msg = update.callback_query.message
+                text = decode_callback_data(update.callback_query.data)
+                disable_nlu_bypass = False
+            elif self._is_edited_message(update):
+                # skip edited messages for now
+                # msg = update.edited_message
+                # text = update.edited_message.text
+                return
+            else:
+                msg = update.message
+                message_type = self._get_message_type(msg)
+                chat_type = self._get_chat_type(msg)
+                # skip channels
+                if chat_type not in ["private", "group", "supergroup"]:
+                    return
+                # ignore non-command and non-reply messages in a group
+                if chat_type in ["group", "supergroup"] and not (
+                    getattr(msg, "text", "").startswith("/")
+                    or getattr(msg, "reply_to_message", "")
+                ):
+                    return
+                if message_type == "text":
+                    text = msg.text
+                    if text and text.startswith("/"):
+                        text = text.replace(f"@{self.verify}", "")
+                elif message_type:
+                    text = json.dumps(metadata)
+                else:
+                    return
+                if getattr(msg, "reply_to_message"):
+                    text = "/livechat_reply"
+            sender_id = msg.chat.id
+            # button payloads of the admin commands are run in process
+            if not disable_nlu_bypass and await self.command_router.handle(
+                text, out_channel, str(sender_id), metadata
+            ):
+                return
+            if text == (INTENT_MESSAGE_PREFIX + USER_INTENT_RESTART):
+                await on_new_message(
+                    UserMessage(
+                        text,
+                        out_channel,
+                        sender_id,
+                        input_channel=self.name(),
+                        metadata=metadata,
+                    )
+                )
+                await on_new_message(
+                    UserMessage(
+                        "/start",
+                        out_channel,
+                        sender_id,
+                        input_channel=self.name(),
+                        metadata=metadata,
+                    )
+                )
+            else:
+                await on_new_message(
+                    UserMessage(
+                        text,
+                        out_channel,
+                        sender_id,
+                        input_channel=self.name(),
+                        metadata=metadata,
+                        disable_nlu_bypass=disable_nlu_bypass,
+                    )
+                )
+
         @telegram_webhook.route("/webhook", methods=["GET", "POST"])
         async def message(request: Request) -> Any:
             if request.method == "POST":
                 try:
-                    disable_nlu_bypass = True
                     request_dict = request.json
                     logger.info("INCOMING UPDATE: " + json.dumps(request_dict))
                     update = Update.de_json(request_dict)
-                    if not out_channel.get_me().username == self.verify:
+                    if not self._is_verified_request(request):
                         logger.debug("Invalid access token, check it matches Telegram")
                         return response.json({"status": "error"})
 
-                    if self._is_button(update):
-                        out_channel.answer_callback_query(update.callback_query.id)
-                        msg = update.callback_query.message
-                        text = update.callback_query.data
-                        disable_nlu_bypass = False
-                    elif self._is_edited_message(update):
-                        # skip edited messages for now
-                        # msg = update.edited_message
-                        # text = update.edited_message.text
+                    # Telegram redelivers updates it did not see acknowledged
+                    update_id = request_dict.get("update_id")
+                    dedup_key = f"telegram_update:{update_id}" if update_id else None
+                    if dedup_key and not await claim_dedup_key_async(dedup_key):
                         return response.json({"status": "ok"})
-                    else:
-                        msg = update.message
-                        message_type = self._get_message_type(msg)
-                        chat_type = self._get_chat_type(msg)
-                        # skip channels
-                        if chat_type not in ["private", "group", "supergroup"]:
-                            return response.json({"status": "ok"})
-                        # ignore non-command and non-reply messages in a group
-                        if chat_type in ["group", "supergroup"] and not (
-                            getattr(msg, "text", "").startswith("/")
-                            or getattr(msg, "reply_to_message", "")
-                        ):
-                            return response.json({"status": "ok"})
-                        if message_type == "text":
-                            text = msg.text
-                            if text and text.startswith("/"):
-                                text = text.replace(f"@{self.verify}", "")
-                        elif message_type:
-                            text = json.dumps(request_dict)
-                        else:
-                            return response.json({"status": "ok"})
-                        if getattr(msg, "reply_to_message"):
-                            text = "/livechat_reply"
-                    sender_id = msg.chat.id
-                    metadata = self.get_metadata(request) or {}
-                    if text == (INTENT_MESSAGE_PREFIX + USER_INTENT_RESTART):
-                        await on_new_message(
-                            UserMessage(
-                                text,
-                                out_channel,
-                                sender_id,
-                                input_channel=self.name(),
-                                metadata=metadata,
-                            )
-                        )
-                        await on_new_message(
-                            UserMessage(
-                                "/start",
-                                out_channel,
-                                sender_id,
-                                input_channel=self.name(),
-                                metadata=metadata,
-                            )
-                        )
-                    else:
-                        await on_new_message(
-                            UserMessage(
-                                text,
-                                out_channel,
-                                sender_id,
-                                input_channel=self.name(),
-                                metadata=metadata,
-                                disable_nlu_bypass=disable_nlu_bypass,
-                            )
-                        )
+
+                    handler = partial(
+                        handle_update, update, self.get_metadata(request) or {}
+                    )
+                    if not self.update_queue:
+                        await handler()
+                    elif not await self.update_queue.put(
+                        self._get_chat_id(update), handler
+                    ):
+                        # Telegram delivers the update again later
+                        if dedup_key:
+                            await release_dedup_key_async(dedup_key)
+                        return response.json({"status": "busy"}, status=503)
                 except Exception as e:
                     logger.error(f"Exception when trying to handle message.{e}")
                     logger.debug(e, exc_info=True)
@@ -419,23 +632,24 @@ class TelegramInput(InputChannel):
         @telegram_webhook.route("/livechat/message", methods=["POST"])
         async def livechat_message(request: Request) -> Any:
             if request.method == "POST":
+                dedup_key = None
                 try:
-                    request_dict = request.json
-                    sender_id = get_admin_group_id()
-                    disable_nlu_bypass = True
-                    await on_new_message(
-                        UserMessage(
-                            "/livechat_message",
-                            out_channel,
-                            sender_id,
-                            input_channel=self.name(),
-                            metadata=request_dict,
-                            disable_nlu_bypass=disable_nlu_bypass,
-                        )
+                    dedup_key = get_livechat_dedup_key(request.json)
+                    if dedup_key and not await claim_dedup_key_async(dedup_key):
+                        return response.json({"status": "ok"})
+                    # handled here rather than through Rasa, where every visitor's
+                    # messages would pile up in the admin group's tracker
+                    admin_group_id = await get_admin_group_id_async()
+                    json_message = await handle_livechat_message(
+                        request.json, admin_group_id
                     )
+                    if json_message and admin_group_id:
+                        await out_channel.send_custom_json(admin_group_id, json_message)
                 except Exception as e:
                     logger.error(f"Exception in chat_webhook.{e}")
                     logger.debug(e, exc_info=True)
+                    if dedup_key:
+                        await release_dedup_key_async(dedup_key)
 
                 return response.json({"status": "ok"})
 
@@ -445,7 +659,12 @@ class TelegramInput(InputChannel):
                 livechat = {}
                 try:
                     user_id = get_query_param(request.args, "user_id")
-                    livechat = get_livechat(user_id=user_id) or {}
+                    livechat = (
+                        await get_livechat_async(
+                            user_id=user_id, projection=LIVECHAT_ENABLED_PROJECTION
+                        )
+                        or {}
+                    )
                 except Exception as e:
                     logger.error(e)
 
@@ -455,7 +674,7 @@ class TelegramInput(InputChannel):
                 try:
                     user_id = request.json.get("user_id")
                     enabled = request.json.get("enabled")
-                    update_livechat(
+                    await update_livechat_async(
                         user_id=user_id,
                         enabled=enabled,
                     )
@@ -467,31 +686,92 @@ class TelegramInput(InputChannel):
         @telegram_webhook.route("/livechat/event", methods=["POST"])
         async def livechat_event(request: Request) -> Any:
             if request.method == "POST":
+                dedup_key = None
                 try:
+                    dedup_key = get_livechat_dedup_key(request.json)
+                    if dedup_key and not await claim_dedup_key_async(dedup_key):
+                        return response.json({"status": "ok"})
                     user_id = request.json.get("user_id")
                     event = request.json.get("event")
-                    update_livechat(
+                    if not await self.livechat_buffer.put(
                         user_id=user_id,
                         event=event,
-                    )
+                    ):
+                        if dedup_key:
+                            await release_dedup_key_async(dedup_key)
+                        return response.json({"status": "busy"}, status=503)
                 except Exception as e:
                     logger.error(e)
+                    if dedup_key:
+                        await release_dedup_key_async(dedup_key)
 
                 return response.json({"status": "ok"})
 
+        @telegram_webhook.route("/livechat/events", methods=["POST"])
+        async def livechat_events(request: Request) -> Any:
+            if request.method == "POST":
+                results = []
+                claimed_keys = {}
+                try:
+                    events = request.json.get("events") or []
+                    # index -> dedup key of the items the widget gave an event_id
+                    dedup_keys = {
+                        i: get_livechat_dedup_key(item)
+                        for i, item in enumerate(events)
+                        if isinstance(item, dict) and item.get("event_id")
+                    }
+                    claimed = await claim_dedup_keys_async(list(dedup_keys.values()))
+                    claimed_keys = {
+                        i: key
+                        for (i, key), is_new in zip(dedup_keys.items(), claimed)
+                        if is_new
+                    }
+                    new_indexes = [
+                        i
+                        for i in range(len(events))
+                        if i not in dedup_keys or i in claimed_keys
+                    ]
+                    statuses = await add_livechat_events_async(
+                        [events[i] for i in new_indexes]
+                    )
+                    results = [{"status": "ok", "duplicate": True} for _ in events]
+                    for i, status in zip(new_indexes, statuses):
+                        results[i] = status
+                        # let the widget's retry store what failed this time
+                        if status.get("status") == "ok":
+                            claimed_keys.pop(i, None)
+                except Exception as e:
+                    logger.error(f"Exception when storing livechat events.{e}")
+                    logger.debug(e, exc_info=True)
+                    # the batch is retried as a whole, so let all of it through again
+                    await release_dedup_keys_async(list(claimed_keys.values()))
+                    return response.json({"status": "error"}, status=500)
+                await release_dedup_keys_async(list(claimed_keys.values()))
+
+                return response.json({"status": "ok", "results": results})
+
         @telegram_webhook.route("/livechat/online", methods=["POST"])
         async def livechat_online(request: Request) -> Any:
             if request.method == "POST":
                 online = False
+                dedup_key = None
                 try:
+                    dedup_key = get_livechat_dedup_key(request.json)
+                    if dedup_key and not await claim_dedup_key_async(dedup_key):
+                        return response.json({"status": "ok"})
                     user_id = request.json.get("user_id")
                     online = request.json.get("online")
-                    update_livechat(
+                    if not await self.livechat_buffer.put(
                         user_id=user_id,
                         online=online,
-                    )
+                    ):
+                        if dedup_key:
+                            await release_dedup_key_async(dedup_key)
+                        return response.json({"status": "busy"}, status=503)
                 except Exception as e:
                     logger.error(e)
+                    if dedup_key:
+                        await release_dedup_key_async(dedup_key)
 
                 return response.json({"status": "ok"})
 
@@ -499,32 +779,67 @@ class TelegramInput(InputChannel):
         async def livechat_visible(request: Request) -> Any:
             if request.method == "POST":
                 visible = False
+                dedup_key = None
                 try:
+                    dedup_key = get_livechat_dedup_key(request.json)
+                    if dedup_key and not await claim_dedup_key_async(dedup_key):
+                        return response.json({"status": "ok"})
                     user_id = request.json.get("user_id")
                     visible = request.json.get("visible")
-                    update_livechat(
+                    if not await self.livechat_buffer.put(
                         user_id=user_id,
                         visible=visible,
-                    )
+                    ):
+                        if dedup_key:
+                            await release_dedup_key_async(dedup_key)
+                        return response.json({"status": "busy"}, status=503)
                 except Exception as e:
                     logger.error(e)
+                    if dedup_key:
+                        await release_dedup_key_async(dedup_key)
 
                 return response.json({"status": "ok"})
 
         return telegram_webhook
 
     def get_output_channel(self) -> TelegramOutput:
-        """Loads the telegram channel."""
-        channel = TelegramOutput(self.access_token)
-        channel.set_webhook(
-            url=self.webhook_url, drop_pending_updates=self.drop_pending_updates
+        """Loads the telegram channel.
+
+        The channel and the bot identity are resolved once and reused until the
+        access token changes.
+        """
+        if self.output_channel and self.output_channel.token == self.access_token:
+            return self.output_channel
+
+        channel = TelegramOutput(self.access_token, self.api_url)
+        # setup runs before the server's event loop, so these calls block
+        channel.api.call_sync(
+            "setWebhook",
+            {
+                "url": self.webhook_url,
+                "drop_pending_updates": self.drop_pending_updates,
+                "secret_token": self.secret_token,
+            },
         )
         commands = [
-            BotCommand("chats", "List chats"),
+            {"command": "chats", "description": "List chats"},
         ]
-        channel.set_my_commands(commands)
+        channel.api.call_sync("setMyCommands", {"commands": commands})
+
+        self.bot_username = channel.api.call_sync("getMe").get("username")
+        if self.bot_username != self.verify:
+            logger.error("Invalid access token, check it matches Telegram")
 
+        self.output_channel = channel
         return channel
 
+    def _is_verified_request(self, request: Request) -> bool:
+        if self.secret_token:
+            return hmac.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""),
+                self.secret_token,
+            )
+        return self.bot_username == self.verify
+
     def get_metadata(self, request: Request) -> Dict[Text, Any]:
         return request.json
@@ -0,0 +1,109 @@
+import aiohttp
+import json
+import logging
+import requests
+from typing import Any, Dict, Optional, Text
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+
+class TelegramApiError(Exception):
+    def __init__(
+        self,
+        method: Text,
+        error_code: Optional[int],
+        description: Optional[Text],
+        retry_after: Optional[int] = None,
+    ) -> None:
+        super().__init__(f"{method} failed with {error_code}: {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class TelegramBotApi:
+    """Asyncio client for the Telegram Bot API.
+
+    All calls share one keep-alive connection pool. Parameters are sent as JSON,
+    or as multipart form data when a file is attached as a
+    (file_name, bytes or file object, content_type) tuple.
+    """
+
+    def __init__(
+        self,
+        token: Text,
+        api_url: Optional[Text] = None,
+        pool_size: int = 100,
+        timeout: float = 30.0,
+    ) -> None:
+        self.token = token
+        self.api_url = api_url or TELEGRAM_API_URL
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def get_method_url(self, method: Text) -> Text:
+        return f"{self.api_url}/bot{self.token}/{method}"
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # created lazily so that it binds to the running event loop
+        if not self.session or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self) -> None:
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    @staticmethod
+    def get_form_data(params: Dict[Text, Any]) -> aiohttp.FormData:
+        form_data = aiohttp.FormData()
+        for key, value in params.items():
+            if isinstance(value, tuple):
+                file_name, file_content, content_type = value
+                form_data.add_field(
+                    key, file_content, filename=file_name, content_type=content_type
+                )
+            elif isinstance(value, (dict, list)):
+                form_data.add_field(key, json.dumps(value))
+            else:
+                form_data.add_field(key, str(value))
+        return form_data
+
+    @staticmethod
+    def get_result(method: Text, response_json: Dict[Text, Any]) -> Any:
+        if not response_json.get("ok"):
+            raise TelegramApiError(
+                method,
+                response_json.get("error_code"),
+                response_json.get("description"),
+                (response_json.get("parameters") or {}).get("retry_after"),
+            )
+        return response_json.get("result")
+
+    async def call(self, method: Text, params: Optional[Dict[Text, Any]] = None) -> Any:
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        has_files = any(isinstance(v, tuple) for v in params.values())
+        request_kwargs = (
+            {"data": self.get_form_data(params)} if has_files else {"json": params}
+        )
+        async with self.get_session().post(
+            self.get_method_url(method), **request_kwargs
+        ) as response:
+            response_json = await response.json(content_type=None)
+        return self.get_result(method, response_json)
+
+    def call_sync(self, method: Text, params: Optional[Dict[Text, Any]] = None) -> Any:
+        """Blocking variant for one-off setup calls made before the event loop runs."""
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        response = requests.post(
+            self.get_method_url(method), json=params, timeout=self.timeout
+        )
+        return self.get_result(method, response.json())
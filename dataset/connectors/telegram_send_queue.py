@@ -0,0 +1,356 @@
+import aiohttp
+import asyncio
+from collections import deque
+import inspect
+import logging
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Text
+
+from connectors.telegram_api import TelegramApiError, TelegramBotApi
+
+logger = logging.getLogger(__name__)
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30.0
+PRIVATE_CHAT_RATE = 1.0
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 20
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+def is_group_chat(chat_id: Any) -> bool:
+    # group and channel ids are negative; channels may also be addressed by @username
+    return str(chat_id).startswith(("-", "@"))
+
+
+def rewind_files(params: Dict[Text, Any]) -> None:
+    # a failed attempt may have read attached files to the end already
+    for value in params.values():
+        if isinstance(value, tuple) and hasattr(value[1], "seek"):
+            value[1].seek(0)
+
+
+class TelegramSendQueue:
+    """Rate limited outbound queue for Bot API calls.
+
+    Calls are queued per chat and sent in order, one at a time per chat, within
+    a per-chat and a global token bucket. A 429 pauses the chat for the
+    `retry_after` Telegram asks for and retries the call; a call that could not
+    connect is retried with a growing delay, any other failure is logged. A call
+    whose `collapse_key` matches a queued call replaces it; edits of the same
+    message collapse by default. A `delay` holds a call back for that long so
+    that the calls collapsing into it in the meantime cost one request. At most
+    `max_size` calls are held, further calls are dropped.
+    """
+
+    def __init__(
+        self,
+        api: TelegramBotApi,
+        max_size: int = 10000,
+        max_retries: int = 5,
+        retry_delay: float = 1.0,
+        close_timeout: float = 10.0,
+        max_idle_buckets: int = 1000,
+    ) -> None:
+        self.api = api
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.close_timeout = close_timeout
+        self.max_idle_buckets = max_idle_buckets
+
+        self.chats: Dict[Any, Deque[Dict[Text, Any]]] = {}
+        self.pending_collapses: Dict[Any, Dict[Text, Any]] = {}
+        self.delayed: List[Dict[Text, Any]] = []
+        self.in_flight: Set[Any] = set()
+        self.paused_until: Dict[Any, float] = {}
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.depth = 0
+
+        self.run_task: Optional[asyncio.Task] = None
+        self.send_tasks: Set[asyncio.Task] = set()
+        self.closing = False
+        self.wakeup: Optional[asyncio.Event] = None
+
+        self.counters = {
+            "queued": 0,
+            "sent": 0,
+            "collapsed": 0,
+            "throttled": 0,
+            "retried": 0,
+            "dropped": 0,
+            "failed": 0,
+            "not_modified": 0,
+            "callback_errors": 0,
+            "max_depth": 0,
+        }
+
+    def start(self) -> None:
+        if self.run_task:
+            return
+        self.closing = False
+        self.wakeup = asyncio.Event()
+        self.run_task = asyncio.ensure_future(self.run())
+
+    async def close(self) -> None:
+        if not self.run_task:
+            return
+        # give the queued calls a chance to go out before shutting down
+        self.closing = True
+        self.wakeup.set()
+        await self.run_task
+        if self.send_tasks:
+            await asyncio.gather(*self.send_tasks, return_exceptions=True)
+        self.run_task = None
+
+    async def put(
+        self,
+        method: Text,
+        params: Dict[Text, Any],
+        on_sent: Optional[Callable[[Any], Any]] = None,
+        on_done: Optional[Callable[[], None]] = None,
+        collapse_key: Optional[Any] = None,
+        delay: float = 0.0,
+    ) -> bool:
+        self.start()
+
+        chat_id = params.get("chat_id")
+        if (
+            not collapse_key
+            and method == "editMessageText"
+            and params.get("message_id")
+        ):
+            collapse_key = (chat_id, params.get("message_id"))
+        pending_item = (
+            self.pending_collapses.get(collapse_key) if collapse_key else None
+        )
+        if pending_item:
+            # only the latest content matters; a delayed call keeps its send time
+            # so that a steady stream of updates still goes out
+            pending_item["method"] = method
+            pending_item["params"] = params
+            pending_item["on_sent"] = on_sent or pending_item["on_sent"]
+            self.counters["collapsed"] += 1
+            if on_done:
+                on_done()
+            return True
+
+        if self.depth >= self.max_size:
+            self.counters["dropped"] += 1
+            if on_done:
+                on_done()
+            return False
+
+        item = {
+            "method": method,
+            "params": params,
+            "on_sent": on_sent,
+            "on_done": on_done,
+            "collapse_key": collapse_key,
+            "attempts": 0,
+            "not_before": time.monotonic() + delay,
+        }
+        if delay > 0:
+            self.delayed.append(item)
+        else:
+            self.chats.setdefault(chat_id, deque()).append(item)
+        if collapse_key:
+            self.pending_collapses[collapse_key] = item
+
+        self.depth += 1
+        self.counters["queued"] += 1
+        self.counters["max_depth"] = max(self.counters["max_depth"], self.depth)
+        self.wakeup.set()
+        return True
+
+    async def run(self) -> None:
+        deadline = None
+        while True:
+            if self.closing:
+                deadline = deadline or time.monotonic() + self.close_timeout
+                if not self.depth:
+                    break
+                if time.monotonic() > deadline:
+                    logger.error(f"Dropping {self.depth} queued Telegram calls.")
+                    break
+            self.wakeup.clear()
+            # with nothing queued, sleep until the next put
+            delay = self.dispatch() if self.depth else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if not bucket:
+            bucket = (
+                TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+                if is_group_chat(chat_id)
+                else TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            )
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def dispatch(self) -> float:
+        """Starts every call that may go out now; returns the time until the next one."""
+        now = time.monotonic()
+        next_delay = 1.0
+
+        delayed, self.delayed = self.delayed, []
+        for item in delayed:
+            if item["not_before"] <= now or self.closing:
+                chat_id = item["params"].get("chat_id")
+                self.chats.setdefault(chat_id, deque()).append(item)
+            else:
+                next_delay = min(next_delay, item["not_before"] - now)
+                self.delayed.append(item)
+
+        for chat_id in list(self.chats.keys()):
+            if chat_id in self.in_flight:
+                continue
+            chat_bucket = self.get_chat_bucket(chat_id)
+            wait_time = max(
+                self.paused_until.get(chat_id, 0.0) - now,
+                chat_bucket.wait_time(now),
+                self.global_bucket.wait_time(now),
+            )
+            if wait_time > 0:
+                next_delay = min(next_delay, wait_time)
+                continue
+
+            chat_bucket.take()
+            self.global_bucket.take()
+            self.paused_until.pop(chat_id, None)
+
+            # rotate the chat to the back so that busy chats do not starve others
+            queue = self.chats.pop(chat_id)
+            item = queue.popleft()
+            if queue:
+                self.chats[chat_id] = queue
+            if (
+                item["collapse_key"]
+                and self.pending_collapses.get(item["collapse_key"]) is item
+            ):
+                del self.pending_collapses[item["collapse_key"]]
+
+            self.in_flight.add(chat_id)
+            task = asyncio.ensure_future(self.send(chat_id, item))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+        if len(self.chat_buckets) > self.max_idle_buckets:
+            self.prune_buckets(now)
+        return next_delay
+
+    def prune_buckets(self, now: float) -> None:
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if (
+                chat_id not in self.chats
+                and chat_id not in self.in_flight
+                and bucket.is_full(now)
+            ):
+                del self.chat_buckets[chat_id]
+
+    def requeue(self, chat_id: Any, item: Dict[Text, Any], delay: float) -> bool:
+        self.paused_until[chat_id] = time.monotonic() + delay
+        if item["collapse_key"]:
+            if item["collapse_key"] in self.pending_collapses:
+                # a newer edit queued meanwhile already carries the latest text
+                self.counters["collapsed"] += 1
+                return False
+            self.pending_collapses[item["collapse_key"]] = item
+        item["attempts"] += 1
+        self.counters["retried"] += 1
+        rewind_files(item["params"])
+        self.chats.setdefault(chat_id, deque()).appendleft(item)
+        return True
+
+    async def send(self, chat_id: Any, item: Dict[Text, Any]) -> None:
+        requeued = False
+        try:
+            result = await self.api.call(item["method"], item["params"])
+            self.counters["sent"] += 1
+        except TelegramApiError as e:
+            if e.retry_after and item["attempts"] < self.max_retries:
+                self.counters["throttled"] += 1
+                requeued = self.requeue(chat_id, item, e.retry_after)
+            elif "message is not modified" in (e.description or ""):
+                # the message already shows this content
+                self.counters["not_modified"] += 1
+            else:
+                self.counters["failed"] += 1
+                logger.error(f"Telegram call {item['method']} failed. {e}")
+        except aiohttp.ClientConnectorError as e:
+            # the call never reached Telegram, so sending it again cannot duplicate it
+            if item["attempts"] < self.max_retries:
+                requeued = self.requeue(
+                    chat_id, item, self.retry_delay * (item["attempts"] + 1)
+                )
+            else:
+                self.counters["failed"] += 1
+                logger.error(f"Telegram call {item['method']} failed. {e}")
+        except Exception as e:
+            # a timeout or a dropped connection may come after Telegram acted on
+            # the call, and a bug fails the same way again; neither is retried
+            self.counters["failed"] += 1
+            logger.error(f"Telegram call {item['method']} failed. {e}")
+            logger.debug(e, exc_info=True)
+        else:
+            # outside the retried block: a failing callback must not resend
+            await self.run_on_sent(item, result)
+        finally:
+            self.in_flight.discard(chat_id)
+            if not requeued:
+                self.depth -= 1
+                if item["on_done"]:
+                    item["on_done"]()
+            self.wakeup.set()
+
+    async def run_on_sent(self, item: Dict[Text, Any], result: Any) -> None:
+        if not item["on_sent"]:
+            return
+        try:
+            on_sent_result = item["on_sent"](result)
+            if inspect.isawaitable(on_sent_result):
+                await on_sent_result
+        except Exception as e:
+            self.counters["callback_errors"] += 1
+            logger.error(f"Could not run on_sent for {item['method']}. {e}")
+            logger.debug(e, exc_info=True)
+
+    def stats(self) -> Dict[Text, Any]:
+        return {
+            "depth": self.depth,
+            "chats": len(self.chats),
+            "delayed": len(self.delayed),
+            "in_flight": len(self.in_flight),
+            "paused_chats": sum(
+                1 for t in self.paused_until.values() if t > time.monotonic()
+            ),
+            **self.counters,
+        }
@@ -0,0 +1,139 @@
+import asyncio
+from collections import deque
+import logging
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Text, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramUpdateQueue:
+    """Processes webhook updates on a pool of background workers.
+
+    Updates are accepted at once so that the webhook acknowledges Telegram before
+    the Rasa turn runs. The updates of one chat are processed one at a time in the
+    order they arrived, while up to `num_workers` chats are processed side by
+    side. At most `max_size` updates are held; `put` returns False when full.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 8,
+        max_size: int = 1000,
+        close_timeout: float = 10.0,
+    ) -> None:
+        self.num_workers = num_workers
+        self.max_size = max_size
+        self.close_timeout = close_timeout
+
+        # chat_id -> (enqueued_ts, handler) in arrival order; a chat is in here
+        # while it waits in `ready` or is being processed, never both at once
+        self.pending: Dict[Any, Deque[Tuple[float, Callable[[], Awaitable]]]] = {}
+        self.ready: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.depth = 0
+        self.busy_workers = 0
+        self.busy_time = 0.0
+        self.started_ts = 0.0
+        self.drained: Optional[asyncio.Event] = None
+
+        self.counters = {
+            "accepted": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed": 0,
+            "max_depth": 0,
+            "last_lag": 0.0,
+            "max_lag": 0.0,
+            "total_lag": 0.0,
+        }
+
+    def start(self) -> None:
+        if self.workers:
+            return
+        self.ready = asyncio.Queue()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.started_ts = time.monotonic()
+        self.workers = [
+            asyncio.ensure_future(self.run()) for _ in range(self.num_workers)
+        ]
+
+    async def close(self) -> None:
+        if not self.workers:
+            return
+        try:
+            await asyncio.wait_for(self.drained.wait(), self.close_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Dropping {self.depth} Telegram updates on close.")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def put(self, chat_id: Any, handler: Callable[[], Awaitable]) -> bool:
+        self.start()
+
+        if self.depth >= self.max_size:
+            self.counters["rejected"] += 1
+            return False
+
+        if chat_id not in self.pending:
+            self.pending[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        self.pending[chat_id].append((time.monotonic(), handler))
+
+        self.depth += 1
+        self.drained.clear()
+        self.counters["accepted"] += 1
+        self.counters["max_depth"] = max(self.counters["max_depth"], self.depth)
+        return True
+
+    async def run(self) -> None:
+        while True:
+            chat_id = await self.ready.get()
+            updates = self.pending[chat_id]
+            enqueued_ts, handler = updates.popleft()
+
+            start_time = time.monotonic()
+            lag = start_time - enqueued_ts
+            self.counters["last_lag"] = lag
+            self.counters["max_lag"] = max(self.counters["max_lag"], lag)
+            self.counters["total_lag"] += lag
+            self.busy_workers += 1
+            try:
+                await handler()
+                self.counters["processed"] += 1
+            except Exception as e:
+                logger.error(f"Exception when processing Telegram update.{e}")
+                logger.debug(e, exc_info=True)
+                self.counters["failed"] += 1
+            finally:
+                self.busy_workers -= 1
+                self.busy_time += time.monotonic() - start_time
+
+            # one update per turn, so a busy chat cannot hold a worker to itself
+            if updates:
+                self.ready.put_nowait(chat_id)
+            else:
+                del self.pending[chat_id]
+            self.depth -= 1
+            if not self.depth:
+                self.drained.set()
+
+    def stats(self) -> Dict[Text, Any]:
+        now = time.monotonic()
+        oldest_ts = min(
+            (updates[0][0] for updates in self.pending.values() if updates),
+            default=now,
+        )
+        worker_time = (now - self.started_ts) * self.num_workers if self.workers else 0
+        return {
+            "depth": self.depth,
+            "chats": len(self.pending),
+            "workers": len(self.workers),
+            "busy_workers": self.busy_workers,
+            "utilisation": self.busy_time / worker_time if worker_time else 0.0,
+            "lag": now - oldest_ts,
+            **self.counters,
+        }
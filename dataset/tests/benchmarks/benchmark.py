@@ -0,0 +1,93 @@
+import time
+
+from actions.utils.livechat import update_livechat
+
+
+def get_user_metadata(index):
+    # roughly what the widget reports for a desktop visitor
+    return {
+        "user_name": f"Visitor {index}",
+        "user_email": f"visitor{index}@example.com",
+        "lifecycle_stage": "subscriber",
+        "browser_data": {
+            "browserName": "Chrome",
+            "fullVersion": "96.0.4664.110",
+            "majorVersion": 96,
+            "appName": "Netscape",
+            "userAgent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 "
+            "Safari/537.36",
+        },
+        "wurfl_data": {
+            "complete_device_name": "Google Chrome",
+            "form_factor": "Desktop",
+            "is_mobile": False,
+        },
+        "location_data": {
+            "ip": f"203.0.113.{index % 256}",
+            "city": "Pune",
+            "region": "Maharashtra",
+            "country": "India",
+            "latitude": 18.5196,
+            "longitude": 73.8553,
+            "timezone": "Asia/Kolkata",
+        },
+        "referrer_data": {
+            "referrer": "https://www.google.com/",
+            "landing_page": "https://example.com/pricing?utm_source=google",
+        },
+    }
+
+
+def seed_livechats(num_livechats, num_messages):
+    for i in range(num_livechats):
+        user_id = f"user-{i}"
+        update_livechat(user_id, user_metadata=get_user_metadata(i))
+        for j in range(num_messages):
+            update_livechat(
+                user_id,
+                message={
+                    "sender_type": "user" if j % 2 else "admin",
+                    "text": f"Message {j} about pricing, installation and features.",
+                    "sent_ts": j,
+                },
+            )
+
+
+class SlowCollection:
+    def __init__(self, collection, latency) -> None:
+        self.collection = collection
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        def call(*args, **kwargs):
+            time.sleep(self.latency)
+            return method(*args, **kwargs)
+
+        return call
+
+
+class SlowDatabase:
+    """Database whose calls each take `latency` seconds, like a round trip to Mongo."""
+
+    def __init__(self, database, latency) -> None:
+        self.database = database
+        self.latency = latency
+
+    def __getitem__(self, name):
+        return SlowCollection(self.database[name], self.latency)
+
+    def __getattr__(self, name):
+        return SlowCollection(self.database[name], self.latency)
+
+
+def print_report(title, header, rows):
+    # shown with `pytest -s`
+    widths = [
+        max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))
+    ]
+    print(f"\n{title}")
+    for row in [header] + rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
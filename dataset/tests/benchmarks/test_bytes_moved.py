@@ -0,0 +1,69 @@
+import bson
+
+from actions.utils.livechat import (
+    LIVECHAT_CARD_HEADER_PROJECTION,
+    LIVECHAT_ENABLED_PROJECTION,
+    LIVECHAT_EXPORT_ROW_PROJECTION,
+    LIVECHAT_ID_PROJECTION,
+    LIVECHAT_LIST_ROW_PROJECTION,
+    LIVECHAT_MESSAGE_TRANSCRIPT_PROJECTION,
+    get_livechat,
+    get_livechat_messages,
+    get_livechats,
+)
+from benchmark import print_report, seed_livechats
+
+NUM_LIVECHATS = 20
+NUM_MESSAGES = 25
+PAGE_SIZE = 10
+
+
+def get_bytes(docs):
+    return sum(len(bson.encode(doc)) for doc in docs)
+
+
+def test_bytes_moved_per_action(db):
+    """Bytes each read path fetches from Mongo, without and with its projection."""
+    seed_livechats(NUM_LIVECHATS, NUM_MESSAGES)
+    livechat_id = db.livechat.find_one({})["_id"]
+
+    read_paths = {
+        "refresh/tag/quick/reply": lambda projection: [
+            get_livechat(id=livechat_id, projection=projection)
+        ],
+        "/livechat/enabled": lambda projection: [
+            get_livechat(user_id="user-0", projection=projection)
+        ],
+        "chats list page": lambda projection: get_livechats(
+            projection=projection, limit=PAGE_SIZE
+        ),
+        "card header": lambda projection: [
+            get_livechat(id=livechat_id, projection=projection)
+        ],
+        "card transcript": lambda projection: get_livechat_messages(
+            livechat_id, projection=projection
+        ),
+        "export": lambda projection: get_livechats(projection=projection),
+    }
+    projections = {
+        "refresh/tag/quick/reply": LIVECHAT_ID_PROJECTION,
+        "/livechat/enabled": LIVECHAT_ENABLED_PROJECTION,
+        "chats list page": LIVECHAT_LIST_ROW_PROJECTION,
+        "card header": LIVECHAT_CARD_HEADER_PROJECTION,
+        "card transcript": LIVECHAT_MESSAGE_TRANSCRIPT_PROJECTION,
+        "export": LIVECHAT_EXPORT_ROW_PROJECTION,
+    }
+
+    rows = []
+    for name, read in read_paths.items():
+        before = get_bytes(read(None))
+        after = get_bytes(read(projections[name]))
+        rows.append([name, before, after, f"{after / before:.0%}"])
+        assert after < before
+
+    print_report(
+        f"Bytes moved per action ({NUM_LIVECHATS} livechats, "
+        f"{NUM_MESSAGES} messages each)",
+        ["read path", "full documents", "projected", "ratio"],
+        rows,
+    )
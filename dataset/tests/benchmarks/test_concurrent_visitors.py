@@ -0,0 +1,129 @@
+import asyncio
+import time
+import uuid
+
+import bson
+
+import actions.utils.livechat
+from actions.utils.livechat import handle_livechat_message
+from benchmark import SlowDatabase, get_user_metadata, print_report
+
+ADMIN_GROUP_ID = "-100"
+LATENCY = 0.002
+NUM_MESSAGES = 3
+
+
+def get_body(visitor, index):
+    # what the widget posts to /livechat/message
+    return {
+        "sender_id": f"user-{visitor}",
+        "message_text": f"message {index}",
+        "user_metadata": get_user_metadata(visitor),
+    }
+
+
+def clear(db):
+    for name in db.list_collection_names():
+        db[name].delete_many({})
+
+
+async def handle_through_admin_tracker(async_db, lock, lock_waits, body):
+    # Rasa handles a message under the lock of its sender id, loads the whole
+    # tracker and appends the turn; every widget message used the admin group's
+    start_time = time.monotonic()
+    async with lock:
+        lock_waits.append(time.monotonic() - start_time)
+        await async_db.conversations.find_one({"sender_id": ADMIN_GROUP_ID})
+        await async_db.conversations.update_one(
+            {"sender_id": ADMIN_GROUP_ID},
+            {"$push": {"events": {"event": "user", "metadata": body}}},
+            upsert=True,
+        )
+        await handle_livechat_message(body, ADMIN_GROUP_ID)
+
+
+async def handle_in_connector(body):
+    await handle_livechat_message(body, ADMIN_GROUP_ID)
+
+
+def run_visitors(num_visitors, handle):
+    async def visit(visitor):
+        for i in range(NUM_MESSAGES):
+            await handle(get_body(visitor, i))
+
+    async def run():
+        start_time = time.monotonic()
+        await asyncio.gather(*[visit(v) for v in range(num_visitors)])
+        return time.monotonic() - start_time
+
+    return asyncio.run(run())
+
+
+def get_largest_document(collection):
+    return max(
+        (len(bson.encode(doc)) for doc in collection.find()),
+        default=0,
+    )
+
+
+def test_concurrent_visitors(db, async_db, monkeypatch):
+    """Widget messages through the admin group tracker vs the connector.
+
+    Rasa is not installed here, so the tracker path is modelled on what it
+    does per message: take the sender id's lock, load the tracker and push the
+    turn with the request body as metadata. Every Mongo call takes LATENCY.
+    """
+    async_db.database = SlowDatabase(db, LATENCY)
+    # pymongo 4 only encodes uuids with a configured representation; the 3.x the
+    # images install does it by default
+    monkeypatch.setattr(actions.utils.livechat, "uuid4", lambda: str(uuid.uuid4()))
+
+    rows = []
+    results = {}
+    for num_visitors in (10, 40):
+        lock_waits = []
+        lock = asyncio.Lock()
+
+        clear(db)
+        # the lock binds to the loop it is first used on
+        before_time = run_visitors(
+            num_visitors,
+            lambda body: handle_through_admin_tracker(async_db, lock, lock_waits, body),
+        )
+        tracker_bytes = get_largest_document(db.conversations)
+
+        clear(db)
+        after_time = run_visitors(num_visitors, handle_in_connector)
+        header_bytes = get_largest_document(db.livechat)
+
+        num_requests = num_visitors * NUM_MESSAGES
+        results[num_visitors] = (tracker_bytes, header_bytes, before_time, after_time)
+        rows.append(
+            [
+                num_visitors,
+                tracker_bytes,
+                header_bytes,
+                f"{sum(lock_waits) / num_requests * 1000:.0f}",
+                f"{num_requests / before_time:.0f}",
+                f"{num_requests / after_time:.0f}",
+            ]
+        )
+
+    print_report(
+        f"Concurrent visitors ({NUM_MESSAGES} messages each, "
+        f"{LATENCY * 1000:.0f} ms per Mongo call)",
+        [
+            "visitors",
+            "tracker bytes",
+            "largest header bytes",
+            "avg lock wait ms",
+            "tracker msgs/s",
+            "connector msgs/s",
+        ],
+        rows,
+    )
+
+    # the shared tracker grows with total traffic, a visitor's header does not
+    assert results[40][0] > 3 * results[10][0]
+    assert results[40][1] < 1.1 * results[10][1]
+    assert results[40][3] < results[40][2]
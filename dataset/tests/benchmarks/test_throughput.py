@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import actions.utils.livechat
+from actions.utils.livechat import update_livechat, update_livechat_async
+from benchmark import SlowDatabase, print_report
+
+# a Mongo round trip within one region
+LATENCY = 0.005
+NUM_REQUESTS = 40
+
+
+def get_message(index):
+    return {"sender_type": "user", "text": f"message {index}", "sent_ts": index}
+
+
+def test_concurrent_webhook_throughput(db, async_db, monkeypatch):
+    """Livechat writes per second from concurrent webhook handlers.
+
+    mongomock answers instantly, so every call is given a round trip of
+    LATENCY. The sync handlers call pymongo on the event loop, as the routes
+    did before the async data layer; the async ones await the same writes.
+    """
+    slow_db = SlowDatabase(db, LATENCY)
+    monkeypatch.setattr(actions.utils.livechat, "db", slow_db)
+    async_db.database = slow_db
+
+    async def handle_sync(index):
+        update_livechat(f"user-{index}", message=get_message(index))
+
+    async def handle_async(index):
+        await update_livechat_async(f"user-{index}", message=get_message(index))
+
+    async def run(handle):
+        start_time = time.monotonic()
+        await asyncio.gather(*[handle(i) for i in range(NUM_REQUESTS)])
+        return NUM_REQUESTS / (time.monotonic() - start_time)
+
+    sync_throughput = asyncio.run(run(handle_sync))
+    db.livechat.delete_many({})
+    db.livechat_message.delete_many({})
+    async_throughput = asyncio.run(run(handle_async))
+
+    print_report(
+        f"Webhook throughput ({NUM_REQUESTS} concurrent requests, "
+        f"{LATENCY * 1000:.0f} ms per Mongo call)",
+        ["data layer", "requests/s"],
+        [
+            ["sync (pymongo)", f"{sync_throughput:.0f}"],
+            ["async", f"{async_throughput:.0f}"],
+        ],
+    )
+    assert async_throughput > 2 * sync_throughput
@@ -0,0 +1,68 @@
+import asyncio
+from functools import partial
+from unittest import mock
+
+import mongomock
+import pytest
+
+# the actions connect to mongo-admin at import time; point them at mongomock
+with mongomock.patch(servers=(("mongo-admin", 27017),)), mock.patch(
+    "pymongo.database.Database", lambda client, name: client[name]
+):
+    from actions.db.store import db as actions_db
+
+
+class AsyncCursor:
+    def __init__(self, cursor) -> None:
+        self.cursor = cursor
+
+    async def to_list(self, length):
+        return list(self.cursor)
+
+
+class AsyncCollection:
+    """Motor-like collection that runs each call on a worker thread, as motor does."""
+
+    def __init__(self, collection) -> None:
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def run(*args, **kwargs):
+            return await asyncio.get_event_loop().run_in_executor(
+                None, partial(method, *args, **kwargs)
+            )
+
+        return run
+
+
+class AsyncDatabase:
+    def __init__(self, database) -> None:
+        self.database = database
+
+    def __getitem__(self, name):
+        return AsyncCollection(self.database[name])
+
+    def __getattr__(self, name):
+        return AsyncCollection(self.database[name])
+
+
+@pytest.fixture
+def db():
+    # keep the collections and their indexes, only drop the documents
+    for name in actions_db.list_collection_names():
+        actions_db[name].delete_many({})
+    return actions_db
+
+
+@pytest.fixture
+def async_db(db, monkeypatch):
+    import actions.utils.livechat
+
+    async_db = AsyncDatabase(db)
+    monkeypatch.setattr(actions.utils.livechat, "get_async_db", lambda: async_db)
+    return async_db
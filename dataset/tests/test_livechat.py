@@ -0,0 +1,156 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo.errors import DuplicateKeyError
+
+from actions.utils.callback_data import encode_callback_data
+from actions.utils.livechat import (
+    get_card_livechat_ids,
+    get_livechat_messages,
+    update_livechat,
+    update_livechat_async,
+)
+from actions.utils.livechat_transcript import get_transcript
+
+NUM_WRITERS = 8
+
+
+def get_message(index):
+    return {"sender_type": "user", "text": f"message {index}", "sent_ts": index}
+
+
+def assert_single_livechat(db, user_id, num_updates):
+    assert db.livechat.count_documents({"user_id": user_id}) == 1
+    livechat = db.livechat.find_one({"user_id": user_id})
+    assert livechat["version"] == num_updates
+    assert livechat["num_messages"] == num_updates
+    assert (
+        db.livechat_message.count_documents({"livechat_id": livechat["_id"]})
+        == num_updates
+    )
+
+
+def insert_before_first_write(collection, user_id, monkeypatch):
+    """Makes the first find_one_and_update lose the upsert race to another writer."""
+    find_one_and_update = collection.find_one_and_update
+    calls = []
+
+    def racing_find_one_and_update(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            collection.insert_one({"user_id": user_id, "version": 1})
+            raise DuplicateKeyError("E11000 duplicate key error")
+        return find_one_and_update(*args, **kwargs)
+
+    monkeypatch.setattr(collection, "find_one_and_update", racing_find_one_and_update)
+    return calls
+
+
+def test_update_livechat_concurrent_first_writes(db):
+    with ThreadPoolExecutor(max_workers=NUM_WRITERS) as executor:
+        list(
+            executor.map(
+                lambda i: update_livechat("user", message=get_message(i)),
+                range(NUM_WRITERS),
+            )
+        )
+
+    assert_single_livechat(db, "user", NUM_WRITERS)
+
+
+def test_update_livechat_retries_after_duplicate_key(db, monkeypatch):
+    calls = insert_before_first_write(db.livechat, "user", monkeypatch)
+
+    update_livechat("user", message=get_message(0))
+
+    assert len(calls) == 2
+    assert db.livechat.count_documents({"user_id": "user"}) == 1
+    livechat = db.livechat.find_one({"user_id": "user"})
+    assert livechat["version"] == 2
+    assert livechat["num_messages"] == 1
+
+
+def test_update_livechat_async_concurrent_first_writes(db, async_db):
+    async def write_all():
+        await asyncio.gather(
+            *[
+                update_livechat_async("user", message=get_message(i))
+                for i in range(NUM_WRITERS)
+            ]
+        )
+
+    asyncio.run(write_all())
+
+    assert_single_livechat(db, "user", NUM_WRITERS)
+
+
+def test_update_livechat_async_retries_after_duplicate_key(db, async_db, monkeypatch):
+    calls = insert_before_first_write(db.livechat, "user", monkeypatch)
+
+    asyncio.run(update_livechat_async("user", message=get_message(0)))
+
+    assert len(calls) == 2
+    assert db.livechat.count_documents({"user_id": "user"}) == 1
+    assert db.livechat.find_one({"user_id": "user"})["version"] == 2
+
+
+def test_messages_are_numbered_in_write_order(db):
+    for i in range(3):
+        update_livechat("user", message=get_message(i))
+
+    livechat = db.livechat.find_one({"user_id": "user"})
+    assert [m["text"] for m in get_livechat_messages(livechat["_id"])] == [
+        "message 0",
+        "message 1",
+        "message 2",
+    ]
+    assert [m["seq"] for m in get_livechat_messages(livechat["_id"], from_seq=1)] == [
+        1,
+        2,
+    ]
+
+
+def test_transcript_waits_for_a_message_that_is_not_stored_yet(db):
+    livechat_id = "livechat"
+    messages = [{"sender_type": "user", "text": str(i), "seq": i} for i in range(3)]
+    stored = [messages[0], messages[2]]
+
+    def get_new_messages(from_seq):
+        return sorted(
+            (m for m in stored if m["seq"] >= from_seq), key=lambda m: m["seq"]
+        )
+
+    transcript = get_transcript(livechat_id, 3, get_new_messages)
+    assert transcript["lines"] == ["User: 0\n"]
+
+    stored.append(messages[1])
+    transcript = get_transcript(livechat_id, 3, get_new_messages)
+    assert transcript["lines"] == ["User: 0\n", "User: 1\n", "User: 2\n"]
+
+
+def get_keyboard_message(payloads):
+    return {
+        "reply_markup": {
+            "inline_keyboard": [
+                [{"text": p, "callback_data": encode_callback_data(p)}]
+                for p in payloads
+            ]
+        }
+    }
+
+
+def test_card_livechat_ids_come_from_card_buttons_only():
+    livechat_id = "0123456789abcdef01234567"
+    card = get_keyboard_message(
+        [
+            f'/refresh{{"c":"{livechat_id}"}}',
+            f'/quick{{"c":"{livechat_id}","d":"greet"}}',
+            '/chats{"s":"a","i":0}',
+        ]
+    )
+    chats_list = get_keyboard_message(
+        [f'/chats{{"p":"a","c":"{i:024x}","b":0}}' for i in range(3)]
+    )
+
+    assert get_card_livechat_ids(card) == {livechat_id}
+    assert get_card_livechat_ids(chats_list) == set()
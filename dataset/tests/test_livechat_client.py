@@ -0,0 +1,78 @@
+import random
+import threading
+import time
+from unittest import mock
+
+import pytest
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from actions.utils.livechat_client import LivechatClient
+
+
+class FakeSession:
+    """requests session that answers each post with the next queued response."""
+
+    def __init__(self, *responses) -> None:
+        self.responses = list(responses)
+        self.posts = []
+        self.lock = threading.Lock()
+
+    def post(self, url, json=None, timeout=None):
+        # uneven latencies would reorder posts that are sent concurrently
+        time.sleep(random.uniform(0, 0.01))
+        with self.lock:
+            self.posts.append(json)
+            response = self.responses.pop(0) if self.responses else 200
+        if isinstance(response, Exception):
+            raise response
+        return mock.Mock(status_code=response, json=lambda: {"ok": True})
+
+
+def get_client(session):
+    client = LivechatClient(backoff_base=0)
+    client.session = session
+    return client
+
+
+def get_connect_error():
+    return requests.ConnectionError(
+        mock.Mock(reason=NewConnectionError(None, "refused"))
+    )
+
+
+def test_background_posts_keep_their_order_per_key():
+    session = FakeSession()
+    client = get_client(session)
+
+    futures = [
+        client.post_in_background("/livechat/message", {"user": u, "i": i}, key=u)
+        for i in range(20)
+        for u in ("a", "b", "c")
+    ]
+    for future in futures:
+        assert future.result(timeout=5) == {"ok": True}
+
+    for u in ("a", "b", "c"):
+        assert [p["i"] for p in session.posts if p["user"] == u] == list(range(20))
+    assert client.pending == {}
+
+
+def test_connect_errors_are_retried():
+    session = FakeSession(get_connect_error(), 200)
+    client = get_client(session)
+
+    assert client.post("/livechat/message", {}) == {"ok": True}
+    assert len(session.posts) == 2
+    assert client.stats()["retried"] == 1
+
+
+@pytest.mark.parametrize("response", [503, requests.ReadTimeout()])
+def test_posts_that_may_have_arrived_are_not_retried(response):
+    session = FakeSession(response, 200)
+    client = get_client(session)
+
+    with pytest.raises(Exception):
+        client.post("/livechat/message", {})
+    assert len(session.posts) == 1
+    assert client.stats()["failed"] == 1
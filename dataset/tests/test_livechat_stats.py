@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import actions.utils.livechat_stats
+from actions.utils.date import SERVER_TZINFO
+from actions.utils.livechat_stats import (
+    get_day_start,
+    get_livechat_stats_for_windows,
+    get_stats_from_users,
+)
+
+
+def get_user(livechat_id, day, **kwargs):
+    return {
+        "bucket": day,
+        "livechat_id": livechat_id,
+        "lifecycle_stage": "subscriber",
+        "new": False,
+        "sessions": 1,
+        "session_duration": 10,
+        "event_labels": [],
+        "lists": {"cities": "Pune"},
+        **kwargs,
+    }
+
+
+def test_users_are_counted_once_across_days():
+    livechat_stats = get_stats_from_users(
+        [
+            get_user("a", "2021-01-01", new=True, event_labels=["/pricing"]),
+            get_user("a", "2021-01-02", event_labels=["/pricing", "/about"]),
+            get_user("b", "2021-01-02", lists={"cities": "Delhi"}),
+        ]
+    )
+
+    funnel = livechat_stats["funnel"]
+    assert funnel["total_users"] == 2
+    assert funnel["new_users"] == 1
+    assert funnel["returning_users"] == 1
+    assert funnel["pricing"] == 1
+    assert funnel["about"] == 1
+    assert livechat_stats["averages"]["sessions_per_user"] == 1.5
+    assert livechat_stats["lists"]["cities"] == {
+        "total": 2,
+        "top": [("Pune", 1), ("Delhi", 1)],
+    }
+
+
+def test_multi_day_window_from_rollups(db, monkeypatch):
+    # mongomock cannot run the stats pipeline; hand the rollups their users
+    today_dt = get_day_start(datetime.now(tz=SERVER_TZINFO))
+    days = [(today_dt - timedelta(days=i)).strftime("%Y-%m-%d") for i in (3, 2, 1)]
+    users = [get_user("a", day, lifecycle_stage="lead") for day in days]
+    users.append(get_user("b", days[-1]))
+
+    def aggregate_stats_users(lifecycle_stage=None, from_ts=None, **kwargs):
+        return [] if from_ts == today_dt.timestamp() else users
+
+    monkeypatch.setattr(
+        actions.utils.livechat_stats, "aggregate_stats_users", aggregate_stats_users
+    )
+
+    windows = {"current": ((today_dt - timedelta(days=7)).timestamp(), None)}
+    funnel = get_livechat_stats_for_windows(windows=windows)["current"]["funnel"]
+
+    assert db.livechat_stats_rollup.count_documents({}) == 4
+    assert funnel["total_users"] == 2
+    assert funnel["qualified_lead"] == 1
+    assert funnel["untagged"] == 1
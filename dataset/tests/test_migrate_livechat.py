@@ -0,0 +1,86 @@
+from actions.db.migrate_livechat import backfill_message_seq, migrate_livechats
+from actions.utils.livechat import get_livechat_messages, update_livechat
+
+
+def insert_unmigrated_livechat(db):
+    return db.livechat.insert_one(
+        {
+            "user_id": "user",
+            "messages": [
+                {"sender_type": "user", "text": "old 0"},
+                {"sender_type": "admin", "text": "old 1"},
+            ],
+            "events": [{"label": "/pricing", "session_index": 0}],
+            "sessions": [{"index": 0, "start_ts": 1, "duration_ts": 5}],
+        }
+    ).inserted_id
+
+
+def test_migration_keeps_rows_written_before_it(db):
+    livechat_id = insert_unmigrated_livechat(db)
+    # the new version starts writing before the migration runs
+    update_livechat(
+        "user",
+        online=True,
+        message={"sender_type": "user", "text": "new 0"},
+        event={"label": "/features"},
+    )
+
+    assert migrate_livechats() == 1
+
+    livechat = db.livechat.find_one({"_id": livechat_id})
+    assert "messages" not in livechat
+    assert livechat["num_sessions"] == 2
+    assert livechat["num_messages"] == 3
+    assert [m["text"] for m in get_livechat_messages(livechat_id)] == [
+        "old 0",
+        "old 1",
+        "new 0",
+    ]
+    sessions = list(db.livechat_session.find({"livechat_id": livechat_id}))
+    assert sorted((s["index"], s["start_ts"] == 1) for s in sessions) == [
+        (0, True),
+        (1, False),
+    ]
+    events = db.livechat_event.find({"livechat_id": livechat_id})
+    assert sorted((e["label"], e["session_index"]) for e in events) == [
+        ("/features", 1),
+        ("/pricing", 0),
+    ]
+
+    # the next session and message follow the migrated ones
+    update_livechat(
+        "user", online=True, message={"sender_type": "user", "text": "new 1"}
+    )
+    assert db.livechat_session.count_documents({"livechat_id": livechat_id}) == 3
+    assert [m["seq"] for m in get_livechat_messages(livechat_id)] == [0, 1, 2, 3]
+
+
+def test_migration_can_be_re_run(db):
+    livechat_id = insert_unmigrated_livechat(db)
+    update_livechat("user", message={"sender_type": "user", "text": "new 0"})
+    migrate_livechats()
+    # as if the run had stopped before clearing the arrays
+    db.livechat.update_one(
+        {"_id": livechat_id},
+        {"$set": {"messages": [{"text": "old 0"}, {"text": "old 1"}]}},
+    )
+
+    migrate_livechats()
+
+    assert [m["text"] for m in get_livechat_messages(livechat_id)] == [
+        "old 0",
+        "old 1",
+        "new 0",
+    ]
+
+
+def test_backfill_message_seq(db):
+    db.livechat_message.insert_many(
+        [{"livechat_id": "livechat", "text": str(i)} for i in range(3)]
+    )
+
+    backfill_message_seq()
+
+    assert [m["text"] for m in get_livechat_messages("livechat")] == ["0", "1", "2"]
+    assert [m["seq"] for m in get_livechat_messages("livechat")] == [0, 1, 2]
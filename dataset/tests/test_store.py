@@ -0,0 +1,15 @@
+from actions.db.store import reset_actions_db
+
+
+def test_reset_actions_db_recreates_indexes(db):
+    db.livechat.insert_one({"user_id": "user"})
+
+    reset_actions_db()
+
+    assert db.livechat.count_documents({}) == 0
+    assert db.livechat.index_information()["user_id_1"]["unique"]
+    assert db.livechat_session.index_information()["livechat_id_1_index_1"]["unique"]
+    assert "expireAfterSeconds" in db.dedup_key.index_information()["created_at_1"]
+    assert (
+        "expireAfterSeconds" in db.message_metadata.index_information()["expire_at_1"]
+    )
@@ -0,0 +1,163 @@
+import asyncio
+import io
+
+from aiohttp import web
+import pytest
+
+from connectors.telegram_api import TelegramApiError, TelegramBotApi
+
+TOKEN = "123:abc"
+
+
+class FakeBotApi:
+    """Bot API server that records the requests it gets and replies as configured."""
+
+    def __init__(self) -> None:
+        self.requests = []
+        self.responses = {}
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "multipart/form-data":
+            params = {}
+            async for part in await request.multipart():
+                params[part.name] = (
+                    (part.filename, await part.read())
+                    if part.filename
+                    else await part.text()
+                )
+        else:
+            params = await request.json()
+        self.requests.append(
+            {"token": request.match_info["token"], "method": method, "params": params}
+        )
+        return web.json_response(
+            self.responses.get(method, {"ok": True, "result": True})
+        )
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def close(self) -> None:
+        await self.runner.cleanup()
+
+
+def run_with_api(test):
+    async def run():
+        server = FakeBotApi()
+        await server.start()
+        api = TelegramBotApi(TOKEN, api_url=server.url)
+        try:
+            await test(server, api)
+        finally:
+            await api.close()
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_call_sends_json_and_returns_result():
+    async def test(server, api):
+        server.responses["sendMessage"] = {"ok": True, "result": {"message_id": 7}}
+
+        result = await api.call(
+            "sendMessage",
+            {
+                "chat_id": 1,
+                "text": "hi",
+                "reply_markup": {"inline_keyboard": []},
+                "parse_mode": None,
+            },
+        )
+
+        assert result == {"message_id": 7}
+        assert server.requests == [
+            {
+                "token": TOKEN,
+                "method": "sendMessage",
+                "params": {
+                    "chat_id": 1,
+                    "text": "hi",
+                    "reply_markup": {"inline_keyboard": []},
+                },
+            }
+        ]
+
+    run_with_api(test)
+
+
+def test_call_raises_api_errors_with_retry_after():
+    async def test(server, api):
+        server.responses["sendMessage"] = {
+            "ok": False,
+            "error_code": 429,
+            "description": "Too Many Requests: retry after 3",
+            "parameters": {"retry_after": 3},
+        }
+
+        with pytest.raises(TelegramApiError) as e:
+            await api.call("sendMessage", {"chat_id": 1, "text": "hi"})
+
+        assert e.value.method == "sendMessage"
+        assert e.value.error_code == 429
+        assert e.value.retry_after == 3
+
+    run_with_api(test)
+
+
+def test_call_sends_files_as_form_data():
+    async def test(server, api):
+        await api.call(
+            "sendDocument",
+            {
+                "chat_id": 1,
+                "caption": "users",
+                "reply_markup": {"inline_keyboard": []},
+                "document": ("users.csv", io.BytesIO(b"a,b\n"), "text/csv"),
+            },
+        )
+
+        assert server.requests[0]["params"] == {
+            "chat_id": "1",
+            "caption": "users",
+            "reply_markup": '{"inline_keyboard": []}',
+            "document": ("users.csv", b"a,b\n"),
+        }
+
+    run_with_api(test)
+
+
+def test_calls_share_one_session():
+    async def test(server, api):
+        session = api.get_session()
+        await asyncio.gather(
+            *[api.call("sendMessage", {"chat_id": i, "text": "hi"}) for i in range(5)]
+        )
+
+        assert api.get_session() is session
+        assert len(server.requests) == 5
+
+    run_with_api(test)
+
+
+def test_call_sync():
+    async def test(server, api):
+        server.responses["setWebhook"] = {"ok": True, "result": True}
+
+        result = await asyncio.get_event_loop().run_in_executor(
+            None, api.call_sync, "setWebhook", {"url": "https://example.com"}
+        )
+
+        assert result is True
+        assert server.requests[0]["params"] == {"url": "https://example.com"}
+
+    run_with_api(test)
@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+import pytest
+
+# the connector runs inside the Rasa server image
+pytest.importorskip("rasa")
+pytest.importorskip("rasa_sdk")
+pytest.importorskip("sanic")
+pytest.importorskip("telebot")
+
+from actions.utils.callback_data import encode_callback_data
+from actions.utils.csv import write_csv_file
+from connectors.telegram import TelegramOutput
+from test_telegram_api import TOKEN, FakeBotApi
+
+
+def run_with_output(test):
+    async def run():
+        server = FakeBotApi()
+        await server.start()
+        output = TelegramOutput(TOKEN, api_url=server.url)
+        try:
+            await test(server, output)
+        finally:
+            await output.close()
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_document_path_is_uploaded_and_removed():
+    path = write_csv_file(["a,b"])
+
+    async def test(server, output):
+        await output.send_custom_json(
+            "1",
+            {
+                "document_path": path,
+                "document_file_name": "users.csv",
+                "document_file_type": "text/csv",
+                "caption": "users",
+            },
+        )
+        await output.send_queue.close()
+
+        assert server.requests[0]["method"] == "sendDocument"
+        params = server.requests[0]["params"]
+        assert params["chat_id"] == "1"
+        assert params["caption"] == "users"
+        assert params["document"] == ("users.csv", b"a,b\n")
+        assert not os.path.exists(path)
+
+    run_with_output(test)
+
+
+def test_message_id_edits_and_text_sends():
+    async def test(server, output):
+        await output.send_custom_json(
+            "1", {"text": "edited", "chat_id": "2", "message_id": 5}
+        )
+        await output.send_custom_json("1", {"text": "new"})
+        await output.send_custom_json("1", {"text": "elsewhere", "chat_id": "3"})
+        await output.send_queue.close()
+
+        requests = {r["params"]["text"]: r for r in server.requests}
+        assert requests["edited"]["method"] == "editMessageText"
+        assert requests["edited"]["params"]["chat_id"] == "2"
+        assert requests["edited"]["params"]["message_id"] == 5
+        assert requests["new"]["method"] == "sendMessage"
+        assert requests["new"]["params"]["chat_id"] == "1"
+        assert requests["elsewhere"]["method"] == "sendMessage"
+        assert requests["elsewhere"]["params"]["chat_id"] == "3"
+
+    run_with_output(test)
+
+
+def test_reply_markup_is_serialized():
+    payload = '/refresh{"c":"0123456789abcdef01234567"}'
+
+    async def test(server, output):
+        await output.send_custom_json(
+            "1",
+            {
+                "text": "card",
+                "reply_markup": {
+                    "type": "inline",
+                    "keyboard": [[{"title": "Refresh", "payload": payload}]],
+                },
+            },
+        )
+        await output.send_custom_json("1", {"text": "plain"})
+        await output.send_custom_json(
+            "1", {"text": "keep", "remove_reply_markup": False}
+        )
+        await output.send_queue.close()
+
+        requests = {r["params"]["text"]: r["params"] for r in server.requests}
+        assert requests["card"]["reply_markup"] == {
+            "inline_keyboard": [
+                [{"text": "Refresh", "callback_data": encode_callback_data(payload)}]
+            ]
+        }
+        assert requests["plain"]["reply_markup"] == {"remove_keyboard": True}
+        assert "reply_markup" not in requests["keep"]
+
+    run_with_output(test)
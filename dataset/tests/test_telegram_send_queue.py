@@ -0,0 +1,75 @@
+import asyncio
+from unittest import mock
+
+import aiohttp
+
+from connectors.telegram_api import TelegramApiError
+from connectors.telegram_send_queue import TelegramSendQueue
+
+
+class FailingApi:
+    """Bot API client whose calls fail with the given errors, then succeed."""
+
+    def __init__(self, *errors) -> None:
+        self.errors = list(errors)
+        self.calls = []
+
+    async def call(self, method, params=None):
+        self.calls.append(method)
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"message_id": 1}
+
+
+def send_one(api):
+    async def run():
+        queue = TelegramSendQueue(api, retry_delay=0.01)
+        await queue.put("sendMessage", {"chat_id": 1, "text": "hi"})
+        await queue.close()
+        return queue.stats()
+
+    return asyncio.run(run())
+
+
+def get_connector_error():
+    return aiohttp.ClientConnectorError(
+        mock.Mock(host="api.telegram.org", port=443, ssl=True),
+        ConnectionRefusedError("refused"),
+    )
+
+
+def test_connect_errors_are_retried():
+    api = FailingApi(get_connector_error(), get_connector_error())
+
+    stats = send_one(api)
+
+    assert len(api.calls) == 3
+    assert stats["retried"] == 2
+    assert stats["sent"] == 1
+
+
+def test_throttled_calls_are_retried_after_retry_after():
+    api = FailingApi(TelegramApiError("sendMessage", 429, "Too Many Requests", 1))
+
+    stats = send_one(api)
+
+    assert len(api.calls) == 2
+    assert stats["throttled"] == 1
+    assert stats["sent"] == 1
+
+
+def test_other_errors_fail_once():
+    errors = [
+        asyncio.TimeoutError(),
+        aiohttp.ServerDisconnectedError(),
+        TelegramApiError("sendMessage", 500, "Internal Server Error"),
+        TypeError("bug"),
+    ]
+    for error in errors:
+        api = FailingApi(error)
+
+        stats = send_one(api)
+
+        assert len(api.calls) == 1
+        assert stats["failed"] == 1
+        assert stats["retried"] == 0